@@ -59,4 +59,10 @@ text_encoder = dict(
 save_text_features = True
 save_compressed_text_features = True
 bin_size = 250  # 1GB, 4195 bins
+# save features per sample for LatentFeatureDataset instead of .bin files for BatchFeatureDataset
+latent_cache = False
+# write bins in a background thread, at most max_pending_bins full bins wait for the disk
+async_save = True
+max_pending_bins = 1
+compress_features = False  # gzip .bin files
 log_time = False
@@ -43,12 +43,20 @@ bucket_config = {  # 12s/it
     # ---
     "2048": {1: (0.1, 5)},
 }
+# fill micro-batches up to a number of latent tokens per GPU instead of the batch sizes above (None still disables)
+# token_budget = dict(max_tokens=120000, patch_size=(1, 2, 2), attn_coef=0.0, max_batch_size=512)
+# give all ranks of a step buckets of similar cost, the rank skew is logged as debug/rank_skew
+balance_ranks = False
 
 grad_checkpoint = True
 
 # Acceleration settings
 num_workers = 8
+# decode in threads of the training process rather than worker processes, see scripts/misc/benchmark_dataloader.py
+# worker_type = "thread"
 num_bucket_build_workers = 16
+# cache VAE latents of the clips on a local disk, clips start at multiples of crop_start_quantum frames
+# latent_cache = dict(cache_dir="/mnt/nvme/latent_cache", max_size_gb=500, crop_start_quantum=8)
 dtype = "bf16"
 plugin = "zero2"
 
@@ -110,4 +118,5 @@ adam_eps = 1e-15
 warmup_steps = 1000
 
 cache_pin_memory = True
+device_prefetch = 1  # copy the next batch to the GPU on a side stream during the current step
 pin_memory_cache_pre_alloc_numels = [(290 + 20) * 1024**2] * (2 * 8 + 4)
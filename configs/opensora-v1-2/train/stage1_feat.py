@@ -1,5 +1,7 @@
 # Dataset settings
 dataset = dict(type="BatchFeatureDataset")
+# for features extracted with latent_cache = True:
+# dataset = dict(type="LatentFeatureDataset", data_path="/path/to/features")
 grad_checkpoint = True
 num_workers = 4
 
@@ -82,9 +82,14 @@ def main():
     assert bucket_config is not None, "bucket_config is required for evaluation"
     logger.info("Evaluating bucket_config: %s", bucket_config)
 
+    # the dataset, the dataloader workers and their pinned memory are shared by all buckets and timesteps
+    dataset = build_module(cfg.dataset, DATASETS)
+    reuse_workers = cfg.num_workers > 0
+    dataloader = None
+
     def build_dataset(resolution, num_frames, batch_size):
+        nonlocal dataloader
         bucket_config = {resolution: {num_frames: (1.0, batch_size)}}
-        dataset = build_module(cfg.dataset, DATASETS)
         dataloader_args = dict(
             dataset=dataset,
             batch_size=None,
@@ -93,8 +98,15 @@ def main():
             drop_last=False,
             pin_memory=True,
             process_group=get_data_parallel_group(),
+            cache_pin_memory=reuse_workers,
+            persistent_workers=reuse_workers,
         )
-        dataloader, sampler = prepare_dataloader(bucket_config=bucket_config, **dataloader_args)
+        new_dataloader, sampler = prepare_dataloader(bucket_config=bucket_config, **dataloader_args)
+        if dataloader is not None and reuse_workers:
+            # keep the persistent workers of the first bucket, the new dataloader has not started any
+            dataloader.reset(sampler)
+        else:
+            dataloader = new_dataloader
         num_batch = sampler.get_num_batch()
         num_steps_per_epoch = num_batch // dist.get_world_size()
         return dataloader, num_steps_per_epoch, num_batch
@@ -123,7 +135,10 @@ def main():
                 dataloader_iter = iter(dataloader)
                 for _ in tqdm(range(num_steps_per_epoch), desc=f"res: {res}, num_frames: {num_frames}, t: {t:.2f}"):
                     batch = next(dataloader_iter)
-                    x = batch.pop("video").to(device, dtype)
+                    pinned_video = batch.pop("video")
+                    x = pinned_video.to(device, dtype)
+                    if reuse_workers:
+                        dataloader_iter.remove_cache(pinned_video)
                     y = batch.pop("text")
                     x = vae.encode(x)
                     model_args = text_encoder.encode(y)
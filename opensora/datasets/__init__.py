@@ -1,2 +1,10 @@
-from .datasets import IMG_FPS, BatchFeatureDataset, VariableVideoTextDataset, VideoTextDataset
+from .datasets import (
+    IMG_FPS,
+    BatchFeatureDataset,
+    LatentFeatureDataset,
+    ShardedVideoTextDataset,
+    VariableVideoTextDataset,
+    VideoTextDataset,
+)
+from .latent_cache import LatentCacheWriter
 from .utils import get_transforms_image, get_transforms_video, is_img, is_vid, save_sample
@@ -0,0 +1,42 @@
+import os
+
+import numpy as np
+
+
+class Blocklist:
+    """Row ids of samples that failed to load, shared by all dataloader workers and ranks through a file.
+
+    Workers append one `{epoch} {row id}` line per failure. Samplers only exclude the samples which failed
+    before the current epoch, so that all ranks build the same buckets even though the file keeps growing
+    while they train.
+
+    Args:
+        path (str): path of the blocklist file, created if it does not exist.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        dirname = os.path.dirname(path)
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
+
+    def add(self, index: int, epoch: int) -> None:
+        # a single small write in append mode is not interleaved with the ones of other processes
+        with open(self.path, "a") as f:
+            f.write(f"{epoch} {index}\n")
+
+    def get(self, before_epoch: int) -> np.ndarray:
+        """Return the sorted unique row ids of the samples which failed before `before_epoch`."""
+        if not os.path.exists(self.path):
+            return np.zeros(0, dtype=np.int64)
+        indices = []
+        with open(self.path, "r") as f:
+            for line in f:
+                fields = line.split()
+                # skip lines being written
+                if len(fields) != 2 or not line.endswith("\n"):
+                    continue
+                epoch, index = int(fields[0]), int(fields[1])
+                if epoch < before_epoch:
+                    indices.append(index)
+        return np.unique(np.array(indices, dtype=np.int64))
@@ -5,6 +5,7 @@ import numpy as np
 from opensora.utils.misc import get_logger
 
 from .aspect import ASPECT_RATIOS, get_closest_ratio
+from .seeded_random import default_rng_random
 
 
 def find_approximate_hw(hw, hw_dict, approx=0.8):
@@ -28,8 +29,58 @@ def find_closet_smaller_bucket(t, t_dict, frame_interval):
     return None
 
 
+class TokenBudget:
+    """Batch sizes filling each micro-batch up to a number of latent tokens, instead of the fixed ones of the config.
+
+    Args:
+        max_tokens (int): target number of tokens of a micro-batch on each GPU.
+        get_latent_size (callable): size of the latent of a (T, H, W) video, e.g. `vae.get_latent_size`.
+        patch_size (tuple): patch size of the diffusion model.
+        sp_size (int): sequence parallel size, the tokens of a sample are split among `sp_size` GPUs.
+        attn_coef (float): memory model of a bucket, a sample of N = T' * H' * W' tokens costs
+            `N * (1 + attn_coef * (H' * W' + T'))` tokens, to account for spatial and temporal attention.
+        max_batch_size (int, optional): upper bound of the batch sizes.
+    """
+
+    def __init__(
+        self,
+        max_tokens,
+        get_latent_size,
+        patch_size=(1, 2, 2),
+        sp_size=1,
+        attn_coef=0.0,
+        max_batch_size=None,
+    ):
+        self.max_tokens = max_tokens
+        self.get_latent_size = get_latent_size
+        self.patch_size = patch_size
+        self.sp_size = sp_size
+        self.attn_coef = attn_coef
+        self.max_batch_size = max_batch_size
+
+    def get_cost(self, T, H, W):
+        latent_size = self.get_latent_size((T, H, W))
+        t, h, w = [-(-size // patch) for size, patch in zip(latent_size, self.patch_size)]
+        return t * h * w * (1 + self.attn_coef * (h * w + t)) / self.sp_size
+
+    def get_batch_size(self, T, H, W):
+        batch_size = max(int(self.max_tokens // self.get_cost(T, H, W)), 1)
+        if self.max_batch_size is not None:
+            batch_size = min(batch_size, self.max_batch_size)
+        return batch_size
+
+
 class Bucket:
-    def __init__(self, bucket_config):
+    """Buckets of (resolution, number of frames, aspect ratio) of a bucket config.
+
+    Args:
+        bucket_config (dict): {resolution: {num_frames: (prob, batch_size)}}, buckets with a None batch size are
+            disabled.
+        token_budget (TokenBudget, optional): compute the batch sizes from a token budget, the batch size of the
+            largest aspect ratio is used for all aspect ratios of a (resolution, num_frames) bucket.
+    """
+
+    def __init__(self, bucket_config, token_budget=None):
         for key in bucket_config:
             assert key in ASPECT_RATIOS, f"Aspect ratio {key} not found."
         # wrap config with OrderedDict
@@ -69,8 +120,22 @@ class Bucket:
         self.t_criteria = t_criteria
         self.ar_criteria = ar_criteria
         self.num_bucket = num_bucket
+        self.token_budget = token_budget
         get_logger().info("Number of buckets: %s", num_bucket)
 
+        if token_budget is not None:
+            for hw_id, t_bs in bucket_bs.items():
+                for t_id, bs in t_bs.items():
+                    if bs is None:
+                        continue
+                    sizes = self.ar_criteria[hw_id][t_id].values()
+                    t_bs[t_id] = min(token_budget.get_batch_size(t_id, h, w) for h, w in sizes)
+            get_logger().info(
+                "Batch sizes for %s tokens: %s",
+                token_budget.max_tokens,
+                {hw_id: dict(t_bs) for hw_id, t_bs in bucket_bs.items()},
+            )
+
     def get_bucket_id(self, T, H, W, frame_interval=1, seed=None):
         resolution = H * W
         approx = 0.8
@@ -119,6 +184,75 @@ class Bucket:
         ar_id = get_closest_ratio(H, W, ar_criteria)
         return hw_id, t_id, ar_id
 
+    def get_bucket_ids(self, T, H, W, frame_interval=1, seeds=None):
+        """Vectorized version of `get_bucket_id`.
+
+        Sample i gets the same bucket as `get_bucket_id(T[i], H[i], W[i], frame_interval, seeds[i])`, since the
+        random draws are bit-exact with `np.random.default_rng(seeds[i] + bucket index)`.
+
+        Args:
+            T, H, W (np.ndarray): number of frames, height and width of each sample.
+            seeds (np.ndarray): non-negative integer seed of each sample.
+
+        Returns:
+            codes (np.ndarray): int64 index into `bucket_list` for each sample, -1 if no bucket fits.
+            bucket_list (list): all (hw_id, t_id, ar_id) bucket ids.
+        """
+        T, H, W = np.asarray(T), np.asarray(H), np.asarray(W)
+        seeds = np.asarray(seeds)
+        resolution = H * W
+        approx = 0.8
+
+        bucket_list = []
+        bucket_offset = dict()
+        for hw_id, t_ar in self.ar_criteria.items():
+            for t_id, ar_criteria in t_ar.items():
+                bucket_offset[(hw_id, t_id)] = len(bucket_list)
+                bucket_list.extend((hw_id, t_id, ar_id) for ar_id in ar_criteria)
+
+        codes = np.full(len(T), -1, dtype=np.int64)
+        undecided = np.ones(len(T), dtype=bool)
+
+        def assign(indices, hw_id, t_id):
+            ar_criteria = self.ar_criteria[hw_id][t_id]
+            ratios = np.array([float(ratio) for ratio in ar_criteria])
+            # same as get_closest_ratio, ties go to the first ratio
+            ar_idx = np.abs(ratios[None, :] - (H[indices] / W[indices])[:, None]).argmin(axis=1)
+            codes[indices] = bucket_offset[(hw_id, t_id)] + ar_idx
+            undecided[indices] = False
+
+        for hw_id, t_criteria in self.bucket_probs.items():
+            indices = np.flatnonzero(undecided & ~(resolution < self.hw_criteria[hw_id] * approx))
+            if len(indices) == 0:
+                continue
+            is_image = T[indices] == 1
+
+            # images that fail here cannot be put into a video bucket of the same resolution
+            if 1 in t_criteria:
+                image_indices = indices[is_image]
+                draws = default_rng_random(seeds[image_indices] + self.bucket_id[hw_id][1])
+                assign(image_indices[draws[0] < t_criteria[1]], hw_id, 1)
+
+            # otherwise, find suitable t_id for video
+            pending = indices[~is_image]
+            for t_id, prob in t_criteria.items():
+                if len(pending) == 0:
+                    break
+                draws = default_rng_random(seeds[pending] + self.bucket_id[hw_id][t_id], num_draws=2)
+                if isinstance(prob, tuple):
+                    # the first draw decides on t_id, the second one on the resolution
+                    passed = ~(draws[0] > prob[1])
+                    prob, draw = prob[0], draws[1]
+                else:
+                    passed = np.ones(len(pending), dtype=bool)
+                    draw = draws[0]
+                found = passed & (T[pending] > t_id * frame_interval) & (t_id != 1)
+                # leave the loop if prob is high enough
+                accepted = np.ones(found.sum(), dtype=bool) if prob >= 1 else draw[found] < prob
+                assign(pending[found][accepted], hw_id, t_id)
+                pending = pending[~found]
+        return codes, bucket_list
+
     def get_thw(self, bucket_id):
         assert len(bucket_id) == 3
         T = self.t_criteria[bucket_id[0]][bucket_id[1]]
@@ -131,6 +265,23 @@ class Bucket:
     def get_batch_size(self, bucket_id):
         return self.bucket_bs[bucket_id[0]][bucket_id[1]]
 
+    def get_cost(self, bucket_id):
+        """Estimated cost of a micro-batch of the bucket: its latent tokens with a token budget, else its pixels."""
+        T, H, W = self.get_thw(bucket_id)
+        cost = self.token_budget.get_cost(T, H, W) if self.token_budget is not None else T * H * W
+        return cost * self.get_batch_size(bucket_id)
+
+    def get_max_batch_numel(self, num_channels=3):
+        """Return the number of elements of the largest video micro-batch among all buckets."""
+        max_numel = 0
+        for hw_id, t_bs in self.bucket_bs.items():
+            for t_id, bs in t_bs.items():
+                if bs is None:
+                    continue
+                max_hw = max(h * w for h, w in self.ar_criteria[hw_id][t_id].values())
+                max_numel = max(max_numel, bs * num_channels * t_id * max_hw)
+        return max_numel
+
     def __len__(self):
         return self.num_bucket
 
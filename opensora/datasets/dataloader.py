@@ -1,8 +1,10 @@
 import collections
 import functools
+import itertools
 import queue
 import random
 import threading
+from concurrent.futures import ThreadPoolExecutor
 from typing import Optional
 
 import numpy as np
@@ -22,13 +24,34 @@ from torch.utils.data.dataloader import (
     _SingleProcessDataLoaderIter,
 )
 
-from .datasets import BatchFeatureDataset, VariableVideoTextDataset, VideoTextDataset
+from .datasets import (
+    BatchFeatureDataset,
+    LatentFeatureDataset,
+    ShardedVideoTextDataset,
+    VariableVideoTextDataset,
+    VideoTextDataset,
+)
 from .pin_memory_cache import PinMemoryCache
-from .sampler import BatchDistributedSampler, StatefulDistributedSampler, VariableVideoBatchSampler
+from .read_video import disable_forced_gc
+from .sampler import (
+    BatchDistributedSampler,
+    LatentBatchSampler,
+    ShardedBucketSampler,
+    StatefulDistributedSampler,
+    VariableVideoBatchSampler,
+)
+from .shared_memory_pool import SharedMemoryCollate, SharedMemoryPool, get_slot_tensor
 
 
 def _pin_memory_loop(
-    in_queue, out_queue, device_id, done_event, device, pin_memory_cache: PinMemoryCache, pin_memory_key: str
+    in_queue,
+    out_queue,
+    device_id,
+    done_event,
+    device,
+    pin_memory_cache: PinMemoryCache,
+    pin_memory_key: str,
+    shm_pool: Optional[SharedMemoryPool] = None,
 ):
     # This setting is thread local, and prevents the copy in pin_memory from
     # consuming all CPU cores.
@@ -48,13 +71,20 @@ def _pin_memory_loop(
         except queue.Empty:
             return
         idx, data = r
-        if not done_event.is_set() and not isinstance(data, ExceptionWrapper):
+        # data is None for the acknowledgements of persistent workers resuming a new epoch
+        if not done_event.is_set() and not isinstance(data, ExceptionWrapper) and data is not None:
             try:
                 assert isinstance(data, dict)
                 if pin_memory_key in data:
-                    val = data[pin_memory_key]
-                    pin_memory_value = pin_memory_cache.get(val)
-                    pin_memory_value.copy_(val)
+                    val, slot = get_slot_tensor(shm_pool, data[pin_memory_key])
+                    try:
+                        pin_memory_value = pin_memory_cache.get(val)
+                        pin_memory_value.copy_(val)
+                    finally:
+                        # the slab can be reused by workers once copied
+                        if slot is not None:
+                            del val
+                            shm_pool.release(slot.slot_id)
                     data[pin_memory_key] = pin_memory_value
             except Exception:
                 data = ExceptionWrapper(where=f"in pin memory thread for device {device_id}")
@@ -93,6 +123,23 @@ class _MultiProcessingDataLoaderIterForVideo(_MultiProcessingDataLoaderIter):
 
         self._worker_init_fn = loader.worker_init_fn
 
+        # samples that failed to load in any worker, see get_num_bad_samples
+        self.bad_sample_counter = multiprocessing_context.Value("q", 0)
+        self._dataset.bad_sample_counter = self.bad_sample_counter
+        # persistent workers keep the dataset of the first epoch, the current epoch is shared with them
+        self.shared_epoch = multiprocessing_context.Value("q", 0)
+        self._dataset.shared_epoch = self.shared_epoch
+        # set while _reset drops the batches left from an unfinished pass
+        self._discarding = False
+
+        # workers write batches into preallocated shared memory slabs, only slot ids go through the queue
+        self.shm_pool = None
+        if getattr(loader, "shm_slot_nbytes", None) is not None:
+            assert self._pin_memory, "Shared memory transport requires pin_memory=True"
+            num_slots = loader.shm_num_slots or self._num_workers + 2
+            self.shm_pool = SharedMemoryPool(num_slots, loader.shm_slot_nbytes, multiprocessing_context)
+            self._collate_fn = SharedMemoryCollate(self._collate_fn, self.shm_pool, self.pin_memory_key)
+
         # Adds forward compatibilities so classic DataLoader can work with DataPipes:
         #   Additional worker init function will take care of sharding in MP and Distributed
         if isinstance(self._dataset, (IterDataPipe, MapDataPipe)):
@@ -166,6 +213,7 @@ class _MultiProcessingDataLoaderIterForVideo(_MultiProcessingDataLoaderIter):
                     self._pin_memory_device,
                     self.pin_memory_cache,
                     self.pin_memory_key,
+                    self.shm_pool,
                 ),
             )
             pin_memory_thread.daemon = True
@@ -195,21 +243,283 @@ class _MultiProcessingDataLoaderIterForVideo(_MultiProcessingDataLoaderIter):
         self._worker_pids_set = True
         self._reset(loader, first_iter=True)
 
+    def _reset(self, loader, first_iter=False):
+        self.shared_epoch.value = getattr(self._dataset, "epoch", 0)
+        if first_iter:
+            super()._reset(loader, first_iter)
+            return
+        # the batch sampler may have been replaced by DataloaderForVideo.reset
+        self._index_sampler = loader._index_sampler
+        # with persistent workers, the batches of an unfinished pass are dropped, release their pinned memory
+        for info in self._task_info.values():
+            if len(info) == 2:
+                self._release_pinned(info[1])
+        self._discarding = True
+        try:
+            super()._reset(loader, first_iter)
+        finally:
+            self._discarding = False
+
+    def _get_data(self):
+        idx, data = super()._get_data()
+        if self._discarding and not isinstance(idx, _utils.worker._ResumeIteration):
+            self._release_pinned(data)
+        return idx, data
+
+    def _release_pinned(self, data):
+        if isinstance(data, dict) and isinstance(data.get(self.pin_memory_key, None), torch.Tensor):
+            try:
+                self.pin_memory_cache.remove(data[self.pin_memory_key])
+            except ValueError:
+                # not from the cache, e.g. without pin_memory
+                pass
+
+    def remove_cache(self, output_tensor: torch.Tensor):
+        self.pin_memory_cache.remove(output_tensor)
+
+    def get_cache_info(self) -> str:
+        return str(self.pin_memory_cache)
+
+    def get_num_bad_samples(self) -> int:
+        return self.bad_sample_counter.value
+
+
+class _ThreadedDataLoaderIterForVideo(_BaseDataLoaderIter):
+    """Load batches in a pool of threads of the main process instead of worker processes.
+
+    PyAV releases the GIL while demuxing and decoding, so threads decode in parallel while sharing the dataset
+    metadata and the pinned memory cache: there is no fork, no pickling of batches and no pin memory thread, each
+    decode thread copies its video straight into the pinned cache. Batches are returned in the sampler order.
+
+    The threads share the global `random`, `numpy` and `torch` generators of the process, which are seeded once from
+    the base seed of the loader like a worker process, and `worker_init_fn` is called in each thread. Random
+    transforms are still not reproducible across runs: which thread draws next depends on the scheduling.
+    """
+
+    pin_memory_key: str = "video"
+
+    def __init__(self, loader):
+        super().__init__(loader)
+        assert self._num_workers > 0
+        assert self._auto_collation, "Thread workers load whole batches, a batch sampler or batch size is required"
+        self.pin_memory_cache = PinMemoryCache()
+        self._prefetch_factor = loader.prefetch_factor or 2
+
+        # same interface as the process workers, see _MultiProcessingDataLoaderIterForVideo
+        self.bad_sample_counter = multiprocessing.Value("q", 0)
+        self._dataset.bad_sample_counter = self.bad_sample_counter
+        self.shared_epoch = multiprocessing.Value("q", 0)
+        self._dataset.shared_epoch = self.shared_epoch
+
+        # same seeds as the worker 0 of the process path
+        seed = self._base_seed
+        random.seed(seed)
+        torch.manual_seed(seed)
+        np.random.seed(seed % 2**32)
+        self._worker_init_fn = loader.worker_init_fn
+        self._worker_ids = itertools.count()
+        self._pool = ThreadPoolExecutor(
+            self._num_workers, thread_name_prefix="video_decode", initializer=self._init_thread
+        )
+        self._futures = collections.deque()
+        self._reset(loader, first_iter=True)
+
+    def _init_thread(self):
+        # no forced gc.collect() per video, it would collect the objects of the training process
+        disable_forced_gc()
+        if self._worker_init_fn is not None:
+            self._worker_init_fn(next(self._worker_ids))
+
+    def _reset(self, loader, first_iter=False):
+        # the batch sampler may have been replaced by DataloaderForVideo.reset
+        self._index_sampler = loader._index_sampler
+        self._drop_pending()
+        super()._reset(loader, first_iter)
+        self.shared_epoch.value = getattr(self._dataset, "epoch", 0)
+        for _ in range(self._num_workers * self._prefetch_factor):
+            self._try_put_index()
+
+    def _drop_pending(self):
+        # batches of an unfinished pass, the running ones are waited for to release their pinned memory
+        while self._futures:
+            future = self._futures.popleft()
+            if not future.cancel():
+                try:
+                    self._release_pinned(future.result())
+                except Exception:
+                    pass
+
+    def _try_put_index(self):
+        try:
+            index = self._next_index()
+        except StopIteration:
+            return
+        self._futures.append(self._pool.submit(self._fetch, index))
+
+    def _fetch(self, index):
+        if hasattr(self._dataset, "__getitems__") and self._dataset.__getitems__:
+            data = self._dataset.__getitems__(index)
+        else:
+            data = [self._dataset[idx] for idx in index]
+        data = self._collate_fn(data)
+        if self._pin_memory and isinstance(data, dict) and self.pin_memory_key in data:
+            pin_memory_value = self.pin_memory_cache.get(data[self.pin_memory_key])
+            pin_memory_value.copy_(data[self.pin_memory_key])
+            data[self.pin_memory_key] = pin_memory_value
+        return data
+
+    def _next_data(self):
+        if not self._futures:
+            raise StopIteration
+        data = self._futures.popleft().result()
+        self._try_put_index()
+        return data
+
+    def _release_pinned(self, data):
+        if isinstance(data, dict) and isinstance(data.get(self.pin_memory_key, None), torch.Tensor):
+            try:
+                self.pin_memory_cache.remove(data[self.pin_memory_key])
+            except ValueError:
+                # not from the cache, e.g. without pin_memory
+                pass
+
     def remove_cache(self, output_tensor: torch.Tensor):
         self.pin_memory_cache.remove(output_tensor)
 
     def get_cache_info(self) -> str:
         return str(self.pin_memory_cache)
 
+    def get_num_bad_samples(self) -> int:
+        return self.bad_sample_counter.value
+
+    def __del__(self):
+        if hasattr(self, "_pool"):
+            for future in self._futures:
+                future.cancel()
+            self._pool.shutdown(wait=False)
+
 
 class DataloaderForVideo(DataLoader):
+    """
+    DataLoader that copies videos into a reusable pinned memory cache.
+
+    With `persistent_workers=True`, the workers and the pinned memory cache are kept across epochs, and `reset`
+    switches to another batch sampler over the same dataset without restarting them.
+
+    Args:
+        shm_slot_nbytes (int, optional): if set, workers write the video batch into preallocated
+            shared memory slabs of this size instead of sending it through the result queue.
+        shm_num_slots (int, optional): number of shared memory slabs, defaults to num_workers + 2.
+        worker_type (str): "process" for worker processes, "thread" for `num_workers` decode threads in the
+            main process, which use much less memory and start instantly. Requires a map-style dataset.
+    """
+
+    def __init__(
+        self,
+        *args,
+        shm_slot_nbytes: Optional[int] = None,
+        shm_num_slots: Optional[int] = None,
+        worker_type: str = "process",
+        **kwargs,
+    ):
+        assert worker_type in ("process", "thread"), f"Unknown worker type: {worker_type}"
+        assert worker_type == "process" or shm_slot_nbytes is None, "Thread workers do not need shared memory"
+        self.shm_slot_nbytes = shm_slot_nbytes
+        self.shm_num_slots = shm_num_slots
+        self.worker_type = worker_type
+        super().__init__(*args, **kwargs)
+
     def _get_iterator(self) -> "_BaseDataLoaderIter":
         if self.num_workers == 0:
             return _SingleProcessDataLoaderIter(self)
+        elif self.worker_type == "thread":
+            return _ThreadedDataLoaderIterForVideo(self)
         else:
             self.check_worker_number_rationality()
             return _MultiProcessingDataLoaderIterForVideo(self)
 
+    def reset(self, batch_sampler=None) -> None:
+        """Use another batch sampler of the same dataset from the next `iter(self)` on, e.g. to evaluate another
+        bucket. Persistent workers are reused, as the bucket of each sample is encoded in its index."""
+        if batch_sampler is not None:
+            # DataLoader forbids setting batch_sampler after its __init__
+            object.__setattr__(self, "batch_sampler", batch_sampler)
+
+
+class DevicePrefetcher:
+    """Copy the tensors of the next batches to the device on a side CUDA stream while the current step runs.
+
+    Up to `num_prefetch` batches are in flight. A batch is handed out once the compute stream has been made to
+    wait for the event recorded after its copies, so the copy of the next batch overlaps with the forward and
+    backward passes of the current one. Pinned videos from `DataloaderForVideo` are released to its
+    `PinMemoryCache` only once their copy event has completed, so the cache never reuses a slot being read.
+
+    Args:
+        loader_iter: the iterator of the dataloader.
+        device (torch.device): the CUDA device.
+        num_prefetch (int): number of batches copied ahead.
+        release_fn (callable, optional): called with the pinned video of a batch once it has been copied,
+            e.g. `remove_cache` of the iterator of `DataloaderForVideo`.
+    """
+
+    def __init__(self, loader_iter, device, num_prefetch: int = 1, release_fn=None, pin_memory_key: str = "video"):
+        self.loader_iter = loader_iter
+        self.device = device
+        self.num_prefetch = max(num_prefetch, 1)
+        self.release_fn = release_fn
+        self.pin_memory_key = pin_memory_key
+        self.stream = torch.cuda.Stream(device=device)
+        self.in_flight = collections.deque()  # (batch, event)
+        self.pending_release = collections.deque()  # (pinned tensor, event)
+        self.exhausted = False
+
+    def __iter__(self):
+        return self
+
+    def _preload(self):
+        try:
+            batch = next(self.loader_iter)
+        except StopIteration:
+            self.exhausted = True
+            return
+        pinned = batch.get(self.pin_memory_key, None)
+        with torch.cuda.stream(self.stream):
+            for k, v in batch.items():
+                if isinstance(v, torch.Tensor):
+                    batch[k] = v.to(self.device, non_blocking=True)
+            event = torch.cuda.Event()
+            event.record(self.stream)
+        if self.release_fn is not None and isinstance(pinned, torch.Tensor):
+            self.pending_release.append((pinned, event))
+        self.in_flight.append((batch, event))
+
+    def _release_copied(self, wait: bool = False):
+        # slots are released in the order of the copies, which complete in the same order on the stream
+        while self.pending_release and (wait or self.pending_release[0][1].query()):
+            pinned, event = self.pending_release.popleft()
+            event.synchronize()
+            self.release_fn(pinned)
+
+    def __next__(self):
+        while not self.exhausted and len(self.in_flight) <= self.num_prefetch:
+            self._preload()
+        self._release_copied()
+        if not self.in_flight:
+            self._release_copied(wait=True)
+            raise StopIteration
+        batch, event = self.in_flight.popleft()
+        current_stream = torch.cuda.current_stream(self.device)
+        current_stream.wait_event(event)
+        for v in batch.values():
+            if isinstance(v, torch.Tensor) and v.is_cuda:
+                # allocated on the side stream, do not let its memory be reused while the compute stream uses it
+                v.record_stream(current_stream)
+        return batch
+
+    def __getattr__(self, name):
+        # e.g. get_cache_info and get_num_bad_samples of the dataloader iterator
+        return getattr(self.loader_iter, name)
+
 
 # Deterministic dataloader
 def get_seed_worker(seed):
@@ -235,10 +545,52 @@ def prepare_dataloader(
     num_bucket_build_workers=1,
     prefetch_factor=None,
     cache_pin_memory=False,
+    shm_transport=False,
+    token_budget=None,
+    balance_ranks=False,
+    worker_type="process",
     **kwargs,
 ):
     _kwargs = kwargs.copy()
-    if isinstance(dataset, VariableVideoTextDataset):
+    if worker_type != "process":
+        # decode threads load whole batches of a map-style dataset, see DataloaderForVideo
+        assert cache_pin_memory, "Thread workers are only supported with cache_pin_memory=True"
+        assert isinstance(dataset, (VariableVideoTextDataset, VideoTextDataset)) and not isinstance(
+            dataset, ShardedVideoTextDataset
+        ), f"Thread workers are not supported for {type(dataset).__name__}"
+        _kwargs["worker_type"] = worker_type
+    if isinstance(dataset, ShardedVideoTextDataset):
+        # the dataset yields whole micro-batches, which are planned by the sampler
+        assert not _kwargs.get("persistent_workers", False), "Workers read the epoch from their copy of the sampler"
+        sampler = ShardedBucketSampler(
+            dataset,
+            bucket_config,
+            num_replicas=process_group.size(),
+            rank=process_group.rank(),
+            num_workers=num_workers,
+            shuffle=shuffle,
+            seed=seed,
+            verbose=True,
+            token_budget=token_budget,
+        )
+        dataset.sampler = sampler
+        dl_cls = DataloaderForVideo if cache_pin_memory else DataLoader
+        if cache_pin_memory and shm_transport:
+            _kwargs["shm_slot_nbytes"] = sampler.bucket.get_max_batch_numel() * _video_element_size(dataset)
+        return (
+            dl_cls(
+                dataset,
+                batch_size=None,
+                worker_init_fn=get_seed_worker(seed),
+                pin_memory=pin_memory,
+                num_workers=num_workers,
+                collate_fn=collate_fn_default,
+                prefetch_factor=prefetch_factor,
+                **_kwargs,
+            ),
+            sampler,
+        )
+    elif isinstance(dataset, VariableVideoTextDataset):
         batch_sampler = VariableVideoBatchSampler(
             dataset,
             bucket_config,
@@ -249,8 +601,12 @@ def prepare_dataloader(
             drop_last=drop_last,
             verbose=True,
             num_bucket_build_workers=num_bucket_build_workers,
+            token_budget=token_budget,
+            balance_ranks=balance_ranks,
         )
         dl_cls = DataloaderForVideo if cache_pin_memory else DataLoader
+        if cache_pin_memory and shm_transport:
+            _kwargs["shm_slot_nbytes"] = batch_sampler.bucket.get_max_batch_numel() * _video_element_size(dataset)
         return (
             dl_cls(
                 dataset,
@@ -273,6 +629,9 @@ def prepare_dataloader(
             shuffle=shuffle,
         )
         dl_cls = DataloaderForVideo if cache_pin_memory else DataLoader
+        if cache_pin_memory and shm_transport:
+            num_frames, (height, width) = dataset.num_frames, dataset.image_size
+            _kwargs["shm_slot_nbytes"] = batch_size * 3 * num_frames * height * width * _video_element_size(dataset)
         return (
             dl_cls(
                 dataset,
@@ -288,6 +647,28 @@ def prepare_dataloader(
             ),
             sampler,
         )
+    elif isinstance(dataset, LatentFeatureDataset):
+        batch_sampler = LatentBatchSampler(
+            dataset,
+            num_replicas=process_group.size(),
+            rank=process_group.rank(),
+            shuffle=shuffle,
+            seed=seed,
+            drop_last=drop_last,
+        )
+        return (
+            DataLoader(
+                dataset,
+                batch_sampler=batch_sampler,
+                worker_init_fn=get_seed_worker(seed),
+                pin_memory=pin_memory,
+                num_workers=num_workers,
+                collate_fn=collate_fn_default,
+                prefetch_factor=prefetch_factor,
+                **_kwargs,
+            ),
+            batch_sampler,
+        )
     elif isinstance(dataset, BatchFeatureDataset):
         sampler = BatchDistributedSampler(
             dataset,
@@ -312,10 +693,22 @@ def prepare_dataloader(
         raise ValueError(f"Unsupported dataset type: {type(dataset)}")
 
 
+def _video_element_size(dataset):
+    # videos are float32 after the transforms, unless left as uint8
+    return 1 if getattr(dataset, "uint8_output", False) else 4
+
+
 def collate_fn_default(batch):
     # filter out None
     batch = [x for x in batch if x is not None]
 
+    # latents found in the latent cache are batched apart from the videos, which come first
+    latents = None
+    if any("latent" in x for x in batch):
+        batch = [x for x in batch if "latent" not in x] + [x for x in batch if "latent" in x]
+        latents = torch.stack([x.pop("latent") for x in batch if "latent" in x])
+        videos = [x.pop("video") for x in batch if "video" in x]
+
     # HACK: for loading text features
     use_mask = False
     if "mask" in batch[0] and isinstance(batch[0]["mask"], int):
@@ -330,6 +723,10 @@ def collate_fn_default(batch):
     if use_mask:
         ret["mask"] = masks
         ret["text"] = texts
+    if latents is not None:
+        ret["latent"] = latents
+        if len(videos) > 0:
+            ret["video"] = torch.stack(videos)
     return ret
 
 
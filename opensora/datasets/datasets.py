@@ -1,15 +1,30 @@
+import collections
+import gzip
+import io
 import os
 from glob import glob
 
 import numpy as np
+import pandas as pd
 import torch
-from PIL import ImageFile
+from PIL import Image, ImageFile
 from torchvision.datasets.folder import IMG_EXTENSIONS, pil_loader
 
 from opensora.registry import DATASETS
 
+from .blocklist import Blocklist
+from .latent_cache import LatentCache
+from .metadata import MetadataStore, is_metadata_store
 from .read_video import read_video
-from .utils import VID_EXTENSIONS, get_transforms_image, get_transforms_video, read_file, temporal_random_crop
+from .utils import (
+    VID_EXTENSIONS,
+    get_temporal_crop_indices,
+    get_transforms_image,
+    get_transforms_video,
+    read_file,
+    resize_crop_uint8,
+    temporal_random_crop,
+)
 
 ImageFile.LOAD_TRUNCATED_IMAGES = True
 IMG_FPS = 120
@@ -20,11 +35,22 @@ class VideoTextDataset(torch.utils.data.Dataset):
     """load video according to the csv file.
 
     Args:
+        data_path (str): a `.csv`/`.parquet` file, or a directory built by `metadata.build_metadata` which is
+            memory-mapped instead of being loaded into a DataFrame in every worker.
         target_video_len (int): the number of video frames will be load.
         align_transform (callable): Align different videos in a specified size.
         temporal_sample (callable): Sample the target length of a video.
+        uint8_output (bool): return uint8 videos of size [T, H, W, C] which are only resized and cropped,
+            the conversion to float and the normalization are left to `video_transforms.normalize_uint8_video`.
+        blocklist_path (str, optional): file recording the samples that failed to load, which are skipped by
+            the samplers from the next epoch on, see `Blocklist`.
     """
 
+    # shared counter of failed samples, set by the dataloader iterator before the workers start
+    bad_sample_counter = None
+    # shared current epoch, set by the dataloader iterator for persistent workers
+    shared_epoch = None
+
     def __init__(
         self,
         data_path=None,
@@ -32,22 +58,50 @@ class VideoTextDataset(torch.utils.data.Dataset):
         frame_interval=1,
         image_size=(256, 256),
         transform_name="center",
+        uint8_output=False,
+        blocklist_path=None,
     ):
         self.data_path = data_path
-        self.data = read_file(data_path)
+        if is_metadata_store(data_path):
+            self.data = MetadataStore(data_path)
+        else:
+            self.data = read_file(data_path)
         self.get_text = "text" in self.data.columns
         self.num_frames = num_frames
         self.frame_interval = frame_interval
         self.image_size = image_size
+        self.uint8_output = uint8_output
+        self.blocklist = Blocklist(blocklist_path) if blocklist_path is not None else None
+        # set by the sampler, failures are recorded with the epoch they happen in
+        self.epoch = 0
         self.transforms = {
             "image": get_transforms_image(transform_name, image_size),
             "video": get_transforms_video(transform_name, image_size),
         }
 
+    def get_sample(self, index):
+        if isinstance(self.data, MetadataStore):
+            return self.data.get_row(index)
+        return self.data.iloc[index]
+
+    def get_column(self, name):
+        if isinstance(self.data, MetadataStore):
+            return self.data[name]
+        return self.data[name].to_numpy()
+
+    def record_bad_sample(self, index, error):
+        print(f"data {self.get_sample(index)['path']}: {error}")
+        if self.bad_sample_counter is not None:
+            with self.bad_sample_counter.get_lock():
+                self.bad_sample_counter.value += 1
+        if self.blocklist is not None:
+            epoch = self.shared_epoch.value if self.shared_epoch is not None else self.epoch
+            self.blocklist.add(index, epoch)
+
     def _print_data_number(self):
         num_videos = 0
         num_images = 0
-        for path in self.data["path"]:
+        for path in self.get_column("path"):
             if self.get_type(path) == "video":
                 num_videos += 1
             else:
@@ -62,36 +116,88 @@ class VideoTextDataset(torch.utils.data.Dataset):
             assert ext.lower() in IMG_EXTENSIONS, f"Unsupported file format: {ext}"
             return "image"
 
+    def open_file(self, sample):
+        """Return the path, or a file object, to read the video or image of a data row from."""
+        return sample["path"]
+
+    def load_image(self, sample):
+        source = self.open_file(sample)
+        if isinstance(source, str):
+            return pil_loader(source)
+        return Image.open(source).convert("RGB")
+
+    def get_crop_indices(self, sample, num_frames, start_quantum=1):
+        """Pick the frames of a clip from the number of frames recorded in the data row, None if it is unknown."""
+        total_frames = sample.get("num_frames", None)
+        if total_frames is None or pd.isna(total_frames):
+            return None
+        return get_temporal_crop_indices(int(total_frames), num_frames, self.frame_interval, start_quantum)
+
+    def read_video_clip(self, sample, num_frames, target_size=None, frame_indice=None):
+        """Read `num_frames` frames sampled from the video of a data row.
+
+        If the row records the number of frames of the video, the crop window is picked first (unless given as
+        `frame_indice`) and only the sampled frames are decoded. Otherwise, or if the recorded number is wrong,
+        the whole video is decoded and randomly cropped afterwards, which is flagged by `vinfo["recropped"]`.
+        If `target_size` is given, frames are downscaled while decoding to the smallest size that still covers it.
+        If the row has a `frame_index` (see `datautil --frame-index`), only the GOPs of the clip are decoded.
+        """
+        if frame_indice is None:
+            frame_indice = self.get_crop_indices(sample, num_frames)
+        if frame_indice is not None:
+            frame_index = sample.get("frame_index", None)
+            if not isinstance(frame_index, str) or frame_index == "":
+                frame_index = None
+            video, vinfo = read_video(
+                self.open_file(sample),
+                backend="av",
+                frame_indices=frame_indice,
+                target_size=target_size,
+                frame_index=frame_index,
+            )
+            if len(video) == num_frames:
+                return video, vinfo
+
+        vframes, vinfo = read_video(self.open_file(sample), backend="av", target_size=target_size)
+        video = temporal_random_crop(vframes, num_frames, self.frame_interval)
+        vinfo["recropped"] = True
+        return video, vinfo
+
     def getitem(self, index):
-        sample = self.data.iloc[index]
+        sample = self.get_sample(index)
         path = sample["path"]
         file_type = self.get_type(path)
 
         if file_type == "video":
-            # loading
-            vframes, vinfo = read_video(path, backend="av")
+            # loading & sampling video frames
+            video, vinfo = self.read_video_clip(sample, self.num_frames, self.image_size)
             video_fps = vinfo["video_fps"] if "video_fps" in vinfo else 24
 
-            # Sampling video frames
-            video = temporal_random_crop(vframes, self.num_frames, self.frame_interval)
-
             # transform
-            transform = self.transforms["video"]
-            video = transform(video)  # T C H W
+            if not self.uint8_output:
+                transform = self.transforms["video"]
+                video = transform(video)  # T C H W
         else:
             # loading
-            image = pil_loader(path)
+            image = self.load_image(sample)
             video_fps = IMG_FPS
 
             # transform
-            transform = self.transforms["image"]
-            image = transform(image)
+            if self.uint8_output:
+                image = torch.from_numpy(np.array(image)).permute(2, 0, 1)
+            else:
+                transform = self.transforms["image"]
+                image = transform(image)
 
             # repeat
             video = image.unsqueeze(0).repeat(self.num_frames, 1, 1, 1)
 
-        # TCHW -> CTHW
-        video = video.permute(1, 0, 2, 3)
+        if self.uint8_output:
+            # TCHW -> THWC
+            video = resize_crop_uint8(video, self.image_size)
+        else:
+            # TCHW -> CTHW
+            video = video.permute(1, 0, 2, 3)
 
         ret = {"video": video, "fps": video_fps}
         if self.get_text:
@@ -103,8 +209,7 @@ class VideoTextDataset(torch.utils.data.Dataset):
             try:
                 return self.getitem(index)
             except Exception as e:
-                path = self.data.iloc[index]["path"]
-                print(f"data {path}: {e}")
+                self.record_bad_sample(index, e)
                 index = np.random.randint(len(self))
         raise RuntimeError("Too many bad data.")
 
@@ -114,6 +219,13 @@ class VideoTextDataset(torch.utils.data.Dataset):
 
 @DATASETS.register_module()
 class VariableVideoTextDataset(VideoTextDataset):
+    """load videos resized to the (time, height, width) of the bucket picked by `VariableVideoBatchSampler`.
+
+    Args:
+        batch_transform (bool): transform the videos of a micro-batch together in `__getitems__`, stacking the
+            crops of the same size instead of transforming them one by one.
+    """
+
     def __init__(
         self,
         data_path=None,
@@ -122,57 +234,106 @@ class VariableVideoTextDataset(VideoTextDataset):
         image_size=(None, None),
         transform_name=None,
         dummy_text_feature=False,
+        uint8_output=False,
+        blocklist_path=None,
+        batch_transform=False,
     ):
-        super().__init__(data_path, num_frames, frame_interval, image_size, transform_name=None)
+        super().__init__(
+            data_path,
+            num_frames,
+            frame_interval,
+            image_size,
+            transform_name=None,
+            uint8_output=uint8_output,
+            blocklist_path=blocklist_path,
+        )
         self.transform_name = transform_name
-        self.data["id"] = np.arange(len(self.data))
+        if not isinstance(self.data, MetadataStore):
+            self.data["id"] = np.arange(len(self.data))
         self.dummy_text_feature = dummy_text_feature
+        assert not (batch_transform and uint8_output), "uint8 outputs are already batched on device"
+        self.batch_transform = batch_transform
+        self.bucket_transforms = {}
+        # a LatentLRUCache set by the training script, cached latents are returned instead of videos
+        self.latent_cache = None
 
     def get_data_info(self, index):
-        T = self.data.iloc[index]["num_frames"]
-        H = self.data.iloc[index]["height"]
-        W = self.data.iloc[index]["width"]
+        sample = self.get_sample(index)
+        T = sample["num_frames"]
+        H = sample["height"]
+        W = sample["width"]
         return T, H, W
 
+    def get_transform(self, file_type, height, width):
+        # transforms only depend on the bucket, do not rebuild them for every sample
+        key = (file_type, height, width)
+        if key not in self.bucket_transforms:
+            get_transforms = get_transforms_video if file_type == "video" else get_transforms_image
+            self.bucket_transforms[key] = get_transforms(self.transform_name, (height, width))
+        return self.bucket_transforms[key]
+
     def getitem(self, index):
         # a hack to pass in the (time, height, width) info from sampler
-        index, num_frames, height, width = [int(val) for val in index.split("-")]
+        index, num_frames, height, width = [int(val) for val in index.split("-")][:4]
+        return self.load_sample(self.get_sample(index), num_frames, height, width)
 
-        sample = self.data.iloc[index]
+    def load_sample(self, sample, num_frames, height, width):
         path = sample["path"]
         file_type = self.get_type(path)
         ar = height / width
 
+        latent_key = None
+        frame_indice = None
+        if self.latent_cache is not None:
+            start_frame = 0
+            if file_type == "video":
+                frame_indice = self.get_crop_indices(sample, num_frames, self.latent_cache.crop_start_quantum)
+                start_frame = None if frame_indice is None else int(frame_indice[0])
+            if start_frame is not None:
+                latent_key = self.latent_cache.get_key(
+                    path, start_frame, num_frames, height, width, self.frame_interval, self.transform_name
+                )
+                entry = self.latent_cache.get(latent_key)
+                if entry is not None:
+                    return self.get_latent_sample(sample, entry, num_frames, height, width, latent_key)
+
         video_fps = 24  # default fps
         if file_type == "video":
-            # loading
-            vframes, vinfo = read_video(path, backend="av")
+            # loading & sampling video frames
+            video, vinfo = self.read_video_clip(sample, num_frames, (height, width), frame_indice)
             video_fps = vinfo["video_fps"] if "video_fps" in vinfo else 24
-
-            # Sampling video frames
-            video = temporal_random_crop(vframes, num_frames, self.frame_interval)
-            video = video.clone()
-            del vframes
+            if vinfo.get("recropped", False):
+                # the crop is not the one of the key
+                latent_key = None
 
             video_fps = video_fps // self.frame_interval
 
             # transform
-            transform = get_transforms_video(self.transform_name, (height, width))
-            video = transform(video)  # T C H W
+            if not self.uint8_output and not self.batch_transform:
+                video = self.get_transform("video", height, width)(video)  # T C H W
         else:
             # loading
-            image = pil_loader(path)
+            image = self.load_image(sample)
             video_fps = IMG_FPS
 
             # transform
-            transform = get_transforms_image(self.transform_name, (height, width))
-            image = transform(image)
+            if self.uint8_output:
+                image = torch.from_numpy(np.array(image)).permute(2, 0, 1)
+            else:
+                image = self.get_transform("image", height, width)(image)
 
             # repeat
             video = image.unsqueeze(0)
 
-        # TCHW -> CTHW
-        video = video.permute(1, 0, 2, 3)
+        if self.uint8_output:
+            # TCHW -> THWC
+            video = resize_crop_uint8(video, (height, width))
+        elif video.dtype == torch.uint8:
+            # raw crop left to transform_batch
+            pass
+        else:
+            # TCHW -> CTHW
+            video = video.permute(1, 0, 2, 3)
         ret = {
             "video": video,
             "num_frames": num_frames,
@@ -181,6 +342,24 @@ class VariableVideoTextDataset(VideoTextDataset):
             "ar": ar,
             "fps": video_fps,
         }
+        if self.latent_cache is not None:
+            # the training loop inserts the latent under this key once encoded, empty if it cannot be cached
+            ret["latent_key"] = latent_key or ""
+        return self.add_text(sample, ret)
+
+    def get_latent_sample(self, sample, entry, num_frames, height, width, latent_key):
+        ret = {
+            "latent": entry["latent"],
+            "num_frames": num_frames,
+            "height": height,
+            "width": width,
+            "ar": height / width,
+            "fps": entry["fps"],
+            "latent_key": latent_key,
+        }
+        return self.add_text(sample, ret)
+
+    def add_text(self, sample, ret):
         if self.get_text:
             ret["text"] = sample["text"]
         if self.dummy_text_feature:
@@ -190,11 +369,153 @@ class VariableVideoTextDataset(VideoTextDataset):
         return ret
 
     def __getitem__(self, index):
+        # the sampler appends samples of the same bucket to try when the sample fails to load
+        index, num_frames, height, width, *fallbacks = [int(val) for val in index.split("-")]
+        for index in [index, *fallbacks]:
+            try:
+                return self.load_sample(self.get_sample(index), num_frames, height, width)
+            except Exception as e:
+                self.record_bad_sample(index, e)
+        return None
+
+    def __getitems__(self, indices):
+        # called by the dataloader workers with the indices of a whole micro-batch
+        return self.transform_batch([self[index] for index in indices])
+
+    def transform_batch(self, samples):
+        """Transform the raw video crops left by `batch_transform`, once for all the crops of the same size.
+
+        The transforms work on [T, C, H, W] clips, so a group of N crops is transformed as a single clip of
+        N * T frames.
+        """
+        if not self.batch_transform:
+            # the videos are transformed by load_sample, e.g. already resized THWC crops with uint8_output
+            return samples
+        groups = collections.defaultdict(list)
+        for sample in samples:
+            if sample is not None and "video" in sample and sample["video"].dtype == torch.uint8:
+                groups[(sample["video"].shape, sample["height"], sample["width"])].append(sample)
+        for (shape, height, width), group in groups.items():
+            videos = torch.stack([sample["video"] for sample in group]).flatten(0, 1)
+            videos = self.get_transform("video", height, width)(videos)
+            # [N * T, C, H, W] -> [N, C, T, H, W]
+            videos = videos.unflatten(0, (len(group), shape[0])).permute(0, 2, 1, 3, 4)
+            for sample, video in zip(group, videos):
+                sample["video"] = video
+        return samples
+
+
+@DATASETS.register_module()
+class ShardedVideoTextDataset(VariableVideoTextDataset, torch.utils.data.IterableDataset):
+    """Stream video-text pairs from tar shards packed by `tools/datasets/pack_shards.py`.
+
+    Reading a few large shards sequentially avoids opening millions of small files on network file systems.
+    `data_path` is the shard index written next to the shards, i.e. the original data rows with the `shard`
+    file, the `offset` and the `size` of each sample in it. The micro-batches are planned by a
+    `ShardedBucketSampler`, which `prepare_dataloader` attaches as `self.sampler`; each item is a list of
+    samples of the same bucket, like a batch of `VariableVideoTextDataset`.
+
+    Args:
+        shuffle_buffer_size (int): number of samples each worker shuffles before grouping them by bucket.
+        max_pending_samples (int): number of samples waiting for the rest of their micro-batch whose bytes are
+            kept in memory. The bytes of the samples waiting the longest, e.g. of rare buckets, are dropped
+            beyond it and read again once their micro-batch is complete.
+    """
+
+    def __init__(
+        self,
+        data_path=None,
+        num_frames=None,
+        frame_interval=1,
+        image_size=(None, None),
+        transform_name=None,
+        dummy_text_feature=False,
+        uint8_output=False,
+        blocklist_path=None,
+        batch_transform=False,
+        shuffle_buffer_size=1000,
+        max_pending_samples=2000,
+    ):
+        super().__init__(
+            data_path,
+            num_frames,
+            frame_interval,
+            image_size,
+            transform_name=transform_name,
+            dummy_text_feature=dummy_text_feature,
+            uint8_output=uint8_output,
+            blocklist_path=blocklist_path,
+            batch_transform=batch_transform,
+        )
+        self.shard_dir = os.path.dirname(os.path.abspath(data_path))
+        self.shuffle_buffer_size = shuffle_buffer_size
+        self.max_pending_samples = max_pending_samples
+        self.sampler = None
+
+    def open_file(self, sample):
+        return io.BytesIO(sample["bytes"])
+
+    def __iter__(self):
+        assert self.sampler is not None, "ShardedVideoTextDataset should be built with prepare_dataloader"
+        worker_info = torch.utils.data.get_worker_info()
+        batches, stream = self.sampler.get_worker_plan(0 if worker_info is None else worker_info.id)
+        batches = collections.deque(batches)
+
+        # samples are read in the order of the shards, and kept until their micro-batch is complete
+        loaded = {}
+        # the loaded samples holding their bytes, from the oldest to the most recent
+        buffered = collections.OrderedDict()
+        files = {}
         try:
-            return self.getitem(index)
-        except:
+            for index in stream:
+                sample = dict(self.get_sample(index))
+                self._read_bytes(sample, files)
+                loaded[index] = sample
+                buffered[index] = None
+                if len(buffered) > self.max_pending_samples:
+                    oldest, _ = buffered.popitem(last=False)
+                    del loaded[oldest]["bytes"]
+
+                while batches and all(i in loaded for i in batches[0][1]):
+                    bucket_id, indices = batches.popleft()
+                    num_frames, height, width = self.sampler.bucket.get_thw(bucket_id)
+                    samples = []
+                    for i in indices:
+                        sample = loaded.pop(i)
+                        buffered.pop(i, None)
+                        if "bytes" not in sample:
+                            # dropped while waiting, see max_pending_samples
+                            self._read_bytes(sample, files)
+                        samples.append(self._load_sample_or_none(i, sample, num_frames, height, width))
+                    yield self.transform_batch(samples)
+        finally:
+            for f in files.values():
+                f.close()
+
+    def _read_bytes(self, sample, files):
+        shard = sample["shard"]
+        if shard not in files:
+            files[shard] = open(os.path.join(self.shard_dir, shard), "rb")
+        files[shard].seek(int(sample["offset"]))
+        sample["bytes"] = files[shard].read(int(sample["size"]))
+
+    def _load_sample_or_none(self, index, sample, num_frames, height, width):
+        try:
+            return self.load_sample(sample, num_frames, height, width)
+        except Exception as e:
+            self.record_bad_sample(index, e)
             return None
 
+    def __len__(self):
+        return len(self.sampler)
+
+
+def _load_bin(path):
+    if path.endswith(".gz"):
+        with gzip.open(path, "rb") as f:
+            return torch.load(f)
+    return torch.load(path)
+
 
 @DATASETS.register_module()
 class BatchFeatureDataset(torch.utils.data.Dataset):
@@ -207,9 +528,10 @@ class BatchFeatureDataset(torch.utils.data.Dataset):
     """
 
     def __init__(self, data_path=None):
-        self.path_list = sorted(glob(data_path + "/**/*.bin"))
+        # .bin.gz files are written by FeatureSaver with compress=True
+        self.path_list = sorted(glob(data_path + "/**/*.bin") + glob(data_path + "/**/*.bin.gz"))
 
-        self._len_buffer = len(torch.load(self.path_list[0]))
+        self._len_buffer = len(_load_bin(self.path_list[0]))
         self._num_buffers = len(self.path_list)
         self.num_samples = self.len_buffer * len(self.path_list)
 
@@ -228,7 +550,7 @@ class BatchFeatureDataset(torch.utils.data.Dataset):
         file_idx = idx // self.len_buffer
         if file_idx != self.cur_file_idx:
             self.cur_file_idx = file_idx
-            self.cur_buffer = torch.load(self.path_list[file_idx])
+            self.cur_buffer = _load_bin(self.path_list[file_idx])
 
     def __len__(self):
         return self.num_samples
@@ -248,3 +570,36 @@ class BatchFeatureDataset(torch.utils.data.Dataset):
             "num_frames": batch["num_frames"],
         }
         return ret
+
+
+@DATASETS.register_module()
+class LatentFeatureDataset(torch.utils.data.Dataset):
+    """
+    Per-sample features written by `LatentCacheWriter` in `scripts/misc/extract_feat.py`.
+    Unlike BatchFeatureDataset, each sample is read on its own from a memory-mapped shard,
+    so samples can be shuffled across shards. Batches are built by `LatentBatchSampler`.
+    """
+
+    def __init__(self, data_path=None):
+        self.cache = LatentCache(data_path)
+
+    def get_groups(self):
+        return self.cache.get_groups()
+
+    def __len__(self):
+        return len(self.cache)
+
+    def __getitem__(self, idx):
+        sample = self.cache[idx]
+
+        ret = {
+            "video": sample["x"],
+            "text": sample["y"] if "y" in sample else sample["text"],
+            "fps": sample["fps"],
+            "height": sample["height"],
+            "width": sample["width"],
+            "num_frames": sample["num_frames"],
+        }
+        if "mask" in sample:
+            ret["mask"] = sample["mask"]
+        return ret
@@ -0,0 +1,165 @@
+import json
+import mmap
+import os
+from glob import glob
+
+import numpy as np
+import torch
+
+from opensora.utils.misc import get_logger
+
+DATA_SUFFIX = ".latent"
+INDEX_SUFFIX = ".latent.json"
+
+
+def _dtype_from_str(name: str) -> torch.dtype:
+    # e.g. "torch.bfloat16", numpy has no bfloat16 so tensors are stored as raw bytes
+    return getattr(torch, name.split(".")[-1])
+
+
+class LatentCacheWriter:
+    """Write extracted features as per-sample records, a drop-in replacement of `FeatureSaver`.
+
+    Every `bin_size` batches, a shard `{bin:08}.latent` is written with the raw bytes of the tensors of each
+    sample, together with an index `{bin:08}.latent.json` of their offsets, shapes and dtypes. Per-sample scalars
+    (e.g. fps) and strings (e.g. text) are stored in the index.
+    """
+
+    def __init__(self, save_dir, bin_size=10, start_bin=0):
+        self.save_dir = save_dir
+        self.bin_size = bin_size
+        self.bin_cnt = start_bin
+
+        self.data_list = []
+        self.cnt = 0
+
+    def update(self, data):
+        self.data_list.append(data)
+        self.cnt += 1
+
+        if self.cnt % self.bin_size == 0:
+            self.save()
+
+    def save(self):
+        self.write(self.data_list, self.bin_cnt)
+        self.data_list = []
+        self.bin_cnt += 1
+
+    def write(self, data_list, bin_idx):
+        """Write a shard and its index, returns the number of bytes of the shard."""
+        save_path = os.path.join(self.save_dir, f"{bin_idx:08}{DATA_SUFFIX}")
+        samples = []
+        offset = 0
+        with open(save_path, "wb") as f:
+            for batch in data_list:
+                batch_size = len(next(iter(batch.values())))
+                for i in range(batch_size):
+                    sample = {"batch_size": batch_size}
+                    for key, value in batch.items():
+                        value = value[i]
+                        if isinstance(value, torch.Tensor) and value.ndim > 0:
+                            data = value.detach().cpu().contiguous().reshape(-1).view(torch.uint8).numpy()
+                            f.write(data.tobytes())
+                            sample[key] = {"offset": offset, "shape": list(value.shape), "dtype": str(value.dtype)}
+                            offset += data.nbytes
+                        elif isinstance(value, torch.Tensor):
+                            sample[key] = value.item()
+                        else:
+                            sample[key] = value
+                    samples.append(sample)
+        # the index is written last, shards without an index are incomplete
+        with open(os.path.join(self.save_dir, f"{bin_idx:08}{INDEX_SUFFIX}"), "w") as f:
+            json.dump(samples, f)
+        get_logger().info("Saved to %s", save_path)
+        return offset
+
+
+class LatentCache:
+    """Random access to the samples written by `LatentCacheWriter`.
+
+    The indexes of all shards are flattened into numpy arrays, so that forked workers share them without
+    copying Python objects. Shards are memory-mapped lazily, and reading a sample only touches its bytes.
+
+    Args:
+        data_path (str): directory containing the shards, searched recursively.
+    """
+
+    def __init__(self, data_path: str):
+        index_paths = sorted(glob(os.path.join(data_path, "**", f"*{INDEX_SUFFIX}"), recursive=True))
+        assert len(index_paths) > 0, f"No latent cache found in {data_path}"
+        self.shard_paths = [path[: -len(INDEX_SUFFIX)] + DATA_SUFFIX for path in index_paths]
+
+        shard_ids, batch_sizes = [], []
+        tensors, scalars, strings = {}, {}, {}
+        self.layouts = []  # (shape, dtype) of tensors
+        layout_ids = {}
+        for shard_id, index_path in enumerate(index_paths):
+            with open(index_path, "r") as f:
+                samples = json.load(f)
+            for sample in samples:
+                shard_ids.append(shard_id)
+                batch_sizes.append(sample.pop("batch_size"))
+                for key, value in sample.items():
+                    if isinstance(value, dict):
+                        layout = (tuple(value["shape"]), value["dtype"])
+                        if layout not in layout_ids:
+                            layout_ids[layout] = len(self.layouts)
+                            self.layouts.append(layout)
+                        tensors.setdefault(key, []).append((value["offset"], layout_ids[layout]))
+                    elif isinstance(value, str):
+                        strings.setdefault(key, []).append(value)
+                    else:
+                        scalars.setdefault(key, []).append(value)
+
+        self.shard_ids = np.array(shard_ids, dtype=np.int32)
+        self.batch_sizes = np.array(batch_sizes, dtype=np.int64)
+        self.tensor_offsets = {key: np.array([v[0] for v in value], dtype=np.int64) for key, value in tensors.items()}
+        self.tensor_layouts = {key: np.array([v[1] for v in value], dtype=np.int32) for key, value in tensors.items()}
+        self.scalars = {key: np.array(value, dtype=np.float64) for key, value in scalars.items()}
+        self.strings = strings
+        self._mmaps = {}
+
+    def __len__(self) -> int:
+        return len(self.shard_ids)
+
+    def _get_mmap(self, shard_id: int) -> mmap.mmap:
+        # opened lazily, so that each dataloader worker maps the shards itself
+        if shard_id not in self._mmaps:
+            with open(self.shard_paths[shard_id], "rb") as f:
+                self._mmaps[shard_id] = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return self._mmaps[shard_id]
+
+    def get_groups(self):
+        """Group the samples whose tensors have the same shapes, so that they can be batched.
+
+        Returns:
+            group_ids (np.ndarray): group of each sample.
+            batch_sizes (np.ndarray): batch size of each group, the largest one it was extracted with.
+        """
+        layouts = np.stack([self.tensor_layouts[key] for key in sorted(self.tensor_layouts)], axis=1)
+        _, group_ids = np.unique(layouts, axis=0, return_inverse=True)
+        group_ids = group_ids.reshape(-1)
+        batch_sizes = np.zeros(group_ids.max(initial=-1) + 1, dtype=np.int64)
+        np.maximum.at(batch_sizes, group_ids, self.batch_sizes)
+        return group_ids, batch_sizes
+
+    def __getitem__(self, index: int) -> dict:
+        mm = self._get_mmap(self.shard_ids[index])
+        sample = {}
+        for key, offsets in self.tensor_offsets.items():
+            shape, dtype = self.layouts[self.tensor_layouts[key][index]]
+            dtype = _dtype_from_str(dtype)
+            nbytes = int(np.prod(shape, dtype=np.int64)) * torch.empty(0, dtype=dtype).element_size()
+            offset = offsets[index]
+            sample[key] = torch.frombuffer(bytearray(mm[offset : offset + nbytes]), dtype=dtype).reshape(shape)
+        for key, values in self.scalars.items():
+            sample[key] = torch.tensor(values[index])
+        for key, values in self.strings.items():
+            sample[key] = values[index]
+        return sample
+
+    def __getstate__(self):
+        # memory maps cannot be pickled, workers open their own
+        state = self.__dict__.copy()
+        state["_mmaps"] = {}
+        return state
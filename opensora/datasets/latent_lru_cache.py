@@ -0,0 +1,151 @@
+import hashlib
+import json
+import os
+import uuid
+
+import torch
+
+from opensora.utils.misc import get_logger
+
+CACHE_SUFFIX = ".pt"
+
+
+def get_vae_id(vae_cfg) -> str:
+    """Identify the weights of a VAE from its config, so that latents of different VAEs never share a key.
+
+    Checkpoints are too large to be hashed on every launch, local checkpoint files referenced by the config are
+    identified by their path, size and modification time instead.
+    """
+    files = []
+
+    def visit(value):
+        if isinstance(value, dict):
+            for v in value.values():
+                visit(v)
+        elif isinstance(value, (list, tuple)):
+            for v in value:
+                visit(v)
+        elif isinstance(value, str) and os.path.isfile(value):
+            stat = os.stat(value)
+            files.append((os.path.abspath(value), stat.st_size, int(stat.st_mtime)))
+
+    visit(vae_cfg)
+    content = json.dumps([vae_cfg, files], sort_keys=True, default=str)
+    return hashlib.sha1(content.encode("utf-8")).hexdigest()
+
+
+class LatentLRUCache:
+    """Content-addressed cache of VAE latents on local disk, bounded in size with least-recently-used eviction.
+
+    A latent is keyed by the video path, the start of its temporal crop, the target T/H/W and the VAE id.
+    Crop starts are quantized to multiples of `crop_start_quantum` frames by the dataset, so that the same
+    clip is drawn again in later epochs. Dataloader workers look latents up before decoding, the training loop
+    inserts the latents it encodes. Hits refresh the modification time of the file, which is used as the LRU order.
+
+    Several processes may share the directory: entries are written to a temporary file and renamed, and each
+    process evicts on its own estimate of the directory size, so the bound is only approximate.
+
+    Args:
+        cache_dir (str): directory of the cache, preferably on a local NVMe disk.
+        vae_id (str): id of the VAE weights, see `get_vae_id`.
+        max_size_gb (float): size above which the least recently used entries are evicted.
+        crop_start_quantum (int): granularity of the start frame of temporal crops.
+    """
+
+    def __init__(self, cache_dir: str, vae_id: str, max_size_gb: float = 100, crop_start_quantum: int = 8):
+        self.cache_dir = cache_dir
+        self.vae_id = vae_id
+        self.max_bytes = int(max_size_gb * 1024**3)
+        self.crop_start_quantum = crop_start_quantum
+        os.makedirs(cache_dir, exist_ok=True)
+
+        # updated by the process that inserts, i.e. the training loop
+        self.size = None
+        self.num_hits = 0
+        self.num_misses = 0
+        self.encode_time = 0.0
+
+    def get_key(self, path: str, start_frame: int, num_frames: int, height: int, width: int, *extra) -> str:
+        content = json.dumps([os.path.abspath(path), start_frame, num_frames, height, width, *extra, self.vae_id])
+        return hashlib.sha1(content.encode("utf-8")).hexdigest()
+
+    def _get_path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, key[:2], key + CACHE_SUFFIX)
+
+    def get(self, key: str):
+        """Return the cached entry `{"latent": ..., "fps": ...}`, or None on a miss."""
+        path = self._get_path(key)
+        try:
+            entry = torch.load(path, map_location="cpu")
+            os.utime(path)
+        except (FileNotFoundError, EOFError, RuntimeError):
+            # missing, being evicted, or truncated by an interrupted write of another process
+            return None
+        return entry
+
+    def insert(self, keys, latents: torch.Tensor, fps) -> None:
+        """Insert the latents of a batch encoded by the training loop, samples with an empty key are skipped."""
+        latents = latents.cpu()
+        for key, latent, video_fps in zip(keys, latents, fps):
+            if not key:
+                continue
+            path = self._get_path(key)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+            # clone, otherwise the storage of the whole batch is saved
+            torch.save({"latent": latent.clone(), "fps": float(video_fps)}, tmp_path)
+            if self.size is not None:
+                self.size += os.path.getsize(tmp_path)
+            os.replace(tmp_path, path)
+
+        if self.size is None or self.size > self.max_bytes:
+            self.evict()
+
+    def evict(self) -> None:
+        """Remove the least recently used entries until the cache is below 90% of its maximum size."""
+        entries = []
+        for root, _, files in os.walk(self.cache_dir):
+            for name in files:
+                if not name.endswith(CACHE_SUFFIX):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+
+        self.size = sum(entry[1] for entry in entries)
+        if self.size <= self.max_bytes:
+            return
+        entries.sort()
+        target = int(self.max_bytes * 0.9)
+        num_removed = 0
+        for _, size, path in entries:
+            if self.size <= target:
+                break
+            try:
+                os.remove(path)
+                num_removed += 1
+            except FileNotFoundError:
+                pass
+            self.size -= size
+        get_logger().info("Evicted %s entries from the latent cache %s", num_removed, self.cache_dir)
+
+    def update_stats(self, num_hits: int, num_misses: int, encode_time: float = 0.0) -> None:
+        self.num_hits += num_hits
+        self.num_misses += num_misses
+        self.encode_time += encode_time
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.num_hits + self.num_misses
+        return self.num_hits / total if total > 0 else 0.0
+
+    def get_info(self) -> str:
+        info = f"hits: {self.num_hits}, misses: {self.num_misses}, hit rate: {self.hit_rate:.2%}"
+        if self.encode_time > 0 and self.num_misses > 0:
+            # VAE encoding costs about the same for all samples of a bucket
+            saved = self.encode_time / self.num_misses * self.num_hits
+            info += f", encode time: {self.encode_time:.1f} s, saved: ~{saved:.1f} s"
+        return info
@@ -0,0 +1,116 @@
+import argparse
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+from .utils import read_file
+
+META_FILE = "meta.json"
+
+
+class StringColumn:
+    """A read-only column of strings stored as utf-8 bytes and the offsets of each string."""
+
+    def __init__(self, offsets: np.ndarray, blob: np.ndarray):
+        self.offsets = offsets
+        self.blob = blob
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def __getitem__(self, index: int) -> str:
+        return self.blob[self.offsets[index] : self.offsets[index + 1]].tobytes().decode("utf-8")
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+
+class MetadataStore:
+    """Read-only columnar metadata memory-mapped from a directory built by `build_metadata`.
+
+    Unlike a pandas DataFrame, rows are never materialized as Python objects, so forked dataloader workers
+    only share the page cache of the mapped files instead of slowly copying the whole table.
+
+    Numeric columns are `{name}.npy` arrays. String columns are the utf-8 bytes of all values in `{name}.bytes`
+    and their int64 offsets in `{name}.offsets.npy`.
+
+    Args:
+        path (str): directory of the metadata store.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(os.path.join(path, META_FILE), "r") as f:
+            meta = json.load(f)
+        self.num_rows = meta["num_rows"]
+        self._columns = {}
+        for name, kind in meta["columns"].items():
+            if kind == "numeric":
+                self._columns[name] = np.load(os.path.join(path, f"{name}.npy"), mmap_mode="r")
+            else:
+                offsets = np.load(os.path.join(path, f"{name}.offsets.npy"), mmap_mode="r")
+                blob_path = os.path.join(path, f"{name}.bytes")
+                # np.memmap cannot map empty files
+                if os.path.getsize(blob_path) > 0:
+                    blob = np.memmap(blob_path, dtype=np.uint8, mode="r")
+                else:
+                    blob = np.zeros(0, dtype=np.uint8)
+                self._columns[name] = StringColumn(offsets, blob)
+
+    @property
+    def columns(self) -> list:
+        return list(self._columns)
+
+    def __len__(self) -> int:
+        return self.num_rows
+
+    def __getitem__(self, name: str):
+        return self._columns[name]
+
+    def get_row(self, index: int) -> dict:
+        return {name: column[index] for name, column in self._columns.items()}
+
+
+def is_metadata_store(path) -> bool:
+    return isinstance(path, str) and os.path.isfile(os.path.join(path, META_FILE))
+
+
+def build_metadata(input_path: str, output_path: str) -> None:
+    """Convert a `.csv` or `.parquet` dataset file into a `MetadataStore` directory.
+
+    Numeric and boolean columns keep their dtype (NaN is kept for missing values). All other columns are
+    stored as strings, with missing values stored as empty strings.
+    """
+    data = read_file(input_path)
+    os.makedirs(output_path, exist_ok=True)
+
+    columns = {}
+    for name in data.columns:
+        column = data[name]
+        if pd.api.types.is_numeric_dtype(column) or pd.api.types.is_bool_dtype(column):
+            np.save(os.path.join(output_path, f"{name}.npy"), column.to_numpy())
+            columns[name] = "numeric"
+        else:
+            encoded = [b"" if pd.isna(value) else str(value).encode("utf-8") for value in column]
+            offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+            np.cumsum([len(value) for value in encoded], out=offsets[1:])
+            np.save(os.path.join(output_path, f"{name}.offsets.npy"), offsets)
+            with open(os.path.join(output_path, f"{name}.bytes"), "wb") as f:
+                f.write(b"".join(encoded))
+            columns[name] = "string"
+
+    # write the meta file last, so that an interrupted build is not mistaken for a complete store
+    with open(os.path.join(output_path, META_FILE), "w") as f:
+        json.dump({"num_rows": len(data), "columns": columns}, f, indent=4)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build a memory-mapped metadata store from a csv/parquet file")
+    parser.add_argument("input", type=str, help="path to the .csv or .parquet file")
+    parser.add_argument("output", type=str, help="output directory of the metadata store")
+    args = parser.parse_args()
+    build_metadata(args.input, args.output)
+    print(f"Saved metadata store of {args.input} to {args.output}")
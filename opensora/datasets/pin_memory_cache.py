@@ -1,27 +1,95 @@
 import threading
-from typing import Dict, List, Optional
+from collections import OrderedDict, defaultdict
+from typing import Dict, List, Optional, Tuple
 
 import torch
 
 
+def get_size_class(numel: int) -> int:
+    """Round numel up to its size class.
+
+    Size classes are spaced by a quarter of a power of two (e.g. 512, 640, 768, 896, 1024, 1280, ...),
+    so at most 25% of a cached tensor is wasted.
+    """
+    if numel <= 4:
+        return max(numel, 1)
+    step = 1 << (numel.bit_length() - 3)
+    return (numel + step - 1) // step * step
+
+
 class PinMemoryCache:
     force_dtype: Optional[torch.dtype] = None
     min_cache_numel: int = 0
     pre_alloc_numels: List[int] = []
+    # soft limit of the pinned memory, idle cache tensors are evicted in LRU order to stay below it
+    max_cache_bytes: Optional[int] = None
+    # idle cache tensors up to this many times larger than a request are reused rather than pinning more memory
+    max_reuse_ratio: float = 2.0
 
     def __init__(self):
         self.cache: Dict[int, torch.Tensor] = {}
+        self.cache_to_key: Dict[int, Tuple[torch.dtype, int]] = {}
         self.output_to_cache: Dict[int, int] = {}
         self.cache_to_output: Dict[int, int] = {}
+        # (dtype, size class) -> idle cache ids, the most recently released one is reused first
+        self.free_lists: Dict[Tuple[torch.dtype, int], Dict[int, None]] = defaultdict(dict)
+        # all idle cache ids, from least to most recently released
+        self.idle: OrderedDict = OrderedDict()
         self.lock = threading.Lock()
+        self.total_bytes = 0
         self.total_cnt = 0
         self.hit_cnt = 0
+        self.evict_cnt = 0
 
         if len(self.pre_alloc_numels) > 0 and self.force_dtype is not None:
             for n in self.pre_alloc_numels:
-                cache_tensor = torch.empty(n, dtype=self.force_dtype, device="cpu", pin_memory=True)
+                key = (self.force_dtype, get_size_class(max(n, self.min_cache_numel)))
+                cache_tensor = torch.empty(key[1], dtype=self.force_dtype, device="cpu", pin_memory=True)
                 with self.lock:
-                    self.cache[id(cache_tensor)] = cache_tensor
+                    self._add(cache_tensor, key)
+                    self._release(id(cache_tensor))
+
+    def _add(self, cache_tensor: torch.Tensor, key: Tuple[torch.dtype, int]) -> None:
+        cache_id = id(cache_tensor)
+        self.cache[cache_id] = cache_tensor
+        self.cache_to_key[cache_id] = key
+        self.total_bytes += cache_tensor.numel() * cache_tensor.element_size()
+
+    def _release(self, cache_id: int) -> None:
+        self.free_lists[self.cache_to_key[cache_id]][cache_id] = None
+        self.idle[cache_id] = None
+
+    def _acquire(self, cache_id: int) -> None:
+        del self.free_lists[self.cache_to_key[cache_id]][cache_id]
+        del self.idle[cache_id]
+
+    def _evict(self, nbytes: int) -> None:
+        # drop idle cache tensors until nbytes more can be allocated under the limit
+        while self.total_bytes + nbytes > self.max_cache_bytes and len(self.idle) > 0:
+            cache_id, _ = self.idle.popitem(last=False)
+            del self.free_lists[self.cache_to_key[cache_id]][cache_id]
+            cache_tensor = self.cache.pop(cache_id)
+            del self.cache_to_key[cache_id]
+            self.total_bytes -= cache_tensor.numel() * cache_tensor.element_size()
+            self.evict_cnt += 1
+
+    def _find_larger(self, key: Tuple[torch.dtype, int]) -> Optional[int]:
+        # idle cache tensor of the next size classes, at most max_reuse_ratio times larger (4 classes for 2x)
+        dtype, size_class = key
+        larger = get_size_class(size_class + 1)
+        while larger <= size_class * self.max_reuse_ratio:
+            free_list = self.free_lists.get((dtype, larger))
+            if free_list:
+                return next(reversed(free_list))
+            larger = get_size_class(larger + 1)
+        return None
+
+    def _bind(self, cache_id: int, tensor: torch.Tensor) -> torch.Tensor:
+        target_cache_tensor = self.cache[cache_id][: tensor.numel()].view(tensor.shape)
+        out_id = id(target_cache_tensor)
+        self.output_to_cache[out_id] = cache_id
+        self.cache_to_output[cache_id] = out_id
+        return target_cache_tensor
 
     def get(self, tensor: torch.Tensor) -> torch.Tensor:
         """Receive a cpu tensor and return the corresponding pinned tensor. Note that this only manage memory allocation, doesn't copy content.
@@ -32,28 +100,35 @@ class PinMemoryCache:
         Returns:
             torch.Tensor: The pinned tensor.
         """
-        self.total_cnt += 1
+        dtype = self.force_dtype if self.force_dtype is not None else tensor.dtype
+        key = (dtype, get_size_class(max(tensor.numel(), self.min_cache_numel)))
+        nbytes = key[1] * torch.empty(0, dtype=dtype).element_size()
         with self.lock:
-            # find free cache
-            for cache_id, cache_tensor in self.cache.items():
-                if cache_id not in self.cache_to_output and cache_tensor.numel() >= tensor.numel():
-                    target_cache_tensor = cache_tensor[: tensor.numel()].view(tensor.shape)
-                    out_id = id(target_cache_tensor)
-                    self.output_to_cache[out_id] = cache_id
-                    self.cache_to_output[cache_id] = out_id
-                    self.hit_cnt += 1
-                    return target_cache_tensor
+            self.total_cnt += 1
+            # find free cache of the same size class
+            free_list = self.free_lists[key]
+            if len(free_list) > 0:
+                cache_id = next(reversed(free_list))
+                self._acquire(cache_id)
+                self.hit_cnt += 1
+                return self._bind(cache_id, tensor)
+
+            # reuse a slightly larger one rather than pinning more memory, e.g. a pre-allocated one
+            cache_id = self._find_larger(key)
+            if cache_id is not None:
+                self._acquire(cache_id)
+                self.hit_cnt += 1
+                return self._bind(cache_id, tensor)
+
+            if self.max_cache_bytes is not None:
+                self._evict(nbytes)
+
         # no free cache, create a new one
-        dtype = self.force_dtype if self.force_dtype is not None else tensor.dtype
-        cache_numel = max(tensor.numel(), self.min_cache_numel)
-        cache_tensor = torch.empty(cache_numel, dtype=dtype, device="cpu", pin_memory=True)
-        target_cache_tensor = cache_tensor[: tensor.numel()].view(tensor.shape)
-        out_id = id(target_cache_tensor)
+        # NOTE: pinning memory is slow, so it is done outside of the lock
+        cache_tensor = torch.empty(key[1], dtype=dtype, device="cpu", pin_memory=True)
         with self.lock:
-            self.cache[id(cache_tensor)] = cache_tensor
-            self.output_to_cache[out_id] = id(cache_tensor)
-            self.cache_to_output[id(cache_tensor)] = out_id
-        return target_cache_tensor
+            self._add(cache_tensor, key)
+            return self._bind(id(cache_tensor), tensor)
 
     def remove(self, output_tensor: torch.Tensor) -> None:
         """Release corresponding cache tensor.
@@ -67,10 +142,13 @@ class PinMemoryCache:
                 raise ValueError("Tensor not found in cache.")
             cache_id = self.output_to_cache.pop(out_id)
             del self.cache_to_output[cache_id]
+            self._release(cache_id)
 
     def __str__(self):
         with self.lock:
             num_cached = len(self.cache)
             num_used = len(self.output_to_cache)
-            total_cache_size = sum([v.numel() * v.element_size() for v in self.cache.values()])
-        return f"PinMemoryCache(num_cached={num_cached}, num_used={num_used}, total_cache_size={total_cache_size / 1024**3:.2f} GB, hit rate={self.hit_cnt / self.total_cnt:.2f})"
+            total_cache_size = self.total_bytes
+            hit_rate = self.hit_cnt / max(self.total_cnt, 1)
+            evict_cnt = self.evict_cnt
+        return f"PinMemoryCache(num_cached={num_cached}, num_used={num_used}, total_cache_size={total_cache_size / 1024**3:.2f} GB, hit rate={hit_rate:.2f}, evicted={evict_cnt})"
@@ -2,6 +2,7 @@ import gc
 import math
 import os
 import re
+import threading
 import warnings
 from fractions import Fraction
 from typing import Any, Dict, List, Optional, Tuple, Union
@@ -15,6 +16,117 @@ from torchvision.io.video import _check_av_available
 
 MAX_NUM_FRAMES = 2500
 
+# per thread, see disable_forced_gc
+_gc_state = threading.local()
+
+
+def disable_forced_gc() -> None:
+    """Skip the gc.collect() after each video read in the calling thread, e.g. in decode threads of the training
+    process, where a full collection of the trainer's objects for every video stalls the training loop. The
+    containers are still closed explicitly, the rest is left to the automatic garbage collection.
+    """
+    _gc_state.disabled = True
+
+
+def _collect_garbage() -> None:
+    # NOTE: manually garbage collect to close pyav threads
+    if not getattr(_gc_state, "disabled", False):
+        gc.collect()
+
+
+def get_fill_size(height: int, width: int, target_size: Tuple[int, int]) -> Tuple[int, int]:
+    """
+    Returns the smallest size with the same aspect ratio as (height, width) that covers target_size,
+    which is the size `resize_crop_to_fill` resizes to before cropping. Frames are never upscaled.
+    """
+    th, tw = target_size
+    rh, rw = th / height, tw / width
+    if max(rh, rw) >= 1:
+        return height, width
+    if rh > rw:
+        return th, round(width * rh)
+    return round(height * rw), tw
+
+
+def frame_to_ndarray(frame: "av.frame.Frame", target_size: Optional[Tuple[int, int]] = None) -> np.ndarray:
+    """
+    Converts a decoded frame to an RGB array. If target_size is given, swscale downscales the frame
+    in the same call as the pixel format conversion, so the full-resolution RGB frame is never materialized.
+    """
+    if target_size is None:
+        return frame.to_rgb().to_ndarray()
+    height, width = get_fill_size(frame.height, frame.width, target_size)
+    return frame.reformat(width=width, height=height, format="rgb24").to_ndarray()
+
+
+def _encode_runs(values: np.ndarray) -> str:
+    # first value, then runs of equal deltas as "delta*count"
+    if len(values) == 0:
+        return ""
+    runs = [str(int(values[0]))]
+    deltas = np.diff(values)
+    start = 0
+    while start < len(deltas):
+        end = start + 1
+        while end < len(deltas) and deltas[end] == deltas[start]:
+            end += 1
+        runs.append(f"{int(deltas[start])}*{end - start}")
+        start = end
+    return ";".join(runs)
+
+
+def _decode_runs(text: str) -> np.ndarray:
+    if text == "":
+        return np.zeros(0, dtype=np.int64)
+    runs = text.split(";")
+    deltas = [np.zeros(1, dtype=np.int64)]
+    for run in runs[1:]:
+        delta, count = run.split("*")
+        deltas.append(np.full(int(count), int(delta), dtype=np.int64))
+    return int(runs[0]) + np.cumsum(np.concatenate(deltas))
+
+
+def encode_frame_index(frame_pts: np.ndarray, keyframes: np.ndarray) -> str:
+    """Serialize a frame index into a compact string which can be stored in a csv/parquet column.
+
+    Deltas are run-length encoded, so a constant frame rate video with a fixed GOP takes a few bytes.
+    """
+    return f"{_encode_runs(frame_pts)}|{_encode_runs(keyframes)}"
+
+
+def decode_frame_index(frame_index: str) -> Tuple[np.ndarray, np.ndarray]:
+    """Inverse of `encode_frame_index`, returns the sorted frame pts and the sorted indices of the keyframes."""
+    frame_pts, keyframes = frame_index.split("|")
+    return _decode_runs(frame_pts), _decode_runs(keyframes)
+
+
+def build_frame_index(filename: str) -> str:
+    """
+    Build the frame index of the first video stream of a file: the pts of every frame in presentation order,
+    and the indices of the keyframes among them. Packets are only demuxed, not decoded.
+
+    With the index, `read_video_av_frames` seeks exactly to the keyframe of the GOP that contains a frame,
+    instead of estimating the timestamp of the frame from the average frame rate.
+
+    Returns:
+        str: the index serialized by `encode_frame_index`.
+    """
+    container = av.open(filename, metadata_errors="ignore")
+    try:
+        packets = [
+            (packet.pts, packet.is_keyframe)
+            for packet in container.demux(video=0)
+            # the last packet of a stream only flushes the decoder
+            if packet.pts is not None and packet.size > 0
+        ]
+    finally:
+        container.close()
+        del container
+    packets.sort(key=lambda x: x[0])
+    frame_pts = np.array([pts for pts, _ in packets], dtype=np.int64)
+    keyframes = np.array([i for i, (_, is_keyframe) in enumerate(packets) if is_keyframe], dtype=np.int64)
+    return encode_frame_index(frame_pts, keyframes)
+
 
 def read_video_av(
     filename: str,
@@ -22,6 +134,7 @@ def read_video_av(
     end_pts: Optional[Union[float, Fraction]] = None,
     pts_unit: str = "pts",
     output_format: str = "THWC",
+    target_size: Optional[Tuple[int, int]] = None,
 ) -> Tuple[torch.Tensor, torch.Tensor, Dict[str, Any]]:
     """
     Reads a video from a file, returning both the video frames and the audio frames
@@ -34,7 +147,7 @@ def read_video_av(
     4. try our best to avoid memory leak
 
     Args:
-        filename (str): path to the video file
+        filename (str or file-like): path to the video file, or a seekable binary file object
         start_pts (int if pts_unit = 'pts', float / Fraction if pts_unit = 'sec', optional):
             The start presentation time of the video
         end_pts (int if pts_unit = 'pts', float / Fraction if pts_unit = 'sec', optional):
@@ -42,6 +155,8 @@ def read_video_av(
         pts_unit (str, optional): unit in which start_pts and end_pts values will be interpreted,
             either 'pts' or 'sec'. Defaults to 'pts'.
         output_format (str, optional): The format of the output video tensors. Can be either "THWC" (default) or "TCHW".
+        target_size (Tuple[int, int], optional): (height, width) the frames will be resized and cropped to later.
+            If given, frames are downscaled while decoding to the smallest size covering it.
 
     Returns:
         vframes (Tensor[T, H, W, C] or Tensor[T, C, H, W]): the `T` video frames
@@ -53,7 +168,7 @@ def read_video_av(
     if output_format not in ("THWC", "TCHW"):
         raise ValueError(f"output_format should be either 'THWC' or 'TCHW', got {output_format}.")
     # file existence
-    if not os.path.exists(filename):
+    if isinstance(filename, str) and not os.path.exists(filename):
         raise RuntimeError(f"File not found: {filename}")
     # backend check
     assert get_video_backend() == "pyav", "pyav backend is required for read_video_av"
@@ -74,7 +189,7 @@ def read_video_av(
     if video_fps is not None:
         info["video_fps"] = float(video_fps)
     iter_video = container.decode(**{"video": 0})
-    frame = next(iter_video).to_rgb().to_ndarray()
+    frame = frame_to_ndarray(next(iter_video), target_size)
     height, width = frame.shape[:2]
     total_frames = container.streams.video[0].frames
     if total_frames == 0:
@@ -91,6 +206,8 @@ def read_video_av(
     # == read ==
     try:
         # TODO: The reading has memory leak (4G for 8 workers 1 GPU)
+        if not isinstance(filename, str):
+            filename.seek(0)
         container = av.open(filename, metadata_errors="ignore")
         assert container.streams.video is not None
         video_frames = _read_from_stream(
@@ -102,11 +219,13 @@ def read_video_av(
             container.streams.video[0],
             {"video": 0},
             filename=filename,
+            target_size=target_size,
         )
     except av.AVError as e:
         print(f"[Warning] Error while reading video {filename}: {e}")
 
-    vframes = torch.from_numpy(video_frames).clone()
+    # the frames are already a copy of the decoding buffer
+    vframes = torch.from_numpy(video_frames)
     del video_frames
     if output_format == "TCHW":
         # [T,H,W,C] --> [T,C,H,W]
@@ -125,6 +244,7 @@ def _read_from_stream(
     stream: "av.stream.Stream",
     stream_name: Dict[str, Optional[Union[int, Tuple[int, ...], List[int]]]],
     filename: Optional[str] = None,
+    target_size: Optional[Tuple[int, int]] = None,
 ) -> List["av.frame.Frame"]:
     if pts_unit == "sec":
         # TODO: we should change all of this from ground up to simply take
@@ -174,7 +294,7 @@ def _read_from_stream(
     try:
         for _idx, frame in enumerate(container.decode(**stream_name)):
             frames_pts.append(frame.pts)
-            video_frames[cnt] = frame.to_rgb().to_ndarray()
+            video_frames[cnt] = frame_to_ndarray(frame, target_size)
             cnt += 1
             if cnt >= len(video_frames):
                 break
@@ -189,8 +309,7 @@ def _read_from_stream(
     # garbage collection for thread leakage
     container.close()
     del container
-    # NOTE: manually garbage collect to close pyav threads
-    gc.collect()
+    _collect_garbage()
 
     # ensure that the results are sorted wrt the pts
     # NOTE: here we assert frames_pts is sorted
@@ -210,6 +329,142 @@ def _read_from_stream(
     return result
 
 
+def read_video_av_frames(
+    filename: str,
+    frame_indices: List[int],
+    output_format: str = "THWC",
+    target_size: Optional[Tuple[int, int]] = None,
+    frame_index: Optional[str] = None,
+) -> Tuple[torch.Tensor, Dict[str, Any]]:
+    """
+    Reads only the requested frames of a video.
+
+    Unlike `read_video_av`, which decodes the whole file, this seeks to the keyframe before the first
+    requested frame and stops decoding right after the last one. Without `frame_index`, frame indices are mapped
+    to presentation timestamps with the average frame rate of the stream, so frames may be missing for
+    variable frame rate videos or broken metadata; callers should check the number of returned frames.
+    With it, frames are identified by their exact pts, and the decoder seeks to the keyframe of every GOP
+    that contains requested frames, so only these GOPs are decoded.
+
+    Args:
+        filename (str or file-like): path to the video file, or a seekable binary file object
+        frame_indices (List[int]): indices of the frames to read, duplicates are allowed
+        output_format (str, optional): The format of the output video tensors. Can be either "THWC" (default) or "TCHW".
+        target_size (Tuple[int, int], optional): see `read_video_av`
+        frame_index (str, optional): the index of the video built by `build_frame_index`
+
+    Returns:
+        vframes (Tensor[T, H, W, C] or Tensor[T, C, H, W]): the decoded frames in the order of `frame_indices`,
+            where T <= len(frame_indices)
+        info (Dict): metadata for the video. Can contain the field video_fps (float)
+    """
+    # format
+    output_format = output_format.upper()
+    if output_format not in ("THWC", "TCHW"):
+        raise ValueError(f"output_format should be either 'THWC' or 'TCHW', got {output_format}.")
+    # file existence
+    if isinstance(filename, str) and not os.path.exists(filename):
+        raise RuntimeError(f"File not found: {filename}")
+    _check_av_available()
+    if len(frame_indices) == 0:
+        raise ValueError("frame_indices should not be empty")
+
+    # map each frame index to its positions in the output
+    frame_positions = {}
+    for pos, frame_idx in enumerate(frame_indices):
+        frame_positions.setdefault(int(frame_idx), []).append(pos)
+    first_idx, last_idx = min(frame_positions), max(frame_positions)
+    frames = [None] * len(frame_indices)
+
+    info = {}
+    container = av.open(filename, metadata_errors="ignore")
+    try:
+        stream = container.streams.video[0]
+        video_fps = stream.average_rate
+        # guard against potentially corrupted files
+        if video_fps is not None:
+            info["video_fps"] = float(video_fps)
+
+        if frame_index is not None:
+            _read_indexed_frames(container, stream, frame_index, frame_positions, frames, target_size)
+        else:
+            # == seek ==
+            # without a frame rate or time base, fall back to counting frames from the beginning
+            pts_per_frame = None
+            start_pts = stream.start_time or 0
+            if video_fps is not None and video_fps > 0 and stream.time_base is not None:
+                pts_per_frame = 1 / (video_fps * stream.time_base)
+                if first_idx > 0:
+                    seek_pts = start_pts + int(first_idx * pts_per_frame)
+                    # jump to the previous keyframe so that the first frame can be decoded
+                    container.seek(seek_pts, any_frame=False, backward=True, stream=stream)
+
+            # == read ==
+            for cnt, frame in enumerate(container.decode(video=0)):
+                if pts_per_frame is not None and frame.pts is not None:
+                    frame_idx = int(round((frame.pts - start_pts) / pts_per_frame))
+                else:
+                    frame_idx = cnt
+                if frame_idx > last_idx:
+                    break
+                if frame_idx in frame_positions:
+                    arr = frame_to_ndarray(frame, target_size)
+                    for pos in frame_positions.pop(frame_idx):
+                        frames[pos] = arr
+                    if len(frame_positions) == 0:
+                        break
+    except av.AVError as e:
+        print(f"[Warning] Error while reading video {filename}: {e}")
+    finally:
+        # garbage collection for thread leakage
+        container.close()
+        del container
+        _collect_garbage()
+
+    frames = [x for x in frames if x is not None]
+    if len(frames) == 0:
+        vframes = torch.empty((0, 0, 0, 3), dtype=torch.uint8)
+    else:
+        vframes = torch.from_numpy(np.stack(frames))
+    del frames
+    if output_format == "TCHW":
+        # [T,H,W,C] --> [T,C,H,W]
+        vframes = vframes.permute(0, 3, 1, 2)
+    return vframes, info
+
+
+def _read_indexed_frames(container, stream, frame_index, frame_positions, frames, target_size=None) -> None:
+    # decode the GOPs containing the requested frames, frames are identified by their exact pts
+    frame_pts, keyframes = decode_frame_index(frame_index)
+    pts_to_idx = {int(pts): idx for idx, pts in enumerate(frame_pts)}
+    frame_iter = None
+    decoded_idx = -1
+    for target in sorted(idx for idx in frame_positions if idx < len(frame_pts)):
+        if target <= decoded_idx:
+            # passed already, missing from the stream
+            continue
+        pos = np.searchsorted(keyframes, target, side="right") - 1
+        keyframe = int(keyframes[pos]) if pos >= 0 else 0
+        if frame_iter is None or keyframe > decoded_idx + 1:
+            # skip the GOPs in between instead of decoding them
+            container.seek(int(frame_pts[keyframe]), any_frame=False, backward=True, stream=stream)
+            frame_iter = container.decode(stream)
+        for frame in frame_iter:
+            frame_idx = pts_to_idx.get(frame.pts, None)
+            if frame_idx is None:
+                continue
+            decoded_idx = frame_idx
+            if frame_idx in frame_positions:
+                arr = frame_to_ndarray(frame, target_size)
+                for out_pos in frame_positions.pop(frame_idx):
+                    frames[out_pos] = arr
+            if frame_idx >= target:
+                break
+        else:
+            # end of the stream
+            break
+
+
 def read_video_cv2(video_path):
     cap = cv2.VideoCapture(video_path)
 
@@ -247,11 +502,35 @@ def read_video_cv2(video_path):
         return frames, vinfo
 
 
-def read_video(video_path, backend="av"):
+def read_video(video_path, backend="av", frame_indices=None, target_size=None, frame_index=None):
+    """
+    Args:
+        video_path (str): path to the video file
+        backend (str): "av" or "cv2"
+        frame_indices (List[int], optional): if given, only these frames are returned. With the "av" backend,
+            only the frames up to the last index are decoded.
+        target_size (Tuple[int, int], optional): (height, width) of the transformed video. With the "av" backend,
+            frames are downscaled while decoding to the smallest size covering it.
+        frame_index (str, optional): index of the video built by `build_frame_index`. With the "av" backend and
+            `frame_indices`, only the GOPs containing the requested frames are decoded.
+    """
     if backend == "cv2":
         vframes, vinfo = read_video_cv2(video_path)
+        if frame_indices is not None:
+            vframes = vframes[[i for i in frame_indices if i < len(vframes)]]
     elif backend == "av":
-        vframes, _, vinfo = read_video_av(filename=video_path, pts_unit="sec", output_format="TCHW")
+        if frame_indices is not None:
+            vframes, vinfo = read_video_av_frames(
+                filename=video_path,
+                frame_indices=frame_indices,
+                output_format="TCHW",
+                target_size=target_size,
+                frame_index=frame_index,
+            )
+        else:
+            vframes, _, vinfo = read_video_av(
+                filename=video_path, pts_unit="sec", output_format="TCHW", target_size=target_size
+            )
     else:
         raise ValueError
 
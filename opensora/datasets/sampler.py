@@ -1,3 +1,4 @@
+import os
 from collections import OrderedDict, defaultdict
 from pprint import pformat
 from typing import Iterator, List, Optional
@@ -10,22 +11,10 @@ from torch.utils.data import Dataset, DistributedSampler
 from opensora.utils.misc import format_numel_str, get_logger
 
 from .aspect import get_num_pixels
-from .bucket import Bucket
+from .bucket import Bucket, TokenBudget
 from .datasets import VariableVideoTextDataset
 
 
-# use pandarallel to accelerate bucket processing
-# NOTE: pandarallel should only access local variables
-def apply(data, method=None, frame_interval=None, seed=None, num_bucket=None):
-    return method(
-        data["num_frames"],
-        data["height"],
-        data["width"],
-        frame_interval,
-        seed + data["id"] * num_bucket,
-    )
-
-
 class StatefulDistributedSampler(DistributedSampler):
     def __init__(
         self,
@@ -70,69 +59,38 @@ class VariableVideoBatchSampler(DistributedSampler):
         drop_last: bool = False,
         verbose: bool = False,
         num_bucket_build_workers: int = 1,
+        num_retries: int = 2,
+        token_budget: Optional[TokenBudget] = None,
+        balance_ranks: bool = False,
     ) -> None:
         super().__init__(
             dataset=dataset, num_replicas=num_replicas, rank=rank, shuffle=shuffle, seed=seed, drop_last=drop_last
         )
         self.dataset = dataset
-        self.bucket = Bucket(bucket_config)
+        self.bucket = Bucket(bucket_config, token_budget)
         self.verbose = verbose
         self.last_micro_batch_access_index = 0
         self.approximate_num_batch = None
-
-        self._get_num_batch_cached_bucket_sample_dict = None
+        # number of samples of the same bucket the dataset may try in place of a sample failing to load
+        self.num_retries = num_retries
+        # give the ranks of a step micro-batches of similar cost, see balance_access_order
+        self.balance_ranks = balance_ranks
+
+        # bucket assignment of the current (seed, epoch), shared by get_num_batch and __iter__
+        self._cached_bucket_sample_dict = None
+        self._cached_bucket_key = None
+        # padded and shuffled buckets of the current (seed, epoch), see get_plan
+        self._plan = None
+        self._plan_key = None
+        # NOTE: buckets are built with vectorized numpy ops, kept for config compatibility
         self.num_bucket_build_workers = num_bucket_build_workers
 
     def __iter__(self) -> Iterator[List[int]]:
-        if self._get_num_batch_cached_bucket_sample_dict is not None:
-            bucket_sample_dict = self._get_num_batch_cached_bucket_sample_dict
-            self._get_num_batch_cached_bucket_sample_dict = None
-        else:
-            bucket_sample_dict = self.group_by_bucket()
-            if self.verbose:
-                self._print_bucket_info(bucket_sample_dict)
-
-        g = torch.Generator()
-        g.manual_seed(self.seed + self.epoch)
-        bucket_micro_batch_count = OrderedDict()
-        bucket_last_consumed = OrderedDict()
-
-        # process the samples
-        for bucket_id, data_list in bucket_sample_dict.items():
-            # handle droplast
-            bs_per_gpu = self.bucket.get_batch_size(bucket_id)
-            remainder = len(data_list) % bs_per_gpu
-
-            if remainder > 0:
-                if not self.drop_last:
-                    # if there is remainder, we pad to make it divisible
-                    data_list += data_list[: bs_per_gpu - remainder]
-                else:
-                    # we just drop the remainder to make it divisible
-                    data_list = data_list[:-remainder]
-            bucket_sample_dict[bucket_id] = data_list
-
-            # handle shuffle
-            if self.shuffle:
-                data_indices = torch.randperm(len(data_list), generator=g).tolist()
-                data_list = [data_list[i] for i in data_indices]
-                bucket_sample_dict[bucket_id] = data_list
-
-            # compute how many micro-batches each bucket has
-            num_micro_batches = len(data_list) // bs_per_gpu
-            bucket_micro_batch_count[bucket_id] = num_micro_batches
-
-        # compute the bucket access order
-        # each bucket may have more than one batch of data
-        # thus bucket_id may appear more than 1 time
-        bucket_id_access_order = []
-        for bucket_id, num_micro_batch in bucket_micro_batch_count.items():
-            bucket_id_access_order.extend([bucket_id] * num_micro_batch)
-
-        # randomize the access order
-        if self.shuffle:
-            bucket_id_access_order_indices = torch.randperm(len(bucket_id_access_order), generator=g).tolist()
-            bucket_id_access_order = [bucket_id_access_order[i] for i in bucket_id_access_order_indices]
+        plan = self.get_plan()
+        bucket_ids = plan["bucket_ids"]
+        offsets = plan["offsets"]
+        samples = plan["samples"]
+        bucket_id_access_order = plan["access_order"]
 
         # make the number of bucket accesses divisible by dp size
         remainder = len(bucket_id_access_order) % self.num_replicas
@@ -140,7 +98,9 @@ class VariableVideoBatchSampler(DistributedSampler):
             if self.drop_last:
                 bucket_id_access_order = bucket_id_access_order[: len(bucket_id_access_order) - remainder]
             else:
-                bucket_id_access_order += bucket_id_access_order[: self.num_replicas - remainder]
+                bucket_id_access_order = np.concatenate(
+                    [bucket_id_access_order, bucket_id_access_order[: self.num_replicas - remainder]]
+                )
 
         # prepare each batch from its bucket
         # according to the predefined bucket access order
@@ -150,13 +110,11 @@ class VariableVideoBatchSampler(DistributedSampler):
         # re-compute the micro-batch consumption
         # this is useful when resuming from a state dict with a different number of GPUs
         self.last_micro_batch_access_index = start_iter_idx * self.num_replicas
-        for i in range(self.last_micro_batch_access_index):
-            bucket_id = bucket_id_access_order[i]
-            bucket_bs = self.bucket.get_batch_size(bucket_id)
-            if bucket_id in bucket_last_consumed:
-                bucket_last_consumed[bucket_id] += bucket_bs
-            else:
-                bucket_last_consumed[bucket_id] = bucket_bs
+        bucket_last_consumed = (
+            np.bincount(bucket_id_access_order[: self.last_micro_batch_access_index], minlength=len(bucket_ids))
+            * plan["batch_sizes"]
+        )
+        bucket_thw = [self.bucket.get_thw(bucket_id) for bucket_id in bucket_ids]
 
         for i in range(start_iter_idx, num_iters):
             bucket_access_list = bucket_id_access_order[i * self.num_replicas : (i + 1) * self.num_replicas]
@@ -164,25 +122,31 @@ class VariableVideoBatchSampler(DistributedSampler):
 
             # compute the data samples consumed by each access
             bucket_access_boundaries = []
-            for bucket_id in bucket_access_list:
-                bucket_bs = self.bucket.get_batch_size(bucket_id)
-                last_consumed_index = bucket_last_consumed.get(bucket_id, 0)
+            for bucket_idx in bucket_access_list:
+                bucket_bs = plan["batch_sizes"][bucket_idx]
+                last_consumed_index = bucket_last_consumed[bucket_idx]
                 bucket_access_boundaries.append([last_consumed_index, last_consumed_index + bucket_bs])
 
                 # update consumption
-                if bucket_id in bucket_last_consumed:
-                    bucket_last_consumed[bucket_id] += bucket_bs
-                else:
-                    bucket_last_consumed[bucket_id] = bucket_bs
+                bucket_last_consumed[bucket_idx] += bucket_bs
 
             # compute the range of data accessed by each GPU
-            bucket_id = bucket_access_list[self.rank]
+            bucket_idx = bucket_access_list[self.rank]
             boundary = bucket_access_boundaries[self.rank]
-            cur_micro_batch = bucket_sample_dict[bucket_id][boundary[0] : boundary[1]]
-
-            # encode t, h, w into the sample index
-            real_t, real_h, real_w = self.bucket.get_thw(bucket_id)
-            cur_micro_batch = [f"{idx}-{real_t}-{real_h}-{real_w}" for idx in cur_micro_batch]
+            bucket_samples = samples[offsets[bucket_idx] : offsets[bucket_idx + 1]]
+            cur_micro_batch = bucket_samples[boundary[0] : boundary[1]]
+
+            # fallbacks are the samples following the micro-batch in the bucket
+            num_samples = len(cur_micro_batch)
+            fallback_pos = boundary[1] + np.arange(num_samples)[:, None] + np.arange(self.num_retries) * num_samples
+            fallbacks = bucket_samples[fallback_pos % len(bucket_samples)] if num_samples > 0 else []
+
+            # encode t, h, w and the fallbacks into the sample index
+            real_t, real_h, real_w = bucket_thw[bucket_idx]
+            cur_micro_batch = [
+                "-".join(map(str, [idx, real_t, real_h, real_w, *fallback]))
+                for idx, fallback in zip(cur_micro_batch.tolist(), fallbacks)
+            ]
             yield cur_micro_batch
 
         self.reset()
@@ -190,40 +154,209 @@ class VariableVideoBatchSampler(DistributedSampler):
     def __len__(self) -> int:
         return self.get_num_batch() // dist.get_world_size()
 
-    def group_by_bucket(self) -> dict:
-        bucket_sample_dict = OrderedDict()
+    def set_epoch(self, epoch: int) -> None:
+        super().set_epoch(epoch)
+        self.dataset.epoch = epoch
 
-        from pandarallel import pandarallel
+    def get_plan(self) -> dict:
+        """Pad, shuffle and order the buckets of the current epoch.
+
+        Returns:
+            dict: `bucket_ids` (list of bucket ids), `batch_sizes` (batch size per bucket), `offsets` and `samples`
+                (samples of bucket k are `samples[offsets[k] : offsets[k + 1]]`), `access_order` (bucket index of each
+                micro-batch, before being made divisible by dp size) and `approximate_num_batch`.
+        """
+        if self._plan is not None and self._plan_key == (self.seed, self.epoch):
+            return self._plan
+
+        bucket_sample_dict = self.group_by_bucket()
+        g = torch.Generator()
+        g.manual_seed(self.seed + self.epoch)
+
+        # process the samples
+        bucket_ids, batch_sizes, data_lists = [], [], []
+        for bucket_id, data_list in bucket_sample_dict.items():
+            # handle droplast
+            bs_per_gpu = self.bucket.get_batch_size(bucket_id)
+            remainder = len(data_list) % bs_per_gpu
+
+            if remainder > 0:
+                if not self.drop_last:
+                    # if there is remainder, we pad to make it divisible
+                    data_list = np.concatenate([data_list, data_list[: bs_per_gpu - remainder]])
+                else:
+                    # we just drop the remainder to make it divisible
+                    data_list = data_list[:-remainder]
+
+            # handle shuffle
+            if self.shuffle:
+                data_list = data_list[torch.randperm(len(data_list), generator=g).numpy()]
+
+            bucket_ids.append(bucket_id)
+            batch_sizes.append(bs_per_gpu)
+            data_lists.append(data_list)
+
+        # compute the bucket access order
+        # each bucket may have more than one batch of data
+        # thus bucket_id may appear more than 1 time
+        batch_sizes = np.array(batch_sizes, dtype=np.int64)
+        bucket_lens = np.array([len(data_list) for data_list in data_lists], dtype=np.int64)
+        bucket_id_access_order = np.repeat(np.arange(len(bucket_ids)), bucket_lens // batch_sizes)
+
+        # randomize the access order
+        if self.shuffle:
+            bucket_id_access_order = bucket_id_access_order[
+                torch.randperm(len(bucket_id_access_order), generator=g).numpy()
+            ]
+        if self.balance_ranks and self.num_replicas > 1:
+            costs = np.array([self.bucket.get_cost(bucket_id) for bucket_id in bucket_ids], dtype=np.float64)
+            skew_before = self.get_rank_skew(bucket_id_access_order, costs).mean()
+            bucket_id_access_order = self.balance_access_order(bucket_id_access_order, costs, g)
+            if self.verbose and dist.get_rank() == 0:
+                get_logger().info(
+                    "Mean rank skew (max / mean cost of the micro-batches of a step): %.3f, balanced: %.3f",
+                    skew_before,
+                    self.get_rank_skew(bucket_id_access_order, costs).mean(),
+                )
+
+        self._plan = dict(
+            bucket_ids=bucket_ids,
+            batch_sizes=batch_sizes,
+            offsets=np.concatenate([[0], np.cumsum(bucket_lens)]),
+            samples=np.concatenate(data_lists) if data_lists else np.zeros(0, dtype=np.int64),
+            access_order=bucket_id_access_order,
+            approximate_num_batch=self.approximate_num_batch,
+        )
+        self._plan_key = (self.seed, self.epoch)
+        return self._plan
+
+    def balance_access_order(self, access_order: np.ndarray, costs: np.ndarray, g: torch.Generator) -> np.ndarray:
+        """Reorder the micro-batches so that the ranks of each step get buckets of similar cost.
+
+        Micro-batches are sorted by the cost of their bucket and cut into steps of `num_replicas` micro-batches,
+        then the steps are shuffled. Ties keep the shuffled order, so the plan stays random and deterministic.
+        """
+        order = access_order[np.argsort(costs[access_order], kind="stable")]
+        num_steps = len(order) // self.num_replicas
+        steps = order[: num_steps * self.num_replicas].reshape(num_steps, self.num_replicas)
+        if self.shuffle:
+            steps = steps[torch.randperm(num_steps, generator=g).numpy()]
+        # the last incomplete step is padded by __iter__
+        return np.concatenate([steps.reshape(-1), order[num_steps * self.num_replicas :]])
+
+    def get_rank_skew(self, access_order: np.ndarray, costs: np.ndarray) -> np.ndarray:
+        """Max over mean of the costs of the micro-batches of each complete step, 1 means no rank waits."""
+        num_steps = len(access_order) // self.num_replicas
+        step_costs = costs[access_order[: num_steps * self.num_replicas]].reshape(num_steps, self.num_replicas)
+        return step_costs.max(axis=1) / np.maximum(step_costs.mean(axis=1), 1e-12)
+
+    def get_step_skew(self, step: int) -> float:
+        """Estimated rank skew of a step of the current epoch, from the bucket cost model."""
+        plan = self.get_plan()
+        access_order = plan["access_order"][step * self.num_replicas : (step + 1) * self.num_replicas]
+        if len(access_order) < self.num_replicas:
+            return 1.0
+        costs = np.array([self.bucket.get_cost(plan["bucket_ids"][k]) for k in access_order], dtype=np.float64)
+        return float(costs.max() / max(costs.mean(), 1e-12))
+
+    def save_plan(self, path: str) -> None:
+        """Save the plan of the current epoch to the directory `path`, so that a resumed job does not rebuild the
+        buckets. The per-sample and per-batch arrays are saved as .npy files to be memory-mapped by `load_plan`.
+        """
+        plan = self.get_plan()
+        hw_ids, t_ids, ar_ids = zip(*plan["bucket_ids"]) if plan["bucket_ids"] else ((), (), ())
+        index_dtype = np.int32 if len(self.dataset) < 2**31 else np.int64
+        os.makedirs(path, exist_ok=True)
+        np.save(os.path.join(path, "samples.npy"), plan["samples"].astype(index_dtype))
+        np.save(os.path.join(path, "access_order.npy"), plan["access_order"].astype(np.int32))
+        np.savez(
+            os.path.join(path, "meta.npz"),
+            seed=self.seed,
+            epoch=self.epoch,
+            num_samples=len(self.dataset),
+            shuffle=self.shuffle,
+            drop_last=self.drop_last,
+            balance_ranks=self.balance_ranks,
+            approximate_num_batch=plan["approximate_num_batch"],
+            hw_ids=np.array(hw_ids, dtype=str),
+            t_ids=np.array(t_ids, dtype=np.int64),
+            ar_ids=np.array(ar_ids, dtype=str),
+            batch_sizes=plan["batch_sizes"],
+            offsets=plan["offsets"],
+        )
+
+    def load_plan(self, path: str) -> bool:
+        """Load a plan saved by `save_plan`, it is used by `__iter__` and `__len__` if seed and epoch match.
+
+        Returns:
+            bool: whether the plan is compatible with this sampler.
+        """
+        with np.load(os.path.join(path, "meta.npz")) as f:
+            bucket_ids = [(str(h), int(t), str(a)) for h, t, a in zip(f["hw_ids"], f["t_ids"], f["ar_ids"])]
+            batch_sizes = f["batch_sizes"]
+            compatible = (
+                int(f["num_samples"]) == len(self.dataset)
+                and bool(f["shuffle"]) == self.shuffle
+                and bool(f["drop_last"]) == self.drop_last
+                and bool(f["balance_ranks"]) == self.balance_ranks
+                and all(self.bucket.get_batch_size(k) == bs for k, bs in zip(bucket_ids, batch_sizes))
+            )
+            if not compatible:
+                get_logger().warning("Sampler plan %s does not match the dataset or bucket config, ignored.", path)
+                return False
+            self._plan = dict(
+                bucket_ids=bucket_ids,
+                batch_sizes=batch_sizes.astype(np.int64),
+                offsets=f["offsets"],
+                # read lazily, a worker only touches the batches it loads
+                samples=np.load(os.path.join(path, "samples.npy"), mmap_mode="r"),
+                access_order=np.load(os.path.join(path, "access_order.npy"), mmap_mode="r"),
+                approximate_num_batch=int(f["approximate_num_batch"]),
+            )
+            self._plan_key = (int(f["seed"]), int(f["epoch"]))
+        return True
+
+    def group_by_bucket(self) -> dict:
+        cache_key = (self.seed, self.epoch)
+        if self._cached_bucket_key == cache_key:
+            return self._cached_bucket_sample_dict
 
-        pandarallel.initialize(nb_workers=self.num_bucket_build_workers, progress_bar=False)
         get_logger().info("Building buckets...")
-        bucket_ids = self.dataset.data.parallel_apply(
-            apply,
-            axis=1,
-            method=self.bucket.get_bucket_id,
+        codes, bucket_list = self.bucket.get_bucket_ids(
+            self.dataset.get_column("num_frames"),
+            self.dataset.get_column("height"),
+            self.dataset.get_column("width"),
             frame_interval=self.dataset.frame_interval,
-            seed=self.seed + self.epoch,
-            num_bucket=self.bucket.num_bucket,
+            # the id of a sample is its row index
+            seeds=self.seed + self.epoch + np.arange(len(self.dataset)) * self.bucket.num_bucket,
         )
+        if self.dataset.blocklist is not None:
+            codes[self.dataset.blocklist.get(self.epoch)] = -1
 
         # group by bucket
         # each data sample is put into a bucket with a similar image/video size
-        for i in range(len(self.dataset)):
-            bucket_id = bucket_ids[i]
-            if bucket_id is None:
-                continue
-            if bucket_id not in bucket_sample_dict:
-                bucket_sample_dict[bucket_id] = []
-            bucket_sample_dict[bucket_id].append(i)
+        # buckets are ordered by their first sample, as if samples were appended one by one
+        indices = np.flatnonzero(codes >= 0)
+        indices = indices[np.argsort(codes[indices], kind="stable")]
+        unique_codes, starts, counts = np.unique(codes[indices], return_index=True, return_counts=True)
+        bucket_sample_dict = OrderedDict()
+        for k in np.argsort(indices[starts]):
+            start = starts[k]
+            bucket_sample_dict[bucket_list[unique_codes[k]]] = indices[start : start + counts[k]]
+
+        self._cached_bucket_sample_dict = bucket_sample_dict
+        self._cached_bucket_key = cache_key
+        self._print_bucket_info(bucket_sample_dict)
         return bucket_sample_dict
 
     def get_num_batch(self) -> int:
-        bucket_sample_dict = self.group_by_bucket()
-        self._get_num_batch_cached_bucket_sample_dict = bucket_sample_dict
+        # a resumed job knows the number of batches from its saved plan
+        if self._plan is not None and self._plan_key == (self.seed, self.epoch):
+            self.approximate_num_batch = self._plan["approximate_num_batch"]
+            return self.approximate_num_batch
 
         # calculate the number of batches
-        if self.verbose:
-            self._print_bucket_info(bucket_sample_dict)
+        self.group_by_bucket()
         return self.approximate_num_batch
 
     def _print_bucket_info(self, bucket_sample_dict: dict) -> None:
@@ -253,7 +386,7 @@ class VariableVideoBatchSampler(DistributedSampler):
         num_hwt_vid_dict = {k: v for k, v in num_hwt_dict.items() if k[1] > 1}
 
         # log
-        if dist.get_rank() == 0 and self.verbose:
+        if self.verbose and dist.get_rank() == 0:
             get_logger().info("Bucket Info:")
             get_logger().info(
                 "Bucket [#sample, #batch] by aspect ratio:\n%s", pformat(num_aspect_dict, sort_dicts=False)
@@ -282,8 +415,10 @@ class VariableVideoBatchSampler(DistributedSampler):
         # to calculate the correct last_micro_batch_access_index
         return {"seed": self.seed, "epoch": self.epoch, "last_micro_batch_access_index": num_steps * self.num_replicas}
 
-    def load_state_dict(self, state_dict: dict) -> None:
+    def load_state_dict(self, state_dict: dict, plan_path: Optional[str] = None) -> None:
         self.__dict__.update(state_dict)
+        if plan_path is not None and os.path.exists(plan_path):
+            self.load_plan(plan_path)
 
 
 class BatchDistributedSampler(DistributedSampler):
@@ -320,3 +455,296 @@ class BatchDistributedSampler(DistributedSampler):
 
     def load_state_dict(self, state_dict: dict):
         self.start_index = state_dict["start_index"] + 1
+
+
+class ShardedBucketSampler:
+    """
+    Plans the bucket-consistent micro-batches of a `ShardedVideoTextDataset` and keeps its resume state.
+
+    Each epoch, the shards are shuffled and dealt to the dataloader workers of all ranks round-robin. A worker
+    streams its shards sequentially, passes the samples through a shuffle buffer and groups them by bucket,
+    yielding a micro-batch whenever a bucket is full; incomplete buckets are dropped at the end of the epoch.
+    All of this only depends on the shard index, so it is computed without reading any shard, and:
+
+    - every rank yields the same number of micro-batches, by capping the workers with more batches;
+    - on resume, a worker skips the micro-batches already consumed and starts reading at the shard and
+      offset of the first sample it still needs.
+
+    Args:
+        dataset (ShardedVideoTextDataset): the dataset, whose `data` is the shard index.
+        bucket_config (dict): same as `VariableVideoBatchSampler`.
+        num_workers (int): number of dataloader workers of each rank.
+        token_budget (TokenBudget, optional): compute the batch sizes from a token budget, see `Bucket`.
+    """
+
+    def __init__(
+        self,
+        dataset,
+        bucket_config: dict,
+        num_replicas: Optional[int] = None,
+        rank: Optional[int] = None,
+        num_workers: int = 0,
+        shuffle: bool = True,
+        seed: int = 0,
+        verbose: bool = False,
+        token_budget: Optional[TokenBudget] = None,
+    ) -> None:
+        self.dataset = dataset
+        self.bucket = Bucket(bucket_config, token_budget)
+        self.num_replicas = dist.get_world_size() if num_replicas is None else num_replicas
+        self.rank = dist.get_rank() if rank is None else rank
+        self.num_workers = max(num_workers, 1)
+        self.shuffle = shuffle
+        self.seed = seed
+        self.verbose = verbose
+        self.epoch = 0
+        self.start_step = 0
+
+        # position of each sample in the stream of its shard
+        shards = dataset.get_column("shard")
+        self.shard_names, self.shard_codes = np.unique(np.asarray(list(shards)), return_inverse=True)
+        self.stream_order = np.lexsort((dataset.get_column("offset"), self.shard_codes))
+        num_global_workers = self.num_replicas * self.num_workers
+        if len(self.shard_names) < num_global_workers:
+            get_logger().warning(
+                "Only %s shards for %s dataloader workers in total, some workers will be idle",
+                len(self.shard_names),
+                num_global_workers,
+            )
+
+        self._cached_key = None
+        self._cached_codes = None
+        self._cached_quotas = None
+        self._bucket_list = None
+
+    def set_epoch(self, epoch: int) -> None:
+        self.epoch = epoch
+        self.dataset.epoch = epoch
+
+    def _get_assignment(self):
+        """Bucket index of each sample (-1 if dropped) and the number of micro-batches of each worker."""
+        cache_key = (self.seed, self.epoch)
+        if self._cached_key == cache_key:
+            return self._cached_codes, self._cached_quotas
+
+        codes, self._bucket_list = self.bucket.get_bucket_ids(
+            self.dataset.get_column("num_frames"),
+            self.dataset.get_column("height"),
+            self.dataset.get_column("width"),
+            frame_interval=self.dataset.frame_interval,
+            seeds=self.seed + self.epoch + np.arange(len(self.dataset.data)) * self.bucket.num_bucket,
+        )
+        if self.dataset.blocklist is not None:
+            codes[self.dataset.blocklist.get(self.epoch)] = -1
+        # buckets without a batch size have a zero probability and never get samples
+        batch_sizes = np.array([self.bucket.get_batch_size(k) or 1 for k in self._bucket_list], dtype=np.int64)
+
+        # number of full micro-batches of each worker, in the order of (rank, worker)
+        num_global_workers = self.num_replicas * self.num_workers
+        sample_workers = self._get_shard_workers()[self.shard_codes]
+        valid = codes >= 0
+        counts = np.bincount(
+            sample_workers[valid] * len(self._bucket_list) + codes[valid],
+            minlength=num_global_workers * len(self._bucket_list),
+        ).reshape(num_global_workers, len(self._bucket_list))
+        quotas = (counts // batch_sizes).sum(axis=1).reshape(self.num_replicas, self.num_workers)
+
+        # every rank should run the same number of steps, take the excess from the workers with the most batches
+        num_batch = quotas.sum(axis=1).min()
+        for rank_quotas in quotas:
+            for _ in range(rank_quotas.sum() - num_batch):
+                rank_quotas[rank_quotas.argmax()] -= 1
+
+        self._cached_codes, self._cached_quotas = codes, quotas
+        self._cached_key = cache_key
+        if self.verbose and dist.get_rank() == 0:
+            get_logger().info(
+                "#training batch per rank: %s, #shards: %s, #workers per rank: %s",
+                format_numel_str(int(num_batch)),
+                len(self.shard_names),
+                self.num_workers,
+            )
+        return codes, quotas
+
+    def _get_shard_workers(self) -> np.ndarray:
+        # global worker (rank * num_workers + worker_id) reading each shard
+        order = np.arange(len(self.shard_names))
+        if self.shuffle:
+            g = torch.Generator()
+            g.manual_seed(self.seed + self.epoch)
+            order = torch.randperm(len(order), generator=g).numpy()
+        shard_workers = np.empty(len(order), dtype=np.int64)
+        shard_workers[order] = np.arange(len(order)) % (self.num_replicas * self.num_workers)
+        return shard_workers
+
+    def __len__(self) -> int:
+        _, quotas = self._get_assignment()
+        return int(quotas[self.rank].sum())
+
+    def _get_consumed(self):
+        """Number of micro-batches consumed from each worker, and the worker the dataloader would read next."""
+        # the dataloader takes micro-batches from its workers round-robin, skipping exhausted workers
+        quotas = self._get_assignment()[1][self.rank]
+        consumed = np.zeros_like(quotas)
+        remaining = self.start_step
+        next_worker = 0
+        for round_idx in range(int(quotas.max(initial=0))):
+            active = np.flatnonzero(quotas > round_idx)
+            if remaining < len(active):
+                consumed[active[:remaining]] += 1
+                if remaining > 0:
+                    next_worker = (active[remaining - 1] + 1) % self.num_workers
+                break
+            consumed[active] += 1
+            remaining -= len(active)
+        return consumed, next_worker
+
+    def get_worker_plan(self, worker_id: int):
+        """Return the remaining micro-batches of a worker of this rank.
+
+        Returns:
+            batches (list): (bucket_id, sample indices) of each micro-batch, in the order they are yielded.
+            stream (np.ndarray): indices of the samples to read, in the order of the shards and their offsets.
+        """
+        codes, quotas = self._get_assignment()
+        # a resumed dataloader starts its round-robin from worker 0 again, so the workers are rotated
+        # to continue from the worker that would have been read next
+        consumed, next_worker = self._get_consumed()
+        worker_id = (worker_id + next_worker) % self.num_workers
+        global_worker = self.rank * self.num_workers + worker_id
+        quota = quotas[self.rank, worker_id]
+
+        shard_workers = self._get_shard_workers()
+        stream = self.stream_order[shard_workers[self.shard_codes[self.stream_order]] == global_worker]
+
+        # shuffle buffer
+        rng = np.random.default_rng((self.seed, self.epoch, global_worker))
+        buffer_size = self.dataset.shuffle_buffer_size if self.shuffle else 1
+        buffer, pending, batches = [], {}, []
+
+        def add_to_bucket(index):
+            code = codes[index]
+            bucket_id = self._bucket_list[code]
+            pending.setdefault(code, []).append(index)
+            if len(pending[code]) == self.bucket.get_batch_size(bucket_id):
+                batches.append((bucket_id, pending.pop(code)))
+
+        for index in stream[codes[stream] >= 0]:
+            if len(buffer) < buffer_size:
+                buffer.append(index)
+                continue
+            pos = rng.integers(len(buffer))
+            add_to_bucket(buffer[pos])
+            buffer[pos] = index
+            if len(batches) >= quota:
+                break
+        while buffer and len(batches) < quota:
+            add_to_bucket(buffer.pop(rng.integers(len(buffer))))
+
+        batches = batches[consumed[worker_id] : quota]
+        needed = np.concatenate([indices for _, indices in batches]) if batches else np.zeros(0, dtype=np.int64)
+        stream = stream[np.isin(stream, needed)]
+        return batches, stream
+
+    def reset(self) -> None:
+        self.start_step = 0
+
+    def state_dict(self, num_steps: int) -> dict:
+        # num_workers and num_replicas decide which shards each worker reads, they are needed to resume exactly
+        return {
+            "seed": self.seed,
+            "epoch": self.epoch,
+            "start_step": num_steps,
+            "num_replicas": self.num_replicas,
+            "num_workers": self.num_workers,
+        }
+
+    def load_state_dict(self, state_dict: dict) -> None:
+        state_dict = state_dict.copy()
+        num_replicas, num_workers = state_dict.pop("num_replicas"), state_dict.pop("num_workers")
+        if (num_replicas, num_workers) != (self.num_replicas, self.num_workers):
+            get_logger().warning(
+                "Resuming with %s ranks x %s workers instead of %s x %s, the current epoch is restarted",
+                self.num_replicas,
+                self.num_workers,
+                num_replicas,
+                num_workers,
+            )
+            state_dict["start_step"] = 0
+        self.__dict__.update(state_dict)
+
+
+class LatentBatchSampler(DistributedSampler):
+    """
+    Used with LatentFeatureDataset.
+    Samples with the same feature shapes are shuffled across all shards and grouped into batches of the size
+    they were extracted with. The batches are then shuffled and dealt to the ranks like VariableVideoBatchSampler.
+    """
+
+    def __init__(
+        self,
+        dataset: Dataset,
+        num_replicas: Optional[int] = None,
+        rank: Optional[int] = None,
+        shuffle: bool = True,
+        seed: int = 0,
+        drop_last: bool = False,
+    ) -> None:
+        super().__init__(
+            dataset=dataset, num_replicas=num_replicas, rank=rank, shuffle=shuffle, seed=seed, drop_last=drop_last
+        )
+        self.last_micro_batch_access_index = 0
+
+    def get_batches(self) -> List[np.ndarray]:
+        group_ids, batch_sizes = self.dataset.get_groups()
+        g = torch.Generator()
+        g.manual_seed(self.seed + self.epoch)
+
+        batches = []
+        order = np.argsort(group_ids, kind="stable")
+        bounds = np.searchsorted(group_ids[order], np.arange(len(batch_sizes) + 1))
+        for group_id, bs in enumerate(batch_sizes):
+            indices = order[bounds[group_id] : bounds[group_id + 1]]
+            if self.shuffle:
+                indices = indices[torch.randperm(len(indices), generator=g).numpy()]
+            remainder = len(indices) % bs
+            if remainder > 0:
+                if self.drop_last:
+                    indices = indices[:-remainder]
+                else:
+                    indices = np.concatenate([indices, indices[: bs - remainder]])
+            if len(indices) > 0:
+                batches.extend(np.split(indices, len(indices) // bs))
+
+        if self.shuffle:
+            batches = [batches[i] for i in torch.randperm(len(batches), generator=g).tolist()]
+
+        # make the number of batches divisible by dp size
+        remainder = len(batches) % self.num_replicas
+        if remainder > 0:
+            if self.drop_last:
+                batches = batches[: len(batches) - remainder]
+            else:
+                batches += batches[: self.num_replicas - remainder]
+        return batches
+
+    def __iter__(self) -> Iterator[List[int]]:
+        batches = self.get_batches()
+        start_iter_idx = self.last_micro_batch_access_index // self.num_replicas
+        self.last_micro_batch_access_index = start_iter_idx * self.num_replicas
+        for i in range(start_iter_idx, len(batches) // self.num_replicas):
+            self.last_micro_batch_access_index += self.num_replicas
+            yield batches[i * self.num_replicas + self.rank].tolist()
+        self.reset()
+
+    def __len__(self) -> int:
+        return len(self.get_batches()) // self.num_replicas
+
+    def reset(self) -> None:
+        self.last_micro_batch_access_index = 0
+
+    def state_dict(self, num_steps: int) -> dict:
+        return {"seed": self.seed, "epoch": self.epoch, "last_micro_batch_access_index": num_steps * self.num_replicas}
+
+    def load_state_dict(self, state_dict: dict) -> None:
+        self.__dict__.update(state_dict)
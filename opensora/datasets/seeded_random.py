@@ -0,0 +1,123 @@
+"""
+Vectorized version of `np.random.default_rng(seed).random()` over an array of seeds.
+
+Seeding a new generator per sample makes bucket assignment a pure function of (seed, sample, bucket),
+i.e. a counter-based RNG, but calling `np.random.default_rng` millions of times is slow. This module
+reimplements numpy's `SeedSequence` hashing and the `PCG64` generator with numpy array arithmetic,
+so that the values are bit-exact with `default_rng` (tested in tests/test_bucket.py).
+"""
+
+import numpy as np
+
+# SeedSequence constants, see numpy/random/bit_generator.pyx
+_INIT_A = 0x43B0D7E5
+_MULT_A = 0x931E8875
+_INIT_B = 0x8B51F9DD
+_MULT_B = 0x58F38DED
+_MIX_MULT_L = 0xCA01F9DD
+_MIX_MULT_R = 0x4973F715
+_XSHIFT = 16
+_POOL_SIZE = 4
+_MASK32 = 0xFFFFFFFF
+
+# PCG64 (XSL-RR 128/64) multiplier, see numpy/random/src/pcg64/pcg64.h
+_PCG_MULT_HIGH = np.uint64(2549297995355413924)
+_PCG_MULT_LOW = np.uint64(4865540595714422341)
+
+
+def _hashmix(value, hash_const):
+    value = value ^ np.uint32(hash_const)
+    hash_const = (hash_const * _MULT_A) & _MASK32
+    value = value * np.uint32(hash_const)
+    value ^= value >> np.uint32(_XSHIFT)
+    return value, hash_const
+
+
+def _mix(x, y):
+    result = np.uint32(_MIX_MULT_L) * x - np.uint32(_MIX_MULT_R) * y
+    result ^= result >> np.uint32(_XSHIFT)
+    return result
+
+
+def _seed_sequence_state(seeds):
+    """SeedSequence(seed).generate_state(4, np.uint64) for seeds in [0, 2**64)."""
+    words = [(seeds & np.uint64(_MASK32)).astype(np.uint32), (seeds >> np.uint64(32)).astype(np.uint32)]
+    # seeds below 2**32 have a single entropy word, which is equivalent to a zero high word here
+    with np.errstate(over="ignore"):
+        hash_const = _INIT_A
+        pool = []
+        for i in range(_POOL_SIZE):
+            value = words[i] if i < len(words) else np.zeros_like(words[0])
+            value, hash_const = _hashmix(value, hash_const)
+            pool.append(value)
+        for i_src in range(_POOL_SIZE):
+            for i_dst in range(_POOL_SIZE):
+                if i_src != i_dst:
+                    value, hash_const = _hashmix(pool[i_src], hash_const)
+                    pool[i_dst] = _mix(pool[i_dst], value)
+
+        hash_const = _INIT_B
+        state = []
+        for i_dst in range(2 * 4):
+            value = pool[i_dst % _POOL_SIZE] ^ np.uint32(hash_const)
+            hash_const = (hash_const * _MULT_B) & _MASK32
+            value = value * np.uint32(hash_const)
+            value ^= value >> np.uint32(_XSHIFT)
+            state.append(value.astype(np.uint64))
+    return [state[2 * i] | (state[2 * i + 1] << np.uint64(32)) for i in range(4)]
+
+
+def _mulhi64(a, b):
+    a0, a1 = a & np.uint64(_MASK32), a >> np.uint64(32)
+    b0, b1 = b & np.uint64(_MASK32), b >> np.uint64(32)
+    p00, p01, p10, p11 = a0 * b0, a0 * b1, a1 * b0, a1 * b1
+    mid = (p00 >> np.uint64(32)) + (p01 & np.uint64(_MASK32)) + (p10 & np.uint64(_MASK32))
+    return p11 + (p01 >> np.uint64(32)) + (p10 >> np.uint64(32)) + (mid >> np.uint64(32))
+
+
+def _add128(a_high, a_low, b_high, b_low):
+    low = a_low + b_low
+    high = a_high + b_high + (low < a_low).astype(np.uint64)
+    return high, low
+
+
+def _step(state_high, state_low, inc_high, inc_low):
+    # state = state * MULT + inc (mod 2**128)
+    low = state_low * _PCG_MULT_LOW
+    high = _mulhi64(state_low, _PCG_MULT_LOW) + state_low * _PCG_MULT_HIGH + state_high * _PCG_MULT_LOW
+    return _add128(high, low, inc_high, inc_low)
+
+
+def _output(state_high, state_low):
+    # XSL-RR output function
+    value = state_high ^ state_low
+    rot = state_high >> np.uint64(58)
+    return (value >> rot) | (value << ((np.uint64(64) - rot) & np.uint64(63)))
+
+
+def default_rng_random(seeds, num_draws=1):
+    """Return `[np.random.default_rng(s).random() for _ in range(num_draws)]` for every seed.
+
+    Args:
+        seeds (np.ndarray): non-negative integer seeds.
+        num_draws (int): number of consecutive values drawn from each generator.
+
+    Returns:
+        np.ndarray: float64 array of shape (num_draws, len(seeds)).
+    """
+    seeds = np.asarray(seeds)
+    assert seeds.ndim == 1 and (seeds.size == 0 or seeds.min() >= 0), "seeds should be a 1D non-negative array"
+    seeds = seeds.astype(np.uint64)
+    out = np.empty((num_draws, len(seeds)), dtype=np.float64)
+    with np.errstate(over="ignore"):
+        seed_high, seed_low, inc_high, inc_low = _seed_sequence_state(seeds)
+        # pcg64_srandom_r: inc = (initseq << 1) | 1, state = step(0) + initstate, state = step(state)
+        inc_high = (inc_high << np.uint64(1)) | (inc_low >> np.uint64(63))
+        inc_low = (inc_low << np.uint64(1)) | np.uint64(1)
+        state_high, state_low = _add128(inc_high, inc_low, seed_high, seed_low)
+        state_high, state_low = _step(state_high, state_low, inc_high, inc_low)
+        for i in range(num_draws):
+            state_high, state_low = _step(state_high, state_low, inc_high, inc_low)
+            value = _output(state_high, state_low)
+            out[i] = (value >> np.uint64(11)).astype(np.float64) * (1.0 / 9007199254740992.0)
+    return out
@@ -0,0 +1,102 @@
+from typing import Callable, NamedTuple, Optional, Tuple
+
+import torch
+import torch.multiprocessing as multiprocessing
+
+
+class SharedMemorySlot(NamedTuple):
+    """Placeholder sent through the worker result queue instead of the tensor stored in a shared memory slab."""
+
+    slot_id: int
+    shape: Tuple[int, ...]
+    dtype: torch.dtype
+
+
+class SharedMemoryPool:
+    """A fixed pool of shared memory slabs created before the dataloader workers start.
+
+    Workers write collated batches directly into a free slab and only send a `SharedMemorySlot` through the
+    result queue. This avoids allocating a new shared memory segment for every batch and pickling its handle.
+    The consumer (the pin memory thread) copies the batch out of the slab and releases it.
+
+    Args:
+        num_slots (int): number of slabs, i.e. the max number of batches in flight between workers and the pin thread.
+        slot_nbytes (int): size of each slab in bytes, should fit the largest batch.
+        multiprocessing_context: the multiprocessing context used by the dataloader.
+    """
+
+    def __init__(self, num_slots: int, slot_nbytes: int, multiprocessing_context=None):
+        assert num_slots > 0 and slot_nbytes > 0
+        if multiprocessing_context is None:
+            multiprocessing_context = multiprocessing
+        self.slot_nbytes = slot_nbytes
+        self.slabs = [torch.empty(slot_nbytes, dtype=torch.uint8).share_memory_() for _ in range(num_slots)]
+        self.free_slots = multiprocessing_context.Queue()
+        for slot_id in range(num_slots):
+            self.free_slots.put(slot_id)
+
+    def __len__(self) -> int:
+        return len(self.slabs)
+
+    def fits(self, shape: Tuple[int, ...], dtype: torch.dtype) -> bool:
+        numel = 1
+        for s in shape:
+            numel *= s
+        return numel * torch.empty(0, dtype=dtype).element_size() <= self.slot_nbytes
+
+    def acquire(self) -> int:
+        """Block until a slab is free and return its id."""
+        return self.free_slots.get()
+
+    def release(self, slot_id: int) -> None:
+        self.free_slots.put(slot_id)
+
+    def view(self, slot: SharedMemorySlot) -> torch.Tensor:
+        """Return the tensor stored in the slab, without copy."""
+        numel = 1
+        for s in slot.shape:
+            numel *= s
+        nbytes = numel * torch.empty(0, dtype=slot.dtype).element_size()
+        return self.slabs[slot.slot_id][:nbytes].view(slot.dtype).view(slot.shape)
+
+
+class SharedMemoryCollate:
+    """Wraps a collate function so that `key` is stacked directly into a slab of the pool (runs in workers).
+
+    Batches that do not fit into a slab fall back to the normal collation.
+    """
+
+    def __init__(self, collate_fn: Callable, pool: SharedMemoryPool, key: str = "video"):
+        self.collate_fn = collate_fn
+        self.pool = pool
+        self.key = key
+
+    def __call__(self, batch):
+        batch = [x for x in batch if x is not None]
+        if len(batch) == 0 or not all(isinstance(x, dict) and self.key in x for x in batch):
+            return self.collate_fn(batch)
+        values = [x.pop(self.key) for x in batch]
+        data = self.collate_fn(batch)
+
+        shape = (len(values), *values[0].shape)
+        dtype = values[0].dtype
+        if not self.pool.fits(shape, dtype):
+            data[self.key] = torch.stack(values)
+            return data
+
+        slot = SharedMemorySlot(self.pool.acquire(), shape, dtype)
+        try:
+            torch.stack(values, out=self.pool.view(slot))
+        except Exception:
+            self.pool.release(slot.slot_id)
+            raise
+        data[self.key] = slot
+        return data
+
+
+def get_slot_tensor(pool: Optional[SharedMemoryPool], value):
+    """Resolve a value received from the workers, returns (tensor, slot or None)."""
+    if isinstance(value, SharedMemorySlot):
+        assert pool is not None, "Received a shared memory slot without a pool"
+        return pool.view(value), value
+    return value, None
@@ -1,6 +1,7 @@
 import os
 import re
 
+import cv2
 import numpy as np
 import pandas as pd
 import requests
@@ -62,14 +63,26 @@ def download_url(input_path):
     return output_path
 
 
-def temporal_random_crop(vframes, num_frames, frame_interval):
-    temporal_sample = video_transforms.TemporalRandomCrop(num_frames * frame_interval)
-    total_frames = len(vframes)
+def get_temporal_crop_indices(total_frames, num_frames, frame_interval, start_quantum=1):
+    """Randomly pick the indices of `num_frames` frames out of a video with `total_frames` frames.
+
+    The start of the crop is rounded down to a multiple of `start_quantum`, so that crops can be cached.
+    """
+    size = num_frames * frame_interval
+    temporal_sample = video_transforms.TemporalRandomCrop(size)
     start_frame_ind, end_frame_ind = temporal_sample(total_frames)
+    if start_quantum > 1:
+        start_frame_ind = start_frame_ind // start_quantum * start_quantum
+        end_frame_ind = min(start_frame_ind + size, total_frames)
     assert (
         end_frame_ind - start_frame_ind >= num_frames
     ), f"Not enough frames to sample, {end_frame_ind} - {start_frame_ind} < {num_frames}"
     frame_indice = np.linspace(start_frame_ind, end_frame_ind - 1, num_frames, dtype=int)
+    return frame_indice
+
+
+def temporal_random_crop(vframes, num_frames, frame_interval):
+    frame_indice = get_temporal_crop_indices(len(vframes), num_frames, frame_interval)
     video = vframes[frame_indice]
     return video
 
@@ -100,6 +113,34 @@ def get_transforms_video(name="center", image_size=(256, 256)):
     return transform_video
 
 
+def resize_crop_uint8(video, target_size):
+    """
+    uint8 counterpart of `video_transforms.ResizeCrop`, to be used in dataloader workers when the
+    conversion to float and the normalization happen on device (see `video_transforms.normalize_uint8_video`).
+
+    Args:
+        video (torch.Tensor, dtype=torch.uint8): Size is (T, C, H, W)
+        target_size (tuple(int, int)): (height, width)
+    Returns:
+        torch.Tensor, dtype=torch.uint8: Size is (T, H, W, C)
+    """
+    video = video.permute(0, 2, 3, 1)
+    h, w = video.shape[1:3]
+    th, tw = target_size
+    rh, rw = th / h, tw / w
+    if rh > rw:
+        sh, sw = th, round(w * rh)
+    else:
+        sh, sw = round(h * rw), tw
+    # videos decoded with target_size are already resized, only images and upscaling are left
+    if (sh, sw) != (h, w):
+        interpolation = cv2.INTER_AREA if sh < h else cv2.INTER_LINEAR
+        frames = [cv2.resize(np.ascontiguousarray(x), (sw, sh), interpolation=interpolation) for x in video.numpy()]
+        video = torch.from_numpy(np.stack(frames))
+    i, j = (sh - th) // 2, (sw - tw) // 2
+    return video[:, i : i + th, j : j + tw].contiguous()
+
+
 def get_transforms_image(name="center", image_size=(256, 256)):
     if name is None:
         return None
@@ -180,6 +180,21 @@ def normalize(clip, mean, std, inplace=False):
     return clip
 
 
+def normalize_uint8_video(clip, dtype=torch.float32, mean=0.5, std=0.5):
+    """
+    Batched, on-device counterpart of ToTensorVideo followed by Normalize.
+    Args:
+        clip (torch.tensor, dtype=torch.uint8): Size is (B, T, H, W, C)
+    Returns:
+        clip (torch.tensor, dtype=dtype): Size is (B, C, T, H, W)
+    """
+    if not clip.dtype == torch.uint8:
+        raise TypeError("clip tensor should have data type uint8. Got %s" % str(clip.dtype))
+    clip = clip.permute(0, 4, 1, 2, 3).float()
+    clip = clip.div_(255.0).sub_(mean).div_(std)
+    return clip.to(dtype)
+
+
 def hflip(clip):
     """
     Args:
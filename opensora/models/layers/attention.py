@@ -0,0 +1,244 @@
+"""
+Attention kernels shared by the attention layers of `blocks.py`.
+
+`attention` and `varlen_attention` run flash-attn, xformers, `F.scaled_dot_product_attention` (SDPA, which also
+runs on the CPU) or an explicit math implementation, depending on what is installed, the device, the dtype and
+the sequence length. The backend chosen for each kind of call, device and dtype is logged once.
+"""
+
+import functools
+from typing import List, Optional, Tuple
+
+import torch
+import torch.nn.functional as F
+
+try:
+    import xformers.ops
+except ImportError:
+    xformers = None
+
+try:
+    from flash_attn import flash_attn_func, flash_attn_varlen_func
+except ImportError:
+    flash_attn_func = flash_attn_varlen_func = None
+
+BACKENDS = ("flash", "xformers", "sdpa", "math")
+
+# backend tried first by all calls, see set_attn_backend
+_forced_backend = None
+_logged_choices = set()
+
+
+def set_attn_backend(backend: Optional[str] = None) -> None:
+    """Try `backend` first in all attention layers, e.g. to compare backends. None restores the automatic choice.
+
+    Calls the backend cannot run, e.g. flash-attn on the CPU or with a mask, still fall back to the others.
+    """
+    global _forced_backend
+    assert backend is None or backend in BACKENDS, f"Unknown attention backend: {backend}"
+    _forced_backend = backend
+
+
+def is_available(backend: str, q: torch.Tensor, attn_mask: Optional[torch.Tensor] = None) -> bool:
+    """Whether `backend` can run the attention of the queries `q` of shape [B, N, #heads, #dim]."""
+    if backend == "flash":
+        return (
+            flash_attn_func is not None
+            and q.is_cuda
+            and q.dtype in (torch.float16, torch.bfloat16)
+            and q.shape[-1] <= 256
+            and attn_mask is None
+        )
+    if backend == "xformers":
+        return xformers is not None and q.is_cuda
+    if backend == "sdpa":
+        return hasattr(F, "scaled_dot_product_attention")
+    return backend == "math"
+
+
+def _select_backend(kind: str, q: torch.Tensor, candidates: List[str], attn_mask=None) -> str:
+    if _forced_backend is not None:
+        candidates = [_forced_backend] + candidates
+    backend = next(b for b in candidates + ["math"] if is_available(b, q, attn_mask))
+    key = (kind, backend, q.device.type, q.dtype)
+    if key not in _logged_choices:
+        _logged_choices.add(key)
+        from opensora.utils.misc import get_logger
+
+        get_logger().info("%s attention uses %s for %s %s inputs", kind, backend, q.device.type, q.dtype)
+    return backend
+
+
+def _math_attention(q, k, v, scale, dropout_p, is_causal, attn_mask, upcast):
+    # (B, N, #heads, #dim) -> (B, #heads, N, #dim)
+    q, k, v = q.transpose(1, 2), k.transpose(1, 2), v.transpose(1, 2)
+    dtype = q.dtype
+    q = q * scale
+    attn = q @ k.transpose(-2, -1)
+    if upcast:
+        attn = attn.to(torch.float32)
+    if is_causal:
+        causal_mask = torch.ones(attn.shape[-2:], dtype=torch.bool, device=attn.device).tril()
+        attn_mask = causal_mask if attn_mask is None else attn_mask & causal_mask
+    if attn_mask is not None:
+        attn = attn.masked_fill(~attn_mask, float("-inf"))
+    attn = attn.softmax(dim=-1)
+    attn = attn.to(dtype)  # cast back attn to original dtype
+    if dropout_p > 0:
+        attn = F.dropout(attn, p=dropout_p)
+    x = attn @ v
+    return x.transpose(1, 2)
+
+
+def attention(
+    q: torch.Tensor,
+    k: torch.Tensor,
+    v: torch.Tensor,
+    scale: Optional[float] = None,
+    dropout_p: float = 0.0,
+    is_causal: bool = False,
+    attn_mask: Optional[torch.Tensor] = None,
+    enable_flash_attn: bool = False,
+    enable_xformers: bool = False,
+    upcast: bool = True,
+) -> torch.Tensor:
+    """Multi-head attention of queries [B, N, #heads, #dim] and keys/values [B, M, #heads, #dim].
+
+    Args:
+        scale (float, optional): softmax scale, defaults to 1 / sqrt(#dim).
+        dropout_p (float): attention dropout, pass 0 in evaluation.
+        is_causal (bool): causal attention, for N == M.
+        attn_mask (torch.Tensor, optional): boolean mask broadcastable to [B, #heads, N, M], True to attend.
+        enable_flash_attn (bool): allow flash-attn, which is only used for sequences longer than the batch.
+        enable_xformers (bool): allow xformers.
+        upcast (bool): compute the softmax of the math fallback in float32.
+
+    Returns:
+        torch.Tensor: the output of shape [B, N, #heads, #dim].
+    """
+    if scale is None:
+        scale = q.shape[-1] ** -0.5
+    candidates = []
+    # flash attn is not memory efficient for small sequences, this is empirical
+    if enable_flash_attn and q.shape[1] > q.shape[0]:
+        candidates.append("flash")
+    if enable_xformers:
+        candidates.append("xformers")
+    candidates.append("sdpa")
+    backend = _select_backend("dense", q, candidates, attn_mask)
+
+    if backend == "flash":
+        return flash_attn_func(q, k, v, dropout_p=dropout_p, softmax_scale=scale, causal=is_causal)
+    if backend == "xformers":
+        attn_bias = None
+        if is_causal:
+            attn_bias = xformers.ops.LowerTriangularMask()
+        if attn_mask is not None:
+            if is_causal:
+                attn_mask = attn_mask & torch.ones(q.shape[1], k.shape[1], dtype=torch.bool, device=q.device).tril()
+            shape = (q.shape[0], q.shape[2], q.shape[1], k.shape[1])
+            attn_bias = torch.zeros(shape, dtype=q.dtype, device=q.device)
+            attn_bias.masked_fill_(~attn_mask.expand(shape), float("-inf"))
+        return xformers.ops.memory_efficient_attention(q, k, v, attn_bias=attn_bias, p=dropout_p, scale=scale)
+    if backend == "sdpa":
+        if is_causal and attn_mask is not None:
+            attn_mask = attn_mask & torch.ones(q.shape[1], k.shape[1], dtype=torch.bool, device=q.device).tril()
+            is_causal = False
+        x = F.scaled_dot_product_attention(
+            q.transpose(1, 2),
+            k.transpose(1, 2),
+            v.transpose(1, 2),
+            attn_mask=attn_mask,
+            dropout_p=dropout_p,
+            is_causal=is_causal,
+            scale=scale,
+        )
+        return x.transpose(1, 2)
+    return _math_attention(q, k, v, scale, dropout_p, is_causal, attn_mask, upcast)
+
+
+# the varlen masks are memoized, all the cross-attention layers of a forward share the same sequence lengths
+@functools.lru_cache(maxsize=32)
+def _block_diagonal_mask(q_seqlens: Tuple[int, ...], kv_seqlens: Tuple[int, ...]):
+    return xformers.ops.fmha.BlockDiagonalMask.from_seqlens(list(q_seqlens), list(kv_seqlens))
+
+
+@functools.lru_cache(maxsize=32)
+def _cu_seqlens(seqlens: Tuple[int, ...], device: torch.device) -> torch.Tensor:
+    return F.pad(torch.tensor(seqlens, device=device).cumsum(0), (1, 0)).to(torch.int32)
+
+
+@functools.lru_cache(maxsize=32)
+def _padding_mask(seqlens: Tuple[int, ...], device: torch.device) -> torch.Tensor:
+    return torch.arange(max(seqlens), device=device)[None] < torch.tensor(seqlens, device=device)[:, None]
+
+
+def _pad_sequences(x: torch.Tensor, seqlens: Tuple[int, ...]):
+    # [1, sum(seqlens), ...] -> [len(seqlens), max(seqlens), ...], and the mask of the valid positions
+    max_len = max(seqlens)
+    if all(n == max_len for n in seqlens):
+        return x.reshape(len(seqlens), max_len, *x.shape[2:]), None
+    padded = torch.nn.utils.rnn.pad_sequence(list(x[0].split(seqlens)), batch_first=True)
+    return padded, _padding_mask(seqlens, x.device)
+
+
+def varlen_attention(
+    q: torch.Tensor,
+    k: torch.Tensor,
+    v: torch.Tensor,
+    q_seqlens: List[int],
+    kv_seqlens: List[int],
+    scale: Optional[float] = None,
+    dropout_p: float = 0.0,
+) -> torch.Tensor:
+    """Attention of packed sequences, where the i-th sequence of queries only attends to the i-th sequence of
+    keys/values, e.g. video tokens to the tokens of their own caption.
+
+    Args:
+        q (torch.Tensor): queries of shape [1, sum(q_seqlens), #heads, #dim].
+        k, v (torch.Tensor): keys and values of shape [1, sum(kv_seqlens), #heads, #dim].
+        q_seqlens, kv_seqlens (List[int]): lengths of the sequences.
+
+    Returns:
+        torch.Tensor: the output of shape [1, sum(q_seqlens), #heads, #dim].
+    """
+    if scale is None:
+        scale = q.shape[-1] ** -0.5
+    q_seqlens, kv_seqlens = tuple(q_seqlens), tuple(kv_seqlens)
+    backend = _select_backend("varlen", q, ["xformers", "flash", "sdpa"])
+
+    if backend == "xformers":
+        attn_bias = _block_diagonal_mask(q_seqlens, kv_seqlens)
+        return xformers.ops.memory_efficient_attention(q, k, v, attn_bias=attn_bias, p=dropout_p, scale=scale)
+    if backend == "flash":
+        x = flash_attn_varlen_func(
+            q[0],
+            k[0],
+            v[0],
+            _cu_seqlens(q_seqlens, q.device),
+            _cu_seqlens(kv_seqlens, q.device),
+            max(q_seqlens),
+            max(kv_seqlens),
+            dropout_p=dropout_p,
+            softmax_scale=scale,
+        )
+        return x.unsqueeze(0)
+
+    # pad to a batch of sequences, the keys of the padding are masked out
+    q, q_mask = _pad_sequences(q, q_seqlens)
+    k, kv_mask = _pad_sequences(k, kv_seqlens)
+    v, _ = _pad_sequences(v, kv_seqlens)
+    attn_mask = None if kv_mask is None else kv_mask[:, None, None, :]
+    if backend == "sdpa":
+        x = F.scaled_dot_product_attention(
+            q.transpose(1, 2),
+            k.transpose(1, 2),
+            v.transpose(1, 2),
+            attn_mask=attn_mask,
+            dropout_p=dropout_p,
+            scale=scale,
+        ).transpose(1, 2)
+    else:
+        x = _math_attention(q, k, v, scale, dropout_p, False, attn_mask, True)
+    x = x.reshape(1, -1, *x.shape[2:]) if q_mask is None else x[q_mask].unsqueeze(0)
+    return x
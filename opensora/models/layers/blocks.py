@@ -19,12 +19,12 @@ import torch.distributed as dist
 import torch.nn as nn
 import torch.nn.functional as F
 import torch.utils.checkpoint
-import xformers.ops
 from einops import rearrange
 from timm.models.vision_transformer import Mlp
 
 from opensora.acceleration.communications import all_to_all, split_forward_gather_backward
 from opensora.acceleration.parallel_states import get_sequence_parallel_group
+from opensora.models.layers.attention import attention, varlen_attention
 
 approx_gelu = lambda: nn.GELU(approximate="tanh")
 
@@ -168,8 +168,6 @@ class Attention(nn.Module):
 
     def forward(self, x: torch.Tensor) -> torch.Tensor:
         B, N, C = x.shape
-        # flash attn is not memory efficient for small sequences, this is empirical
-        enable_flash_attn = self.enable_flash_attn and (N > B)
         qkv = self.qkv(x)
         qkv_shape = (B, N, 3, self.num_heads, self.head_dim)
 
@@ -187,38 +185,18 @@ class Attention(nn.Module):
                 q = self.rotary_emb(q)
                 k = self.rotary_emb(k)
 
-        if enable_flash_attn:
-            from flash_attn import flash_attn_func
-
-            # (B, #heads, N, #dim) -> (B, N, #heads, #dim)
-            q = q.permute(0, 2, 1, 3)
-            k = k.permute(0, 2, 1, 3)
-            v = v.permute(0, 2, 1, 3)
-            x = flash_attn_func(
-                q,
-                k,
-                v,
-                dropout_p=self.attn_drop.p if self.training else 0.0,
-                softmax_scale=self.scale,
-                causal=self.is_causal,
-            )
-        else:
-            dtype = q.dtype
-            q = q * self.scale
-            attn = q @ k.transpose(-2, -1)  # translate attn to float32
-            attn = attn.to(torch.float32)
-            if self.is_causal:
-                causal_mask = torch.tril(torch.ones_like(attn), diagonal=0)
-                causal_mask = torch.where(causal_mask.bool(), 0, float('-inf'))
-                attn += causal_mask
-            attn = attn.softmax(dim=-1)
-            attn = attn.to(dtype)  # cast back attn to original dtype
-            attn = self.attn_drop(attn)
-            x = attn @ v
+        # (B, #heads, N, #dim) -> (B, N, #heads, #dim)
+        x = attention(
+            q.transpose(1, 2),
+            k.transpose(1, 2),
+            v.transpose(1, 2),
+            scale=self.scale,
+            dropout_p=self.attn_drop.p if self.training else 0.0,
+            is_causal=self.is_causal,
+            enable_flash_attn=self.enable_flash_attn,
+        )
 
         x_output_shape = (B, N, C)
-        if not enable_flash_attn:
-            x = x.transpose(1, 2)
         x = x.reshape(x_output_shape)
         x = self.proj(x)
         x = self.proj_drop(x)
@@ -297,8 +275,6 @@ class KVCompressAttention(nn.Module):
         B, N, C = x.shape
         new_N = N
         H, W = HW
-        # flash attn is not memory efficient for small sequences, this is empirical
-        enable_flash_attn = self.enable_flash_attn and (N > B)
 
         qkv = self.qkv(x).reshape(B, N, 3, C)
         q, k, v = qkv.unbind(2)
@@ -314,41 +290,20 @@ class KVCompressAttention(nn.Module):
 
         q, k = self.q_norm(q), self.k_norm(k)
 
-        if enable_flash_attn:
-            from flash_attn import flash_attn_func
-
-            x = flash_attn_func(
-                q,
-                k,
-                v,
-                dropout_p=self.attn_drop.p if self.training else 0.0,
-                softmax_scale=self.scale,
-            )
-
-        elif self.mem_eff_attention:
-            attn_bias = None
-            if mask is not None:
-                attn_bias = torch.zeros([B * self.num_heads, q.shape[1], k.shape[1]], dtype=q.dtype, device=q.device)
-                attn_bias.masked_fill_(mask.squeeze(1).repeat(self.num_heads, 1, 1) == 0, float("-inf"))
-            x = xformers.ops.memory_efficient_attention(q, k, v, p=self.attn_drop.p, attn_bias=attn_bias)
-        else:
-            # (B, N, #heads, #dim) -> (B, #heads, N, #dim)
-            q = q.permute(0, 2, 1, 3)
-            k = k.permute(0, 2, 1, 3)
-            v = v.permute(0, 2, 1, 3)
-            dtype = q.dtype
-            q = q * self.scale
-            attn = q @ k.transpose(-2, -1)  # translate attn to float32
-            if not self.attn_half:
-                attn = attn.to(torch.float32)
-            attn = attn.softmax(dim=-1)
-            attn = attn.to(dtype)  # cast back attn to original dtype
-            attn = self.attn_drop(attn)
-            x = attn @ v
+        x = attention(
+            q,
+            k,
+            v,
+            scale=self.scale,
+            dropout_p=self.attn_drop.p if self.training else 0.0,
+            # [B, 1, N, new_N], 0 for the masked out keys
+            attn_mask=None if mask is None else mask != 0,
+            enable_flash_attn=self.enable_flash_attn,
+            enable_xformers=self.mem_eff_attention,
+            upcast=not self.attn_half,
+        )
 
         x_output_shape = (B, N, C)
-        if not enable_flash_attn:
-            x = x.transpose(1, 2)
         x = x.reshape(x_output_shape)
         x = self.proj(x)
         x = self.proj_drop(x)
@@ -392,49 +347,20 @@ class SeqParallelAttention(Attention):
         # [B, SUB_N, 3, NUM_HEAD, HEAD_DIM] -> [B, N, 3, NUM_HEAD_PER_DEVICE, HEAD_DIM]
         qkv = all_to_all(qkv, sp_group, scatter_dim=3, gather_dim=1)
 
-        if self.enable_flash_attn:
-            qkv_permute_shape = (
-                2,
-                0,
-                1,
-                3,
-                4,
-            )  # [3, B, N, NUM_HEAD_PER_DEVICE, HEAD_DIM]
-        else:
-            qkv_permute_shape = (
-                2,
-                0,
-                3,
-                1,
-                4,
-            )  # [3, B, NUM_HEAD_PER_DEVICE, N, HEAD_DIM]
+        qkv_permute_shape = (2, 0, 1, 3, 4)  # [3, B, N, NUM_HEAD_PER_DEVICE, HEAD_DIM]
         qkv = qkv.permute(qkv_permute_shape)
 
         # ERROR: Should qk_norm first
         q, k, v = qkv.unbind(0)
         q, k = self.q_norm(q), self.k_norm(k)
-        if self.enable_flash_attn:
-            from flash_attn import flash_attn_func
-
-            x = flash_attn_func(
-                q,
-                k,
-                v,
-                dropout_p=self.attn_drop.p if self.training else 0.0,
-                softmax_scale=self.scale,
-            )
-        else:
-            dtype = q.dtype
-            q = q * self.scale
-            attn = q @ k.transpose(-2, -1)  # translate attn to float32
-            attn = attn.to(torch.float32)
-            attn = attn.softmax(dim=-1)
-            attn = attn.to(dtype)  # cast back attn to original dtype
-            attn = self.attn_drop(attn)
-            x = attn @ v
-
-        if not self.enable_flash_attn:
-            x = x.transpose(1, 2)
+        x = attention(
+            q,
+            k,
+            v,
+            scale=self.scale,
+            dropout_p=self.attn_drop.p if self.training else 0.0,
+            enable_flash_attn=self.enable_flash_attn,
+        )
 
         # apply all to all to gather back attention heads and split sequence
         # [B, N, NUM_HEAD_PER_DEVICE, HEAD_DIM]  -> [B, SUB_N, NUM_HEAD, HEAD_DIM]
@@ -471,12 +397,13 @@ class MultiHeadCrossAttention(nn.Module):
         kv = self.kv_linear(cond).view(1, -1, 2, self.num_heads, self.head_dim)
         k, v = kv.unbind(2)
 
-        attn_bias = None
-        if mask is not None:
-            attn_bias = xformers.ops.fmha.BlockDiagonalMask.from_seqlens([N] * B, mask)
-        x = xformers.ops.memory_efficient_attention(q, k, v, p=self.attn_drop.p, attn_bias=attn_bias)
+        dropout_p = self.attn_drop.p if self.training else 0.0
+        if mask is None:
+            x = attention(q, k, v, dropout_p=dropout_p, enable_flash_attn=True, enable_xformers=True)
+        else:
+            x = varlen_attention(q, k, v, [N] * B, mask, dropout_p=dropout_p)
 
-        x = x.view(B, -1, C)
+        x = x.reshape(B, -1, C)
         x = self.proj(x)
         x = self.proj_drop(x)
         return x
@@ -519,13 +446,14 @@ class SeqParallelMultiHeadCrossAttention(MultiHeadCrossAttention):
         v = v.view(1, -1, self.num_heads // sp_size, self.head_dim)
 
         # compute attention
-        attn_bias = None
-        if mask is not None:
-            attn_bias = xformers.ops.fmha.BlockDiagonalMask.from_seqlens([N] * B, mask)
-        x = xformers.ops.memory_efficient_attention(q, k, v, p=self.attn_drop.p, attn_bias=attn_bias)
+        dropout_p = self.attn_drop.p if self.training else 0.0
+        if mask is None:
+            x = attention(q, k, v, dropout_p=dropout_p, enable_flash_attn=True, enable_xformers=True)
+        else:
+            x = varlen_attention(q, k, v, [N] * B, mask, dropout_p=dropout_p)
 
         # apply all to all to gather back attention heads and scatter sequence
-        x = x.view(B, -1, self.num_heads // sp_size, self.head_dim)
+        x = x.reshape(B, -1, self.num_heads // sp_size, self.head_dim)
         x = all_to_all(x, sp_group, scatter_dim=1, gather_dim=2)
 
         # apply output projection
@@ -1,4 +1,5 @@
 import os
+from contextlib import contextmanager
 
 import numpy as np
 import torch
@@ -77,15 +78,17 @@ class STDiT3Block(nn.Module):
         self.drop_path = DropPath(drop_path) if drop_path > 0.0 else nn.Identity()
         self.scale_shift_table = nn.Parameter(torch.randn(6, hidden_size) / hidden_size**0.5)
 
-    def t_mask_select(self, x_mask, x, masked_x, T, S):
-        # x: [B, (T, S), C]
-        # mased_x: [B, (T, S), C]
-        # x_mask: [B, T]
-        x = rearrange(x, "B (T S) C -> B T S C", T=T, S=S)
-        masked_x = rearrange(masked_x, "B (T S) C -> B T S C", T=T, S=S)
-        x = torch.where(x_mask[:, :, None, None], x, masked_x)
-        x = rearrange(x, "B T S C -> B (T S) C")
-        return x
+    def get_modulation(self, t, x_mask=None, t0=None):
+        # t, t0: [B, 6 * C]
+        # x_mask: [B, T], frames with a False mask are modulated with t0
+        # returns 6 parameters of shape [B, 1, C], or [B, T, 1, C] per frame with x_mask
+        B = t.shape[0]
+        modulation = self.scale_shift_table[None] + t.reshape(B, 6, -1)
+        if x_mask is None:
+            return modulation.chunk(6, dim=1)
+        modulation_zero = self.scale_shift_table[None] + t0.reshape(B, 6, -1)
+        modulation = torch.where(x_mask[:, None, :, None], modulation[:, :, None], modulation_zero[:, :, None])
+        return modulation[:, :, :, None].unbind(1)
 
     def forward(
         self,
@@ -100,19 +103,12 @@ class STDiT3Block(nn.Module):
     ):
         # prepare modulate parameters
         B, N, C = x.shape
-        shift_msa, scale_msa, gate_msa, shift_mlp, scale_mlp, gate_mlp = (
-            self.scale_shift_table[None] + t.reshape(B, 6, -1)
-        ).chunk(6, dim=1)
-        if x_mask is not None:
-            shift_msa_zero, scale_msa_zero, gate_msa_zero, shift_mlp_zero, scale_mlp_zero, gate_mlp_zero = (
-                self.scale_shift_table[None] + t0.reshape(B, 6, -1)
-            ).chunk(6, dim=1)
+        shift_msa, scale_msa, gate_msa, shift_mlp, scale_mlp, gate_mlp = self.get_modulation(t, x_mask, t0)
+        # with x_mask, the parameters are selected per frame instead of modulating twice and selecting the results
+        frame_shape = (B, T, S, C) if x_mask is not None else (B, N, C)
 
         # modulate (attention)
-        x_m = t2i_modulate(self.norm1(x), shift_msa, scale_msa)
-        if x_mask is not None:
-            x_m_zero = t2i_modulate(self.norm1(x), shift_msa_zero, scale_msa_zero)
-            x_m = self.t_mask_select(x_mask, x_m, x_m_zero, T, S)
+        x_m = t2i_modulate(self.norm1(x).view(frame_shape), shift_msa, scale_msa).view(B, N, C)
 
         # attention
         if self.temporal:
@@ -125,10 +121,7 @@ class STDiT3Block(nn.Module):
             x_m = rearrange(x_m, "(B T) S C -> B (T S) C", T=T, S=S)
 
         # modulate (attention)
-        x_m_s = gate_msa * x_m
-        if x_mask is not None:
-            x_m_s_zero = gate_msa_zero * x_m
-            x_m_s = self.t_mask_select(x_mask, x_m_s, x_m_s_zero, T, S)
+        x_m_s = (gate_msa * x_m.reshape(frame_shape)).view(B, N, C)
 
         # residual
         x = x + self.drop_path(x_m_s)
@@ -137,19 +130,13 @@ class STDiT3Block(nn.Module):
         x = x + self.cross_attn(x, y, mask)
 
         # modulate (MLP)
-        x_m = t2i_modulate(self.norm2(x), shift_mlp, scale_mlp)
-        if x_mask is not None:
-            x_m_zero = t2i_modulate(self.norm2(x), shift_mlp_zero, scale_mlp_zero)
-            x_m = self.t_mask_select(x_mask, x_m, x_m_zero, T, S)
+        x_m = t2i_modulate(self.norm2(x).view(frame_shape), shift_mlp, scale_mlp).view(B, N, C)
 
         # MLP
         x_m = self.mlp(x_m)
 
         # modulate (MLP)
-        x_m_s = gate_mlp * x_m
-        if x_mask is not None:
-            x_m_s_zero = gate_mlp_zero * x_m
-            x_m_s = self.t_mask_select(x_mask, x_m_s, x_m_s_zero, T, S)
+        x_m_s = (gate_mlp * x_m.view(frame_shape)).view(B, N, C)
 
         # residual
         x = x + self.drop_path(x_m_s)
@@ -242,6 +229,9 @@ class STDiT3(PreTrainedModel):
             nn.SiLU(),
             nn.Linear(config.hidden_size, 6 * config.hidden_size, bias=True),
         )
+        # see cache_embeddings
+        self._embedding_cache = None
+        self._batch_repeats = 1
         self.y_embedder = CaptionEmbedder(
             in_channels=config.caption_channels,
             hidden_size=config.hidden_size,
@@ -339,6 +329,46 @@ class STDiT3(PreTrainedModel):
         W = W // self.patch_size[2]
         return (T, H, W)
 
+    @contextmanager
+    def cache_embeddings(self, batch_repeats=1):
+        """Reuse the fps and t0 embeddings across forward calls in inference, e.g. in all the sampling steps of a
+        request, where the fps and the batch size do not change. The cached embeddings do not follow parameter
+        updates.
+
+        Args:
+            batch_repeats (int): the batch is made of this many copies of the same timesteps and fps, e.g. 2 for the
+                halves of classifier-free guidance, their embeddings are computed for the first copy only.
+        """
+        self._embedding_cache = {}
+        self._batch_repeats = batch_repeats
+        try:
+            yield
+        finally:
+            self._embedding_cache = None
+            self._batch_repeats = 1
+
+    def embed_timestep(self, timestep, fps, dtype, cache_key=None):
+        # t = t_embedder(timestep) + fps_embedder(fps) of each sample, and t_block(t)
+        cache = self._embedding_cache
+        if cache is None:
+            t = self.t_embedder(timestep, dtype=dtype) + self.fps_embedder(fps.unsqueeze(1), timestep.shape[0])
+            return t, self.t_block(t)
+
+        # within cache_embeddings, the embeddings of constant timesteps, e.g. t0, are kept under cache_key
+        key = (cache_key, dtype, timestep.shape[0])
+        if cache_key is not None and key in cache:
+            return cache[key]
+        B = timestep.shape[0] // self._batch_repeats
+        fps_key = ("fps", dtype, B)
+        if fps_key not in cache:
+            cache[fps_key] = self.fps_embedder(fps[:B].unsqueeze(1), B)
+        t = self.t_embedder(timestep[:B], dtype=dtype) + cache[fps_key]
+        t_mlp = self.t_block(t)
+        t, t_mlp = t.repeat(self._batch_repeats, 1), t_mlp.repeat(self._batch_repeats, 1)
+        if cache_key is not None:
+            cache[key] = (t, t_mlp)
+        return t, t_mlp
+
     def encode_text(self, y, mask=None):
         y = self.y_embedder(y, self.training)  # [B, 1, N_token, C]
         if mask is not None:
@@ -352,9 +382,42 @@ class STDiT3(PreTrainedModel):
             y = y.squeeze(1).view(1, -1, self.hidden_size)
         return y, y_lens
 
-    def forward(self, x, timestep, y, mask=None, x_mask=None, fps=None, height=None, width=None, **kwargs):
+    def prepare_text(self, y, mask=None):
+        """Embed the text conditioning into the packed tokens y [1, sum(y_lens), C] and their lengths y_lens.
+
+        Its outputs can be passed to forward as y and y_lens, e.g. to embed the text once for all sampling steps.
+        """
+        y = y.to(self.x_embedder.proj.weight.dtype)
+        if self.config.skip_y_embedder:
+            y_lens = mask
+            if isinstance(y_lens, torch.Tensor):
+                y_lens = y_lens.long().tolist()
+        else:
+            y, y_lens = self.encode_text(y, mask)
+        return y, y_lens
+
+    def get_pos_embed_scale(self, height, width):
+        """Scale of the positional embedding for videos of the given resolution, as a float that can be passed to
+        forward as pos_embed_scale, e.g. to read the resolution once for all sampling steps.
+        """
+        resolution_sq = (height[0].item() * width[0].item()) ** 0.5
+        return resolution_sq / self.input_sq_size
+
+    def forward(
+        self,
+        x,
+        timestep,
+        y,
+        mask=None,
+        x_mask=None,
+        fps=None,
+        height=None,
+        width=None,
+        y_lens=None,
+        pos_embed_scale=None,
+        **kwargs,
+    ):
         dtype = self.x_embedder.proj.weight.dtype
-        B = x.size(0)
         x = x.to(dtype)
         timestep = timestep.to(dtype)
         y = y.to(dtype)
@@ -382,29 +445,20 @@ class STDiT3(PreTrainedModel):
 
         S = H * W
         base_size = round(S**0.5)
-        resolution_sq = (height[0].item() * width[0].item()) ** 0.5
-        scale = resolution_sq / self.input_sq_size
-        pos_emb = self.pos_embed(x, H, W, scale=scale, base_size=base_size)
+        if pos_embed_scale is None:
+            pos_embed_scale = self.get_pos_embed_scale(height, width)
+        pos_emb = self.pos_embed(x, H, W, scale=pos_embed_scale, base_size=base_size)
 
         # === get timestep embed ===
-        t = self.t_embedder(timestep, dtype=x.dtype)  # [B, C]
-        fps = self.fps_embedder(fps.unsqueeze(1), B)
-        t = t + fps
-        t_mlp = self.t_block(t)
+        t, t_mlp = self.embed_timestep(timestep, fps, x.dtype)  # [B, C], [B, 6 * C]
         t0 = t0_mlp = None
         if x_mask is not None:
             t0_timestep = torch.zeros_like(timestep)
-            t0 = self.t_embedder(t0_timestep, dtype=x.dtype)
-            t0 = t0 + fps
-            t0_mlp = self.t_block(t0)
+            t0, t0_mlp = self.embed_timestep(t0_timestep, fps, x.dtype, cache_key="t0")
 
         # === get y embed ===
-        if self.config.skip_y_embedder:
-            y_lens = mask
-            if isinstance(y_lens, torch.Tensor):
-                y_lens = y_lens.long().tolist()
-        else:
-            y, y_lens = self.encode_text(y, mask)
+        if y_lens is None:
+            y, y_lens = self.prepare_text(y, mask)
 
         # === get x embed ===
         x = self.x_embedder(x)  # [B, N, C]
@@ -1,3 +1,5 @@
+from contextlib import nullcontext
+
 import torch
 from tqdm import tqdm
 
@@ -54,6 +56,11 @@ class RFLOW:
         model_args["y"] = torch.cat([model_args["y"], y_null], 0)
         if additional_args is not None:
             model_args.update(additional_args)
+        # embed the text and read the resolution once for all steps, without syncing with the host at each step
+        if hasattr(model, "prepare_text"):
+            model_args["y"], model_args["y_lens"] = model.prepare_text(model_args["y"], model_args.pop("mask", None))
+        if hasattr(model, "get_pos_embed_scale"):
+            model_args["pos_embed_scale"] = model.get_pos_embed_scale(model_args["height"], model_args["width"])
 
         # prepare timesteps
         timesteps = [(1.0 - i / self.num_sampling_steps) * self.num_timesteps for i in range(self.num_sampling_steps)]
@@ -66,36 +73,46 @@ class RFLOW:
         if mask is not None:
             noise_added = torch.zeros_like(mask, dtype=torch.bool)
             noise_added = noise_added | (mask == 1)
+            # without conditioned frames, e.g. text-to-video, x_mask is true at all steps and is not passed, so that
+            # the model skips its t0 branches
+            pass_x_mask = not bool(noise_added.all())
 
         progress_wrap = tqdm if progress else (lambda x: x)
-        for i, t in progress_wrap(enumerate(timesteps)):
-            # mask for adding noise
-            if mask is not None:
-                mask_t = mask * self.num_timesteps
-                x0 = z.clone()
-                x_noise = self.scheduler.add_noise(x0, torch.randn_like(x0), t)
-
-                mask_t_upper = mask_t >= t.unsqueeze(1)
-                model_args["x_mask"] = mask_t_upper.repeat(2, 1)
-                mask_add_noise = mask_t_upper & ~noise_added
-
-                z = torch.where(mask_add_noise[:, None, :, None, None], x_noise, x0)
-                noise_added = mask_t_upper
-
-            # classifier-free guidance
-            z_in = torch.cat([z, z], 0)
-            t = torch.cat([t, t], 0)
-            pred = model(z_in, t, **model_args).chunk(2, dim=1)[0]
-            pred_cond, pred_uncond = pred.chunk(2, dim=0)
-            v_pred = pred_uncond + guidance_scale * (pred_cond - pred_uncond)
-
-            # update z
-            dt = timesteps[i] - timesteps[i + 1] if i < len(timesteps) - 1 else timesteps[i]
-            dt = dt / self.num_timesteps
-            z = z + v_pred * dt[:, None, None, None, None]
-
-            if mask is not None:
-                z = torch.where(mask_t_upper[:, None, :, None, None], z, x0)
+        # the t0 and fps embeddings are the same at all steps, and for both halves of the batch
+        if hasattr(model, "cache_embeddings"):
+            cache_embeddings = model.cache_embeddings(batch_repeats=2)
+        else:
+            cache_embeddings = nullcontext()
+        with cache_embeddings:
+            for i, t in progress_wrap(enumerate(timesteps)):
+                # mask for adding noise
+                if mask is not None:
+                    mask_t = mask * self.num_timesteps
+                    x0 = z.clone()
+                    x_noise = self.scheduler.add_noise(x0, torch.randn_like(x0), t)
+
+                    mask_t_upper = mask_t >= t.unsqueeze(1)
+                    if pass_x_mask:
+                        model_args["x_mask"] = mask_t_upper.repeat(2, 1)
+                    mask_add_noise = mask_t_upper & ~noise_added
+
+                    z = torch.where(mask_add_noise[:, None, :, None, None], x_noise, x0)
+                    noise_added = mask_t_upper
+
+                # classifier-free guidance
+                z_in = torch.cat([z, z], 0)
+                t = torch.cat([t, t], 0)
+                pred = model(z_in, t, **model_args).chunk(2, dim=1)[0]
+                pred_cond, pred_uncond = pred.chunk(2, dim=0)
+                v_pred = pred_uncond + guidance_scale * (pred_cond - pred_uncond)
+
+                # update z
+                dt = timesteps[i] - timesteps[i + 1] if i < len(timesteps) - 1 else timesteps[i]
+                dt = dt / self.num_timesteps
+                z = z + v_pred * dt[:, None, None, None, None]
+
+                if mask is not None:
+                    z = torch.where(mask_t_upper[:, None, :, None, None], z, x0)
 
         return z
 
@@ -339,6 +339,8 @@ class CheckpointIO:
             if sampler is not None:
                 # only for VariableVideoBatchSampler
                 torch.save(sampler.state_dict(step), os.path.join(save_dir, "sampler"))
+                if hasattr(sampler, "save_plan"):
+                    sampler.save_plan(os.path.join(save_dir, "sampler_plan"))
         dist.barrier()
         return save_dir
 
@@ -372,7 +374,12 @@ class CheckpointIO:
         if lr_scheduler is not None:
             booster.load_lr_scheduler(lr_scheduler, os.path.join(load_dir, "lr_scheduler"))
         if sampler is not None:
-            sampler.load_state_dict(torch.load(os.path.join(load_dir, "sampler")))
+            if hasattr(sampler, "load_plan"):
+                sampler.load_state_dict(
+                    torch.load(os.path.join(load_dir, "sampler")), plan_path=os.path.join(load_dir, "sampler_plan")
+                )
+            else:
+                sampler.load_state_dict(torch.load(os.path.join(load_dir, "sampler")))
         dist.barrier()
 
         return (
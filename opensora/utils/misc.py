@@ -1,7 +1,10 @@
 import collections
+import gzip
 import importlib
 import logging
 import os
+import queue
+import threading
 import time
 from collections import OrderedDict
 from collections.abc import Sequence
@@ -392,10 +395,12 @@ def get_tensor_memory(tensor, human_readable=True):
 
 
 class FeatureSaver:
-    def __init__(self, save_dir, bin_size=10, start_bin=0):
+    def __init__(self, save_dir, bin_size=10, start_bin=0, compress=False):
         self.save_dir = save_dir
         self.bin_size = bin_size
         self.bin_cnt = start_bin
+        # gzip the bins, read back transparently by BatchFeatureDataset
+        self.compress = compress
 
         self.data_list = []
         self.cnt = 0
@@ -408,8 +413,103 @@ class FeatureSaver:
             self.save()
 
     def save(self):
-        save_path = os.path.join(self.save_dir, f"{self.bin_cnt:08}.bin")
-        torch.save(self.data_list, save_path)
-        get_logger().info("Saved to %s", save_path)
+        self.write(self.data_list, self.bin_cnt)
         self.data_list = []
         self.bin_cnt += 1
+
+    def write(self, data_list, bin_idx):
+        """Write a bin, returns the number of bytes written."""
+        save_path = os.path.join(self.save_dir, f"{bin_idx:08}.bin")
+        if self.compress:
+            save_path += ".gz"
+            with gzip.open(save_path, "wb", compresslevel=1) as f:
+                torch.save(data_list, f)
+        else:
+            torch.save(data_list, save_path)
+        get_logger().info("Saved to %s", save_path)
+        return os.path.getsize(save_path)
+
+
+class AsyncFeatureWriter:
+    """Write the bins of a `FeatureSaver` or `LatentCacheWriter` in a background thread.
+
+    `update` starts non-blocking device-to-host copies of the tensors of a batch into pinned memory and returns
+    immediately. Full bins are handed to the writer thread through a bounded queue, so the GPU keeps encoding the
+    next bin while the previous one is written, and only waits if `max_pending_bins` bins are already queued.
+
+    Args:
+        saver: a `FeatureSaver` or `LatentCacheWriter`, whose `write` is called in the background.
+        max_pending_bins (int): max number of full bins waiting to be written.
+    """
+
+    def __init__(self, saver, max_pending_bins=1):
+        self.saver = saver
+        self.data_list = []
+        self.cnt = 0
+        self.queue = queue.Queue(maxsize=max_pending_bins)
+        self.error = None
+        # written by the writer thread
+        self.bytes_written = 0
+        self.write_time = 0.0
+        self.thread = threading.Thread(target=self._write_loop, daemon=True)
+        self.thread.start()
+
+    def _to_pinned(self, value):
+        if isinstance(value, torch.Tensor) and value.device.type != "cpu":
+            pinned = torch.empty(value.shape, dtype=value.dtype, pin_memory=True)
+            pinned.copy_(value, non_blocking=True)
+            return pinned
+        return value
+
+    def update(self, data):
+        self.data_list.append({k: self._to_pinned(v) for k, v in data.items()})
+        self.cnt += 1
+
+        if self.cnt % self.saver.bin_size == 0:
+            self.save()
+
+    def save(self):
+        self._check_error()
+        event = None
+        if torch.cuda.is_available():
+            event = torch.cuda.Event()
+            event.record()
+        self.queue.put((self.data_list, self.saver.bin_cnt, event))
+        self.data_list = []
+        self.saver.bin_cnt += 1
+
+    def _write_loop(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            data_list, bin_idx, event = item
+            try:
+                # wait for the copies of this bin only, not for the work queued after it
+                if event is not None:
+                    event.synchronize()
+                start = time.time()
+                self.bytes_written += self.saver.write(data_list, bin_idx)
+                self.write_time += time.time() - start
+            except Exception as e:
+                self.error = e
+            finally:
+                self.queue.task_done()
+
+    def _check_error(self):
+        if self.error is not None:
+            raise RuntimeError("Failed to write features") from self.error
+
+    @property
+    def queue_depth(self) -> int:
+        return self.queue.qsize()
+
+    def get_info(self) -> str:
+        throughput = self.bytes_written / self.write_time / 1024**2 if self.write_time > 0 else 0.0
+        return f"queue depth: {self.queue_depth}, write throughput: {throughput:.2f} MB/s"
+
+    def close(self):
+        """Wait until all full bins are written, the features of an incomplete bin are dropped like `FeatureSaver`."""
+        self.queue.put(None)
+        self.thread.join()
+        self._check_error()
@@ -0,0 +1,102 @@
+"""
+Time the attention backends on the spatial and temporal attention shapes of STDiT3 for the buckets of a config.
+
+Spatial attention runs over the H*W latent tokens of each frame (batch B*T), temporal attention over the T latent
+frames of each token (batch B*H*W). Backends that cannot run on this device or dtype are skipped, and those running
+out of memory for a shape are reported as OOM.
+
+Usage:
+    python scripts/misc/benchmark_attention.py configs/opensora-v1-2/train/stage1.py --max-batch-size 8 --backward
+"""
+
+import argparse
+import math
+import time
+
+import torch
+
+from opensora.datasets.aspect import get_image_size
+from opensora.models.layers.attention import BACKENDS, attention, is_available, set_attn_backend
+from opensora.utils.config_utils import read_config
+from opensora.utils.misc import to_torch_dtype
+
+
+def get_latent_size(num_frames, height, width, micro_frame_size=17):
+    # OpenSoraVAE_V1_2: 8x spatial compression, 17 frames are compressed to 5
+    t = num_frames // micro_frame_size * 5 + math.ceil(num_frames % micro_frame_size / 4)
+    return t, math.ceil(height / 8), math.ceil(width / 8)
+
+
+def run(backend, q, backward, warmup, iters):
+    set_attn_backend(backend)
+    q = q.detach().requires_grad_(backward)
+    k, v = q.detach().clone().requires_grad_(backward), q.detach().clone().requires_grad_(backward)
+
+    def step():
+        out = attention(q, k, v, enable_flash_attn=True, enable_xformers=True)
+        if backward:
+            out.backward(torch.ones_like(out))
+
+    for _ in range(warmup):
+        step()
+    if q.is_cuda:
+        torch.cuda.synchronize()
+    start = time.time()
+    for _ in range(iters):
+        step()
+    if q.is_cuda:
+        torch.cuda.synchronize()
+    return (time.time() - start) / iters * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("config", type=str, help="training config with a bucket_config")
+    parser.add_argument("--aspect-ratio", type=str, default="9:16")
+    parser.add_argument("--num-heads", type=int, default=16)
+    parser.add_argument("--head-dim", type=int, default=72)
+    parser.add_argument("--max-batch-size", type=int, default=None, help="clip the batch sizes of the buckets")
+    parser.add_argument("--dtype", type=str, default="bf16")
+    parser.add_argument("--backward", action="store_true", help="time the forward and backward passes")
+    parser.add_argument("--warmup", type=int, default=3)
+    parser.add_argument("--iters", type=int, default=10)
+    args = parser.parse_args()
+
+    cfg = read_config(args.config)
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    dtype = to_torch_dtype(args.dtype)
+
+    for resolution, t_criteria in cfg.bucket_config.items():
+        height, width = get_image_size(resolution, args.aspect_ratio)
+        for num_frames, (prob, batch_size) in t_criteria.items():
+            if batch_size is None or prob == 0:
+                continue
+            if args.max_batch_size is not None:
+                batch_size = min(batch_size, args.max_batch_size)
+            t, h, w = get_latent_size(num_frames, height, width)
+            s = math.ceil(h / 2) * math.ceil(w / 2)
+            shapes = {"spatial": (batch_size * t, s), "temporal": (batch_size * s, t)}
+            for kind, (attn_batch, seq_len) in shapes.items():
+                if kind == "temporal" and t == 1:
+                    continue
+                q = torch.randn(attn_batch, seq_len, args.num_heads, args.head_dim, device=device, dtype=dtype)
+                results = []
+                for backend in BACKENDS:
+                    if not is_available(backend, q):
+                        continue
+                    try:
+                        results.append(f"{backend} {run(backend, q, args.backward, args.warmup, args.iters):.2f} ms")
+                    except torch.cuda.OutOfMemoryError:
+                        results.append(f"{backend} OOM")
+                    finally:
+                        if q.is_cuda:
+                            torch.cuda.empty_cache()
+                print(
+                    f"[{resolution} x {num_frames} bs {batch_size}] {kind} B={attn_batch} N={seq_len}: "
+                    + ", ".join(results)
+                )
+    set_attn_backend(None)
+
+
+if __name__ == "__main__":
+    main()
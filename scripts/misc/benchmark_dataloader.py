@@ -0,0 +1,112 @@
+"""
+Compare the process workers of DataloaderForVideo against decode threads in the training process.
+
+Each (worker type, number of workers) runs in its own process. Reported are the time to the first batch, the
+throughput after it, and the memory of the loading process and its workers: RSS counts the pages shared by forked
+workers once per process, PSS splits them between the processes sharing them (Linux only).
+
+Usage:
+    python scripts/misc/benchmark_dataloader.py /path/to/meta.csv --resolution 240p --num-frames 51 \
+        --batch-size 4 --num-workers 8 16 32
+
+With --num-objects, the loading process holds that many Python objects like a trainer, so that garbage
+collections in its decode threads cost what they would during training.
+"""
+
+import argparse
+import multiprocessing as mp
+import os
+import time
+
+import torch
+
+from opensora.datasets.dataloader import DataloaderForVideo, collate_fn_default
+from opensora.datasets.datasets import VariableVideoTextDataset
+from opensora.datasets.sampler import VariableVideoBatchSampler
+
+
+def get_memory_mb(pids):
+    rss = pss = 0
+    for pid in pids:
+        try:
+            with open(f"/proc/{pid}/smaps_rollup") as f:
+                for line in f:
+                    if line.startswith("Rss:"):
+                        rss += int(line.split()[1])
+                    elif line.startswith("Pss:"):
+                        pss += int(line.split()[1])
+        except FileNotFoundError:
+            continue
+    return rss / 1024, pss / 1024  # KB -> MB
+
+
+def run(worker_type, num_workers, args, result_queue):
+    torch.set_num_threads(1)
+    # stands for the object graph of a trainer, which each full garbage collection walks through
+    objects = [{"id": i, "name": str(i)} for i in range(args.num_objects)]
+    dataset = VariableVideoTextDataset(args.data_path, transform_name="resize_crop")
+    bucket_config = {args.resolution: {args.num_frames: (1.0, args.batch_size)}}
+    batch_sampler = VariableVideoBatchSampler(dataset, bucket_config, num_replicas=1, rank=0, seed=args.seed)
+    pin_memory = torch.cuda.is_available()
+    dataloader = DataloaderForVideo(
+        dataset,
+        batch_sampler=batch_sampler,
+        num_workers=num_workers,
+        pin_memory=pin_memory,
+        collate_fn=collate_fn_default,
+        worker_type=worker_type,
+    )
+
+    num_samples, startup_time = 0, None
+    start = time.time()
+    dataloader_iter = iter(dataloader)
+    for i, batch in enumerate(dataloader_iter):
+        if i == 0:
+            startup_time = time.time() - start
+            start = time.time()
+        else:
+            num_samples += len(batch["video"])
+        if pin_memory:
+            dataloader_iter.remove_cache(batch["video"])
+        if i == args.num_batches:
+            break
+    elapsed = time.time() - start
+    assert num_samples > 0, "Too few batches, check that the samples fit in the bucket of the resolution"
+
+    pids = [os.getpid()] + [w.pid for w in getattr(dataloader_iter, "_workers", [])]
+    rss, pss = get_memory_mb(pids)
+    result_queue.put((worker_type, num_workers, startup_time, num_samples / elapsed, rss, pss))
+    del objects
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("data_path", type=str, help="csv or parquet of a VariableVideoTextDataset")
+    parser.add_argument("--resolution", type=str, default="240p")
+    parser.add_argument("--num-frames", type=int, default=51)
+    parser.add_argument("--batch-size", type=int, default=4)
+    parser.add_argument("--num-batches", type=int, default=50, help="timed batches after the first one")
+    parser.add_argument("--num-workers", type=int, nargs="+", default=[8, 16, 32])
+    parser.add_argument("--worker-types", type=str, nargs="+", default=["process", "thread"])
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument(
+        "--num-objects", type=int, default=0, help="python objects allocated in the loading process, like a trainer"
+    )
+    args = parser.parse_args()
+
+    ctx = mp.get_context("spawn")
+    result_queue = ctx.Queue()
+    for num_workers in args.num_workers:
+        for worker_type in args.worker_types:
+            p = ctx.Process(target=run, args=(worker_type, num_workers, args, result_queue))
+            p.start()
+            worker_type, num_workers, startup_time, samples_per_sec, rss, pss = result_queue.get()
+            p.join()
+            print(
+                f"[{worker_type} x {num_workers}] startup {startup_time:.2f} s, {samples_per_sec:.2f} samples/s, "
+                f"RSS {rss:.0f} MB, PSS {pss:.0f} MB"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,70 @@
+"""
+Compare the per-worker throughput of decoding the whole video then cropping (the old behaviour)
+against seeking and decoding only the sampled frames.
+
+Each mode runs in its own process, which mimics a single dataloader worker.
+
+Usage:
+    python scripts/misc/benchmark_read_video.py /path/to/meta.csv --num-frames 51 --num-samples 100
+"""
+
+import argparse
+import multiprocessing as mp
+import random
+import resource
+import time
+
+from opensora.datasets.read_video import read_video
+from opensora.datasets.utils import get_temporal_crop_indices, read_file, temporal_random_crop
+
+
+def run(mode, rows, num_frames, frame_interval, seed, result_queue):
+    random.seed(seed)
+    num_decoded_frames = 0
+    start = time.time()
+    for path, total_frames in rows:
+        if mode == "full":
+            vframes, _ = read_video(path, backend="av")
+            video = temporal_random_crop(vframes, num_frames, frame_interval)
+            num_decoded_frames += len(vframes)
+            del vframes
+        else:
+            frame_indice = get_temporal_crop_indices(total_frames, num_frames, frame_interval)
+            video, _ = read_video(path, backend="av", frame_indices=frame_indice)
+            num_decoded_frames += len(video)
+        del video
+    elapsed = time.time() - start
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024  # KB -> MB
+    result_queue.put((mode, len(rows) / elapsed, num_decoded_frames, max_rss))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("data_path", type=str, help="csv or parquet with path and num_frames columns")
+    parser.add_argument("--num-frames", type=int, default=51)
+    parser.add_argument("--frame-interval", type=int, default=1)
+    parser.add_argument("--num-samples", type=int, default=100)
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    data = read_file(args.data_path)
+    assert "num_frames" in data.columns, "num_frames is required, run `datautil --info` first"
+    data = data[data["num_frames"] >= args.num_frames * args.frame_interval]
+    data = data.sample(n=min(args.num_samples, len(data)), random_state=args.seed)
+    rows = list(zip(data["path"], data["num_frames"].astype(int)))
+
+    ctx = mp.get_context("spawn")
+    result_queue = ctx.Queue()
+    for mode in ["full", "seek"]:
+        p = ctx.Process(target=run, args=(mode, rows, args.num_frames, args.frame_interval, args.seed, result_queue))
+        p.start()
+        mode, samples_per_sec, num_decoded_frames, max_rss = result_queue.get()
+        p.join()
+        print(
+            f"[{mode}] {samples_per_sec:.2f} samples/s per worker, "
+            f"{num_decoded_frames / len(rows):.1f} frames/sample materialized, max RSS {max_rss:.0f} MB"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -7,10 +7,19 @@ import torch.distributed as dist
 from tqdm import tqdm
 
 from opensora.acceleration.parallel_states import get_data_parallel_group, set_data_parallel_group
+from opensora.datasets import LatentCacheWriter
 from opensora.datasets.dataloader import prepare_dataloader
 from opensora.registry import DATASETS, MODELS, build_module
 from opensora.utils.config_utils import parse_configs, save_training_config
-from opensora.utils.misc import FeatureSaver, Timer, create_logger, format_numel_str, get_model_numel, to_torch_dtype
+from opensora.utils.misc import (
+    AsyncFeatureWriter,
+    FeatureSaver,
+    Timer,
+    create_logger,
+    format_numel_str,
+    get_model_numel,
+    to_torch_dtype,
+)
 
 
 def main():
@@ -128,7 +137,15 @@ def main():
     save_training_config(cfg.to_dict(), save_dir)
     logger.info("Saving features to %s", save_dir)
 
-    saver = FeatureSaver(save_dir, bin_size, start_bin=start_index)
+    # the latent cache format is read per sample by LatentFeatureDataset, the .bin format by BatchFeatureDataset
+    if cfg.get("latent_cache", False):
+        saver = LatentCacheWriter(save_dir, bin_size, start_bin=start_index)
+    else:
+        saver = FeatureSaver(save_dir, bin_size, start_bin=start_index, compress=cfg.get("compress_features", False))
+    # write bins in the background, features are copied to pinned memory without blocking the GPU
+    async_save = cfg.get("async_save", False)
+    if async_save:
+        saver = AsyncFeatureWriter(saver, max_pending_bins=cfg.get("max_pending_bins", 1))
 
     # == training loop in an epoch ==
     dataloader_iter = iter(dataloader)
@@ -142,8 +159,9 @@ def main():
 
             with Timer("vae", log=log_time):
                 x = vae.encode(x)
-            with Timer("feature to cpu", log=log_time):
-                x = x.cpu()
+            if not async_save:
+                with Timer("feature to cpu", log=log_time):
+                    x = x.cpu()
 
             batch_dict = {
                 "x": x,
@@ -162,12 +180,19 @@ def main():
                     if save_compressed_text_features:
                         y_feat, y_mask = model.encode_text(y_feat, y_mask)
                         y_mask = torch.tensor(y_mask)
-                with Timer("feature to cpu", log=log_time):
-                    y_feat = y_feat.cpu()
-                    y_mask = y_mask.cpu()
+                if not async_save:
+                    with Timer("feature to cpu", log=log_time):
+                        y_feat = y_feat.cpu()
+                        y_mask = y_mask.cpu()
                 batch_dict.update({"y": y_feat, "mask": y_mask})
 
-            saver.update(batch_dict)
+            with Timer("save", log=log_time):
+                saver.update(batch_dict)
+            if async_save and log_time:
+                print(f"Feature writer: {saver.get_info()}")
+
+    if async_save:
+        saver.close()
 
 
 if __name__ == "__main__":
@@ -16,8 +16,11 @@ from tqdm import tqdm
 
 from opensora.acceleration.checkpoint import set_grad_checkpoint
 from opensora.acceleration.parallel_states import get_data_parallel_group
-from opensora.datasets.dataloader import prepare_dataloader
+from opensora.datasets.bucket import TokenBudget
+from opensora.datasets.dataloader import DevicePrefetcher, prepare_dataloader
+from opensora.datasets.latent_lru_cache import LatentLRUCache, get_vae_id
 from opensora.datasets.pin_memory_cache import PinMemoryCache
+from opensora.datasets.video_transforms import normalize_uint8_video
 from opensora.registry import DATASETS, MODELS, SCHEDULERS, build_module
 from opensora.utils.ckpt_utils import CheckpointIO, model_sharding, record_model_param_shape
 from opensora.utils.config_utils import define_experiment_workspace, parse_configs, save_training_config
@@ -55,9 +58,11 @@ def main():
     dist.init_process_group(backend="nccl", timeout=timedelta(hours=24))
     torch.cuda.set_device(dist.get_rank() % torch.cuda.device_count())
     set_seed(cfg.get("seed", 1024))
-    PinMemoryCache.force_dtype = dtype
+    # uint8 videos are normalized on device, keep them as uint8 in the pin memory cache
+    PinMemoryCache.force_dtype = torch.uint8 if cfg.dataset.get("uint8_output", False) else dtype
     pin_memory_cache_pre_alloc_numels = cfg.get("pin_memory_cache_pre_alloc_numels", [])
     PinMemoryCache.pre_alloc_numels = pin_memory_cache_pre_alloc_numels
+    PinMemoryCache.max_cache_bytes = cfg.get("pin_memory_cache_max_bytes", None)
     coordinator = DistCoordinator()
     device = get_current_device()
 
@@ -97,8 +102,30 @@ def main():
     dataset = build_module(cfg.dataset, DATASETS)
     logger.info("Dataset contains %s samples.", len(dataset))
 
+    # == latent cache ==
+    latent_cache = None
+    if cfg.get("latent_cache", None) is not None and not cfg.get("load_video_features", False):
+        assert hasattr(dataset, "latent_cache"), f"{type(dataset).__name__} does not support the latent cache"
+        latent_cache = LatentLRUCache(vae_id=get_vae_id(cfg.vae), **cfg.latent_cache)
+        dataset.latent_cache = latent_cache
+        logger.info("Using the latent cache in %s", latent_cache.cache_dir)
+
+    # == build vae ==
+    # built before the dataloader, the token budget depends on its latent size
+    vae = build_module(cfg.get("vae", None), MODELS)
+    if vae is not None:
+        vae = vae.to(device, dtype).eval()
+
     # == build dataloader ==
+    token_budget = None
+    if cfg.get("token_budget", None) is not None:
+        assert vae is not None, "The token budget requires a vae to compute the latent size"
+        token_budget = TokenBudget(
+            get_latent_size=vae.get_latent_size, sp_size=cfg.get("sp_size", 1), **cfg.token_budget
+        )
     cache_pin_memory = cfg.get("cache_pin_memory", False)
+    # number of batches copied to the device ahead of the training step, 0 to copy in the step
+    device_prefetch = cfg.get("device_prefetch", 0)
     dataloader_args = dict(
         dataset=dataset,
         batch_size=cfg.get("batch_size", None),
@@ -110,13 +137,19 @@ def main():
         process_group=get_data_parallel_group(),
         prefetch_factor=cfg.get("prefetch_factor", None),
         cache_pin_memory=cache_pin_memory,
+        shm_transport=cfg.get("shm_transport", False),
+        # keep the workers and the pinned memory cache across epochs
+        persistent_workers=cfg.get("persistent_workers", False),
+        # "thread" decodes in num_workers threads of the training process instead of worker processes
+        worker_type=cfg.get("worker_type", "process"),
     )
     dataloader, sampler = prepare_dataloader(
         bucket_config=cfg.get("bucket_config", None),
         num_bucket_build_workers=cfg.get("num_bucket_build_workers", 1),
+        token_budget=token_budget,
+        balance_ranks=cfg.get("balance_ranks", False),
         **dataloader_args,
     )
-    num_steps_per_epoch = len(dataloader)
 
     # ======================================================
     # 3. build model
@@ -131,10 +164,7 @@ def main():
         text_encoder_output_dim = cfg.get("text_encoder_output_dim", 4096)
         text_encoder_model_max_length = cfg.get("text_encoder_model_max_length", 300)
 
-    # == build vae ==
-    vae = build_module(cfg.get("vae", None), MODELS)
-    if vae is not None:
-        vae = vae.to(device, dtype).eval()
+    # == latent size ==
     if vae is not None:
         input_size = (dataset.num_frames, *dataset.image_size)
         latent_size = vae.get_latent_size(input_size)
@@ -215,7 +245,6 @@ def main():
     cfg_epochs = cfg.get("epochs", 1000)
     start_epoch = start_step = log_step = acc_step = 0
     running_loss = 0.0
-    logger.info("Training for %s epochs with %s steps per epoch", cfg_epochs, num_steps_per_epoch)
 
     # == resume ==
     if cfg.get("load", None) is not None:
@@ -233,6 +262,10 @@ def main():
             start_epoch, start_step = ret
         logger.info("Loaded checkpoint %s at epoch %s step %s", cfg.load, start_epoch, start_step)
 
+    # after the resume, which loads the saved sampler plan instead of building the buckets of the whole dataset
+    num_steps_per_epoch = len(dataloader)
+    logger.info("Training for %s epochs with %s steps per epoch", cfg_epochs, num_steps_per_epoch)
+
     model_sharding(ema, device=device)
 
     # =======================================================
@@ -260,6 +293,14 @@ def main():
         # == set dataloader to new epoch ==
         sampler.set_epoch(epoch)
         dataloader_iter = iter(dataloader)
+        if device_prefetch > 0:
+            # pinned videos are released by the prefetcher once copied
+            dataloader_iter = DevicePrefetcher(
+                dataloader_iter,
+                device,
+                num_prefetch=device_prefetch,
+                release_fn=dataloader_iter.remove_cache if cache_pin_memory else None,
+            )
         logger.info("Beginning epoch %s...", epoch)
 
         # == training loop in an epoch ==
@@ -275,8 +316,16 @@ def main():
                 #     print(f"==debug== rank{dist.get_rank()} {dataloader_iter.get_cache_info()}")
                 timer_list = []
                 with timers["move_data"] as move_data_t:
-                    pinned_video = batch.pop("video")
-                    x = pinned_video.to(device, dtype, non_blocking=True)  # [B, C, T, H, W]
+                    # with the latent cache, the videos of cached samples are replaced by their latents
+                    pinned_video = batch.pop("video", None)
+                    x = None
+                    if pinned_video is not None and pinned_video.dtype == torch.uint8:
+                        # [B, T, H, W, C] -> [B, C, T, H, W]
+                        x = normalize_uint8_video(pinned_video.to(device, non_blocking=True), dtype)
+                    elif pinned_video is not None:
+                        x = pinned_video.to(device, dtype, non_blocking=True)  # [B, C, T, H, W]
+                    cached_latent = batch.pop("latent", None)
+                    latent_keys = batch.pop("latent_key", None)
                     y = batch.pop("text")
                 if record_time:
                     timer_list.append(move_data_t)
@@ -288,7 +337,15 @@ def main():
                         if cfg.get("load_video_features", False):
                             x = x.to(device, dtype)
                         else:
-                            x = vae.encode(x)  # [B, C, T, H/P, W/P]
+                            num_encoded = 0
+                            if x is not None:
+                                x = vae.encode(x)  # [B, C, T, H/P, W/P]
+                                num_encoded = x.shape[0]
+                                if latent_cache is not None:
+                                    latent_cache.insert(latent_keys[:num_encoded], x, batch["fps"][:num_encoded])
+                            if cached_latent is not None:
+                                cached_latent = cached_latent.to(device, dtype)
+                                x = cached_latent if x is None else torch.cat([x, cached_latent])
                         # Prepare text inputs
                         if cfg.get("load_text_features", False):
                             model_args = {"y": y.to(device, dtype)}
@@ -300,6 +357,9 @@ def main():
                             model_args = text_encoder.encode(y)
                 if record_time:
                     timer_list.append(encode_t)
+                if latent_cache is not None:
+                    num_cached = x.shape[0] - num_encoded
+                    latent_cache.update_stats(num_cached, num_encoded, encode_t.elapsed_time if record_time else 0.0)
 
                 # == mask ==
                 with timers["mask"] as mask_t:
@@ -315,7 +375,7 @@ def main():
                     if isinstance(v, torch.Tensor):
                         model_args[k] = v.to(device, dtype)
 
-                if cache_pin_memory:
+                if cache_pin_memory and device_prefetch == 0 and pinned_video is not None:
                     dataloader_iter.remove_cache(pinned_video)
 
                 # == diffusion loss computation ==
@@ -374,6 +434,11 @@ def main():
                             "avg_loss": avg_loss,
                             "lr": optimizer.param_groups[0]["lr"],
                         }
+                        if latent_cache is not None:
+                            wandb_dict["latent_cache_hit_rate"] = latent_cache.hit_rate
+                        if hasattr(sampler, "get_step_skew"):
+                            # estimated time the fastest rank waits for the slowest one, relative to the average
+                            wandb_dict["debug/rank_skew"] = sampler.get_step_skew(step)
                         if record_time:
                             wandb_dict.update(
                                 {
@@ -433,6 +498,8 @@ def main():
                         log_str += f"{timer.name}: {timer.elapsed_time:.3f}s | "
                     print(log_str)
 
+        if latent_cache is not None:
+            logger.info("Latent cache at the end of epoch %s: %s", epoch, latent_cache.get_info())
         sampler.reset()
         start_step = 0
 
@@ -0,0 +1,71 @@
+import torch
+
+from opensora.models.layers.attention import BACKENDS, attention, is_available, set_attn_backend, varlen_attention
+from opensora.models.layers.blocks import MultiHeadCrossAttention
+
+
+def test_dense_attention():
+    torch.manual_seed(0)
+    q, k, v = torch.randn(3, 2, 10, 4, 16).unbind(0)
+    attn_mask = torch.rand(2, 1, 10, 10) > 0.3
+    attn_mask[..., 0] = True
+    try:
+        for kwargs in [{}, {"is_causal": True}, {"attn_mask": attn_mask}, {"is_causal": True, "attn_mask": attn_mask}]:
+            set_attn_backend("math")
+            expected = attention(q, k, v, **kwargs)
+            set_attn_backend("sdpa")
+            assert torch.allclose(attention(q, k, v, **kwargs), expected, atol=1e-5)
+    finally:
+        set_attn_backend(None)
+
+    # the first query only sees the first key
+    out = attention(q, k, v, is_causal=True)
+    assert torch.allclose(out[:, 0], v[:, 0], atol=1e-5)
+
+
+def test_varlen_attention():
+    torch.manual_seed(0)
+    q_seqlens, kv_seqlens = [6, 6, 6], [3, 7, 1]
+    q = torch.randn(1, sum(q_seqlens), 4, 16)
+    k, v = torch.randn(2, 1, sum(kv_seqlens), 4, 16).unbind(0)
+    expected = torch.cat(
+        [
+            attention(q_i, k_i, v_i)
+            for q_i, k_i, v_i in zip(q.split(q_seqlens, 1), k.split(kv_seqlens, 1), v.split(kv_seqlens, 1))
+        ],
+        dim=1,
+    )
+    try:
+        for backend in ["sdpa", "math"]:
+            set_attn_backend(backend)
+            assert torch.allclose(varlen_attention(q, k, v, q_seqlens, kv_seqlens), expected, atol=1e-5)
+            assert torch.allclose(varlen_attention(q, k, v, [4, 8, 6], kv_seqlens)[:, :4], expected[:, :4], atol=1e-5)
+    finally:
+        set_attn_backend(None)
+
+
+def test_cross_attention_without_mask():
+    torch.manual_seed(0)
+    cross_attn = MultiHeadCrossAttention(64, 4).eval()
+    x, cond = torch.randn(2, 10, 64), torch.randn(1, 6, 64)
+    q = torch.randn(1, 20, 4, 16)
+    outputs = []
+    try:
+        for backend in BACKENDS:
+            if not is_available(backend, q):
+                continue
+            set_attn_backend(backend)
+            # all the tokens of the batch attend to all the condition tokens
+            out = cross_attn(x, cond)
+            assert out.shape == x.shape
+            outputs.append(out)
+    finally:
+        set_attn_backend(None)
+    for out in outputs[1:]:
+        assert torch.allclose(out, outputs[0], atol=1e-5)
+
+
+if __name__ == "__main__":
+    test_dense_attention()
+    test_varlen_attention()
+    test_cross_attention_without_mask()
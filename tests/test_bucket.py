@@ -0,0 +1,70 @@
+import numpy as np
+
+from opensora.datasets.bucket import Bucket, TokenBudget
+from opensora.datasets.seeded_random import default_rng_random
+
+BUCKET_CONFIG = {
+    "144p": {1: (1.0, 475), 51: (1.0, 51), 102: ((1.0, 0.33), 27), 204: ((1.0, 0.1), 13), 408: ((1.0, 0.1), 6)},
+    "256": {1: (0.4, 297), 51: (0.5, 20), 102: ((0.5, 0.33), 10), 204: ((0.5, 0.1), 5), 408: ((0.5, 0.1), 2)},
+    "240p": {1: (0.3, 297), 51: (0.4, 20), 102: ((0.4, 0.33), 10), 204: ((0.4, 0.1), 5), 408: ((0.4, 0.1), 2)},
+    "360p": {1: (0.2, 141), 51: (0.15, 8), 102: ((0.15, 0.33), 4), 204: ((0.15, 0.1), 2), 408: ((0.15, 0.1), 1)},
+    "480p": {1: (0.1, 89)},
+    "720p": {1: (0.05, 36), 51: (0.3, 2)},
+    "1080p": {1: (0.1, 5)},
+}
+
+
+def test_default_rng_random():
+    rng = np.random.default_rng(0)
+    seeds = np.concatenate([np.arange(100), rng.integers(0, 2**62, 1000)])
+    draws = default_rng_random(seeds, num_draws=2)
+    for i, seed in enumerate(seeds):
+        g = np.random.default_rng(int(seed))
+        assert draws[0, i] == g.random()
+        assert draws[1, i] == g.random()
+
+
+def test_get_bucket_ids():
+    bucket = Bucket(BUCKET_CONFIG)
+    rng = np.random.default_rng(1024)
+    num_samples = 5000
+    T = np.where(rng.random(num_samples) < 0.3, 1, rng.integers(2, 500, num_samples))
+    H = rng.integers(100, 1200, num_samples)
+    W = rng.integers(100, 2000, num_samples)
+    seeds = 42 + 3 + np.arange(num_samples) * bucket.num_bucket
+
+    for frame_interval in [1, 3]:
+        codes, bucket_list = bucket.get_bucket_ids(T, H, W, frame_interval=frame_interval, seeds=seeds)
+        for i in range(num_samples):
+            expected = bucket.get_bucket_id(int(T[i]), int(H[i]), int(W[i]), frame_interval, int(seeds[i]))
+            actual = None if codes[i] < 0 else bucket_list[codes[i]]
+            assert actual == expected, f"sample {i}: {actual} != {expected}"
+
+
+def test_token_budget():
+    def get_latent_size(input_size):
+        # 4x temporal and 8x spatial compression
+        return [(input_size[0] + 3) // 4, input_size[1] // 8, input_size[2] // 8]
+
+    token_budget = TokenBudget(max_tokens=200000, get_latent_size=get_latent_size, max_batch_size=256)
+    bucket = Bucket(BUCKET_CONFIG, token_budget=token_budget)
+    for hw_id, t_bs in bucket.bucket_bs.items():
+        for t_id, bs in t_bs.items():
+            sizes = bucket.ar_criteria[hw_id][t_id].values()
+            assert bs == min(token_budget.get_batch_size(t_id, h, w) for h, w in sizes)
+            assert 1 <= bs <= 256
+    # 144p images have less than 800 tokens, capped by max_batch_size
+    assert bucket.get_batch_size(("144p", 1)) == 256
+    # 360p videos of 51 frames have 13 latent frames of 2x2 patches
+    sizes = bucket.ar_criteria["360p"][51].values()
+    max_tokens = max(13 * ((h // 8 + 1) // 2) * ((w // 8 + 1) // 2) for h, w in sizes)
+    assert bucket.get_batch_size(("360p", 51)) == 200000 // max_tokens
+
+    token_budget.sp_size = 4
+    assert Bucket(BUCKET_CONFIG, token_budget=token_budget).get_batch_size(("360p", 51)) == 4 * 200000 // max_tokens
+
+
+if __name__ == "__main__":
+    test_default_rng_random()
+    test_get_bucket_ids()
+    test_token_budget()
@@ -0,0 +1,52 @@
+import av
+import numpy as np
+
+from opensora.datasets.read_video import build_frame_index, decode_frame_index, encode_frame_index, read_video_av_frames
+
+
+def write_video(path, num_frames):
+    # the gray level of a frame encodes its index, keyframes every 12 frames with B-frames in between
+    container = av.open(path, "w")
+    stream = container.add_stream("libx264", rate=30)
+    stream.width, stream.height, stream.pix_fmt = 64, 48, "yuv420p"
+    stream.options = {"g": "12", "keyint_min": "12", "bf": "2", "sc_threshold": "0"}
+    for i in range(num_frames):
+        frame = av.VideoFrame.from_ndarray(np.full((48, 64, 3), i * 4, dtype=np.uint8), format="rgb24")
+        for packet in stream.encode(frame):
+            container.mux(packet)
+    for packet in stream.encode():
+        container.mux(packet)
+    container.close()
+
+
+def test_encode_frame_index():
+    frame_pts = np.array([0, 512, 1024, 1536, 2560, 3072])
+    keyframes = np.array([0, 4])
+    frame_index = encode_frame_index(frame_pts, keyframes)
+    assert frame_index == "0;512*3;1024*1;512*1|0;4*1"
+    decoded_pts, decoded_keyframes = decode_frame_index(frame_index)
+    assert np.array_equal(decoded_pts, frame_pts) and np.array_equal(decoded_keyframes, keyframes)
+    assert all(len(x) == 0 for x in decode_frame_index(encode_frame_index(np.zeros(0), np.zeros(0))))
+
+
+def test_read_indexed_frames(tmp_path):
+    path = str(tmp_path / "video.mp4")
+    write_video(path, 60)
+    frame_index = build_frame_index(path)
+    frame_pts, keyframes = decode_frame_index(frame_index)
+    assert len(frame_pts) == 60 and np.array_equal(keyframes, np.arange(0, 60, 12))
+
+    # frames of several GOPs, duplicates, unordered and out of range indices
+    frame_indices = [30, 2, 2, 59, 13, 100]
+    vframes, _ = read_video_av_frames(path, frame_indices, frame_index=frame_index)
+    assert len(vframes) == 5
+    assert np.abs(vframes[:, 0, 0, 0].float().numpy() - np.array([30, 2, 2, 59, 13]) * 4).max() <= 3
+
+
+if __name__ == "__main__":
+    import tempfile
+    from pathlib import Path
+
+    test_encode_frame_index()
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        test_read_indexed_frames(Path(tmp_dir))
@@ -0,0 +1,40 @@
+import os
+import time
+
+import torch
+
+from opensora.datasets.latent_lru_cache import LatentLRUCache
+
+
+def test_latent_lru_cache(tmp_path):
+    cache = LatentLRUCache(str(tmp_path), vae_id="vae", max_size_gb=0, crop_start_quantum=4)
+    key = cache.get_key("a.mp4", 0, 51, 240, 426)
+    assert key != cache.get_key("a.mp4", 4, 51, 240, 426)
+    assert key != LatentLRUCache(str(tmp_path), vae_id="other").get_key("a.mp4", 0, 51, 240, 426)
+    assert cache.get(key) is None
+
+    # everything is evicted when the cache has no room
+    latents = torch.randn(2, 4, 15, 30, 53, dtype=torch.bfloat16)
+    cache.insert([key, ""], latents, torch.tensor([24.0, 24.0]))
+    assert cache.get(key) is None
+
+    cache.max_bytes = 3 * latents[0].numel() * latents.element_size()
+    keys = [cache.get_key("a.mp4", i, 51, 240, 426) for i in range(3)]
+    cache.insert(keys[:2], latents, torch.tensor([24.0, 30.0]))
+    entry = cache.get(keys[0])
+    assert torch.equal(entry["latent"], latents[0]) and entry["fps"] == 24.0
+
+    # hits refresh the entries, the least recently used one is evicted first
+    old_time = time.time() - 100
+    os.utime(cache._get_path(keys[1]), (old_time, old_time))
+    cache.insert(keys[2:], latents[:1], torch.tensor([24.0]))
+    assert cache.get(keys[1]) is None
+    assert cache.get(keys[0]) is not None and cache.get(keys[2]) is not None
+
+
+if __name__ == "__main__":
+    import tempfile
+    from pathlib import Path
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        test_latent_lru_cache(Path(tmp_dir))
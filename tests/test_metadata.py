@@ -0,0 +1,38 @@
+import numpy as np
+import pandas as pd
+
+from opensora.datasets.metadata import MetadataStore, build_metadata, is_metadata_store
+
+
+def test_metadata_store(tmp_path):
+    data = pd.DataFrame(
+        {
+            "path": ["/data/a.mp4", "/data/视频.mp4", "/data/c.jpg"],
+            "text": ["a cat", None, ""],
+            "num_frames": [120.0, np.nan, 1.0],
+            "height": [720, 1080, 256],
+            "width": [1280, 1920, 256],
+        }
+    )
+    csv_path = str(tmp_path / "data.csv")
+    data.to_csv(csv_path, index=False)
+    store_path = str(tmp_path / "data_meta")
+    build_metadata(csv_path, store_path)
+
+    assert is_metadata_store(store_path) and not is_metadata_store(csv_path)
+    store = MetadataStore(store_path)
+    assert len(store) == 3
+    assert store.columns == ["path", "text", "num_frames", "height", "width"]
+    assert list(store["path"]) == data["path"].tolist()
+    assert list(store["text"]) == ["a cat", "", ""]
+    assert np.array_equal(store["height"], data["height"].to_numpy())
+    row = store.get_row(1)
+    assert row["path"] == "/data/视频.mp4" and pd.isna(row["num_frames"]) and row["width"] == 1920
+
+
+if __name__ == "__main__":
+    import tempfile
+    from pathlib import Path
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        test_metadata_store(Path(tmp_dir))
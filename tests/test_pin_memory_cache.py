@@ -0,0 +1,71 @@
+import torch
+
+from opensora.datasets.pin_memory_cache import PinMemoryCache, get_size_class
+
+
+def test_size_class():
+    assert get_size_class(1) == 1
+    assert get_size_class(1000) == 1024
+    assert get_size_class(1024) == 1024
+    assert get_size_class(1025) == 1280
+    for numel in range(1, 10000):
+        size_class = get_size_class(numel)
+        assert numel <= size_class <= numel * 1.25 + 1
+
+
+def test_reuse_same_size_class():
+    cache = PinMemoryCache()
+    x = torch.randn(2, 3, 16, 16)
+    out = cache.get(x)
+    assert out.shape == x.shape and out.is_pinned()
+    cache.remove(out)
+
+    # same size class is reused, a much smaller tensor gets its own cache tensor
+    out = cache.get(torch.randn(2, 3, 16, 15))
+    small = cache.get(torch.randn(2, 3, 4, 4))
+    assert len(cache.cache) == 2
+    assert cache.hit_cnt == 1 and cache.total_cnt == 3
+    cache.remove(out)
+    cache.remove(small)
+
+
+def test_reuse_larger_size_class():
+    cache = PinMemoryCache()
+    big = cache.get(torch.randn(1024 * 3))
+    cache.remove(big)
+
+    # the idle cache tensor of a larger size class is reused rather than pinning more memory
+    out = cache.get(torch.randn(1024 * 2))
+    assert out.shape == (1024 * 2,) and out.is_pinned()
+    assert len(cache.cache) == 1 and cache.hit_cnt == 1
+    cache.remove(out)
+
+    # but not for a much smaller tensor
+    small = cache.get(torch.randn(256))
+    assert len(cache.cache) == 2 and cache.hit_cnt == 1
+    cache.remove(small)
+
+
+def test_max_cache_bytes():
+    PinMemoryCache.max_cache_bytes = 4 * 1024 * 4
+    try:
+        cache = PinMemoryCache()
+        small = cache.get(torch.randn(1024 * 2))
+        cache.remove(small)
+        # the idle small cache tensor is evicted to make room for a larger size class
+        out = cache.get(torch.randn(1024 * 3))
+        assert cache.evict_cnt == 1 and len(cache.cache) == 1
+        # everything is in use, the limit is exceeded rather than blocking
+        out2 = cache.get(torch.randn(1024 * 2))
+        assert len(cache.cache) == 2
+        cache.remove(out)
+        cache.remove(out2)
+    finally:
+        PinMemoryCache.max_cache_bytes = None
+
+
+if __name__ == "__main__":
+    test_size_class()
+    test_reuse_same_size_class()
+    test_reuse_larger_size_class()
+    test_max_cache_bytes()
@@ -0,0 +1,59 @@
+import av
+import numpy as np
+import pandas as pd
+import torch
+
+from opensora.datasets.datasets import VariableVideoTextDataset
+
+
+def write_dataset(tmp_path, num_videos=2, num_frames=8, height=48, width=64):
+    paths = []
+    for i in range(num_videos):
+        path = str(tmp_path / f"video_{i}.mp4")
+        container = av.open(path, "w")
+        stream = container.add_stream("libx264", rate=24)
+        stream.width, stream.height, stream.pix_fmt = width, height, "yuv420p"
+        for _ in range(num_frames):
+            frame = np.random.randint(0, 256, (height, width, 3), dtype=np.uint8)
+            for packet in stream.encode(av.VideoFrame.from_ndarray(frame, format="rgb24")):
+                container.mux(packet)
+        for packet in stream.encode():
+            container.mux(packet)
+        container.close()
+        paths.append(path)
+    data_path = str(tmp_path / "data.csv")
+    pd.DataFrame({"path": paths, "text": "a video", "num_frames": num_frames, "height": height, "width": width}).to_csv(
+        data_path, index=False
+    )
+    return data_path
+
+
+def test_uint8_output_getitems(tmp_path):
+    dataset = VariableVideoTextDataset(write_dataset(tmp_path), transform_name="resize_crop", uint8_output=True)
+    # index-num_frames-height-width, as given by VariableVideoBatchSampler
+    samples = dataset.__getitems__(["0-4-32-40", "1-4-32-40"])
+    for sample in samples:
+        # resized THWC crops, converted to float on device
+        assert sample["video"].dtype == torch.uint8
+        assert sample["video"].shape == (4, 32, 40, 3)
+
+
+def test_batch_transform(tmp_path):
+    # clips of the whole videos, so that both datasets read the same frames
+    data_path = write_dataset(tmp_path, num_frames=4)
+    indices = ["0-4-32-40", "1-4-32-40"]
+    expected = VariableVideoTextDataset(data_path, transform_name="resize_crop").__getitems__(indices)
+    dataset = VariableVideoTextDataset(data_path, transform_name="resize_crop", batch_transform=True)
+    for sample, expected_sample in zip(dataset.__getitems__(indices), expected):
+        assert sample["video"].shape == (3, 4, 32, 40)
+        assert torch.allclose(sample["video"], expected_sample["video"], atol=1e-5)
+
+
+if __name__ == "__main__":
+    import tempfile
+    from pathlib import Path
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        test_uint8_output_getitems(Path(tmp_dir))
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        test_batch_transform(Path(tmp_dir))
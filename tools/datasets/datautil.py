@@ -13,7 +13,7 @@ import pandas as pd
 from PIL import Image
 from tqdm import tqdm
 
-from opensora.datasets.read_video import read_video
+from opensora.datasets.read_video import build_frame_index, read_video
 
 from .utils import IMG_EXTENSIONS
 
@@ -33,7 +33,18 @@ def apply(df, func, **kwargs):
     return df.progress_apply(func, **kwargs)
 
 
-TRAIN_COLUMNS = ["path", "text", "num_frames", "fps", "height", "width", "aspect_ratio", "resolution", "text_len"]
+TRAIN_COLUMNS = [
+    "path",
+    "text",
+    "num_frames",
+    "fps",
+    "height",
+    "width",
+    "aspect_ratio",
+    "resolution",
+    "text_len",
+    "frame_index",
+]
 
 # ======================================================
 # --info
@@ -146,6 +157,17 @@ def get_video_info(path, backend="torchvision"):
         raise ValueError
 
 
+def get_frame_index(path):
+    # images and unreadable videos have no index, their clips are read without it
+    try:
+        ext = os.path.splitext(path)[1].lower()
+        if ext in IMG_EXTENSIONS:
+            return ""
+        return build_frame_index(path)
+    except:
+        return ""
+
+
 # ======================================================
 # --refine-llm-caption
 # ======================================================
@@ -547,6 +569,8 @@ def main(args):
             data["fps"],
             data["resolution"],
         ) = zip(*info)
+    if args.frame_index:
+        data["frame_index"] = apply(data["path"], get_frame_index)
     if args.ext:
         assert "path" in data.columns
         data = data[apply(data["path"], os.path.exists)]
@@ -704,6 +728,9 @@ def parse_args():
     # IO-related
     parser.add_argument("--info", action="store_true", help="get the basic information of each video and image")
     parser.add_argument("--video-info", action="store_true", help="get the basic information of each video")
+    parser.add_argument(
+        "--frame-index", action="store_true", help="index the frame pts and keyframes of each video for exact seeking"
+    )
     parser.add_argument("--ext", action="store_true", help="check if the file exists")
     parser.add_argument(
         "--load-caption", type=str, default=None, choices=["json", "txt"], help="load the caption from json or txt"
@@ -786,6 +813,8 @@ def get_output_path(args, input_name):
         name += "_info"
     if args.video_info:
         name += "_vinfo"
+    if args.frame_index:
+        name += "_findex"
     if args.ext:
         name += "_ext"
     if args.load_caption:
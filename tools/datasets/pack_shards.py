@@ -0,0 +1,63 @@
+import argparse
+import io
+import os
+import tarfile
+
+from tqdm import tqdm
+
+from opensora.datasets.utils import read_file
+
+
+def pack_shards(input_path: str, output_dir: str, samples_per_shard: int, shuffle: bool = False, seed: int = 42):
+    """Pack the videos and images of a dataset file into tar shards for `ShardedVideoTextDataset`.
+
+    Each sample is stored as `{id}{ext}` with its data row as `{id}.json`. The index `{output_dir}/index.csv`
+    has the data rows with the `shard`, `offset` and `size` of each sample, and is the `data_path` of the dataset.
+    """
+    data = read_file(input_path)
+    if shuffle:
+        # shards are read sequentially, mix the samples so that each shard covers the whole dataset
+        data = data.sample(frac=1, random_state=seed).reset_index(drop=True)
+    os.makedirs(output_dir, exist_ok=True)
+
+    num_shards = (len(data) + samples_per_shard - 1) // samples_per_shard
+    shards, offsets, sizes = [], [], []
+    for shard_idx in tqdm(range(num_shards)):
+        shard = f"{shard_idx:06d}.tar"
+        rows = data.iloc[shard_idx * samples_per_shard : (shard_idx + 1) * samples_per_shard]
+        with tarfile.open(os.path.join(output_dir, shard), "w", dereference=True) as tar:
+            for row_idx, row in rows.iterrows():
+                key = f"{row_idx:09d}"
+                tar.add(row["path"], arcname=key + os.path.splitext(row["path"])[-1].lower())
+                meta = row.to_json(force_ascii=False).encode("utf-8")
+                info = tarfile.TarInfo(key + ".json")
+                info.size = len(meta)
+                tar.addfile(info, fileobj=io.BytesIO(meta))
+
+        # offsets are read back from the headers, which also handle long names
+        with tarfile.open(os.path.join(output_dir, shard), "r") as tar:
+            members = [m for m in tar.getmembers() if not m.name.endswith(".json")]
+        assert len(members) == len(rows)
+        shards.extend([shard] * len(members))
+        offsets.extend(m.offset_data for m in members)
+        sizes.extend(m.size for m in members)
+
+    data["shard"] = shards
+    data["offset"] = offsets
+    data["size"] = sizes
+    index_path = os.path.join(output_dir, "index.csv")
+    data.to_csv(index_path, index=False)
+    print(f"Packed {len(data)} samples into {num_shards} shards, index saved to {index_path}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("input", type=str, help="path to the .csv or .parquet file")
+    parser.add_argument("-o", "--output", required=True, help="output directory of the shards and the index")
+    parser.add_argument("--samples-per-shard", type=int, default=1000)
+    parser.add_argument("--shuffle", action="store_true", help="shuffle the samples before packing")
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+    assert args.samples_per_shard > 0
+
+    pack_shards(args.input, args.output, args.samples_per_shard, args.shuffle, args.seed)
@@ -20,12 +20,14 @@ def extract_frames(
     backend="opencv",
     return_length=False,
     num_frames=None,
+    frame_index=None,
 ):
     """
     Args:
         video_path (str): path to video
         frame_inds (List[int]): indices of frames to extract
         points (List[float]): values within [0, 1); multiply #frames to get frame indices
+        frame_index (str): index of the video built by `datautil --frame-index`, for exact seeking with "av"
     Return:
         List[PIL.Image]
     """
@@ -45,13 +47,20 @@ def extract_frames(
             frame_inds = [int(p * total_frames) for p in points]
 
         frames = []
-        for idx in frame_inds:
-            if idx >= total_frames:
-                idx = total_frames - 1
-            target_timestamp = int(idx * av.time_base / container.streams.video[0].average_rate)
-            container.seek(target_timestamp)
-            frame = next(container.decode(video=0)).to_image()
-            frames.append(frame)
+        if frame_index is not None:
+            from opensora.datasets.read_video import read_video_av_frames
+
+            frame_inds = [min(idx, total_frames - 1) for idx in frame_inds]
+            vframes, _ = read_video_av_frames(video_path, frame_inds, frame_index=frame_index)
+            frames = [Image.fromarray(x) for x in vframes.numpy()]
+        else:
+            for idx in frame_inds:
+                if idx >= total_frames:
+                    idx = total_frames - 1
+                target_timestamp = int(idx * av.time_base / container.streams.video[0].average_rate)
+                container.seek(target_timestamp)
+                frame = next(container.decode(video=0)).to_image()
+                frames.append(frame)
 
         if return_length:
             return frames, total_frames